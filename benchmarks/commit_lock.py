@@ -0,0 +1,96 @@
+"""Commit-lock hold time of large transactions, by JSON conversion mode
+
+Usage::
+
+  python benchmarks/commit_lock.py DSN [-n NUMBER_OF_OBJECTS] [-r REPEAT] [-j N]
+
+The database at DSN is cleared before each measurement.
+
+RelStorage takes its commit lock when a transaction is voted and holds
+it until the transaction is finished, so other committers wait for
+anything done in between.  Without worker processes, records are
+converted to JSON as they're stored, before the lock is taken.  With
+worker processes, records are sent to the workers in batches as
+they're stored, and conversions still running when the transaction
+is voted are finished before the lock is taken.  For comparison, the
+last measurement converts all of a transaction's records after the
+lock is taken.
+"""
+from __future__ import print_function
+import argparse
+import time
+
+import relstorage.adapters.postgresql.locker
+
+import newt.db
+from newt.db import Object
+from newt.db._adapter import Mover
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('dsn', help="PostgreSQL connection string")
+parser.add_argument('-n', '--objects', type=int, default=10000,
+                    help="Number of objects changed per transaction")
+parser.add_argument('-r', '--repeat', type=int, default=5,
+                    help="Number of transactions to measure")
+parser.add_argument('-j', '--jsonify-processes', type=int, default=4,
+                    help="Number of jsonifier worker processes")
+
+Locker = relstorage.adapters.postgresql.locker.PostgreSQLLocker
+locked = []
+
+def hold_commit_lock(self, *args, **kw):
+    result = hold_commit_lock.original(self, *args, **kw)
+    locked.append(time.time())
+    return result
+
+hold_commit_lock.original = Locker.hold_commit_lock
+
+def measure(options, name, processes, batch_size=Mover.json_batch_size,
+            before_lock=True):
+    storage = newt.db.storage(options.dsn)
+    storage.zap_all()
+    storage.close()
+    db = newt.db.DB(options.dsn, jsonify_processes=processes)
+    with db.transaction() as conn:
+        conn.root.obs = [Object(i=i, body=u'Lorem ipsum dolor sit amet ' * 9)
+                         for i in range(options.objects)]
+
+    conn = db.open()
+    adapter = conn._storage._adapter
+    adapter.mover.json_batch_size = batch_size
+    if not before_lock:
+        adapter.locker.before_commit_lock = None
+    held = []
+    total = []
+    for r in range(options.repeat):
+        for ob in conn.root.obs:
+            ob.r = r
+        del locked[:]
+        start = time.time()
+        conn.commit()
+        end = time.time()
+        total.append(end - start)
+        held.append(end - locked[-1])
+    conn.close()
+    db.close()
+
+    held.sort()
+    total.sort()
+    print("%-32s lock held %7.1f ms  commit %7.1f ms (medians)" % (
+        name, held[len(held) // 2] * 1000, total[len(total) // 2] * 1000))
+
+def main(args=None):
+    options = parser.parse_args(args)
+    Locker.hold_commit_lock = hold_commit_lock
+    try:
+        measure(options, 'inline', 0)
+        if options.jsonify_processes:
+            processes = options.jsonify_processes
+            measure(options, '%s processes' % processes, processes)
+            measure(options, '%s processes, under the lock' % processes,
+                    processes, options.objects + 1, False)
+    finally:
+        Locker.hold_commit_lock = hold_commit_lock.original
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Jsonifier micro benchmarks
+
+Usage::
+
+  python benchmarks/jsonifier.py [-n NUMBER_OF_OBJECTS] [-r REPEAT] [-j N]
+
+Database records are generated by committing objects to an in-memory
+ZODB database, so the pickles are the same as the ones newt converts
+when committing or when running the updater.
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import timeit
+
+import persistent
+import persistent.mapping
+import ZODB
+
+from newt.db.jsonpickle import Jsonifier, JsonUnpickler
+from newt.db.jsonpickle import encode, encode_tree, jsonable
+
+def encoders():
+    """Return encoder backends to compare, by name
+    """
+    result = [('json + default', encode), ('json + jsonable', encode_tree)]
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        def encode_orjson(ob, **json_args):
+            return orjson.dumps(
+                jsonable(ob), option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        result.append(('orjson + jsonable', encode_orjson))
+    return result
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('-n', '--objects', type=int, default=10000,
+                    help="Number of objects (records) to convert")
+parser.add_argument('-r', '--repeat', type=int, default=5,
+                    help="Number of times to repeat each measurement")
+parser.add_argument('-j', '--jsonify-processes', type=int, default=4,
+                    help="Number of worker processes for Jsonifier.map")
+
+class Document(persistent.Persistent):
+
+    def __init__(self, i, folder):
+        self.title = u'Document %s' % i
+        self.body = u'Lorem ipsum dolor sit amet ' * (i % 20)
+        self.tags = ['tag%s' % (i % 7), 'tag%s' % (i % 11)]
+        self.created = datetime.datetime(2017, 1, 1, 12, i % 60)
+        self.size = i * 17
+        self.folder = folder
+
+class Small(persistent.Persistent):
+
+    def __init__(self, i):
+        self.i = i
+
+def records(n):
+    """Return a list of database records (pickles)
+    """
+    db = ZODB.DB(None)
+    with db.transaction() as conn:
+        folder = conn.root.folder = persistent.mapping.PersistentMapping()
+        for i in range(n):
+            if i % 2:
+                ob = Document(i, folder)
+            else:
+                ob = Small(i)
+            folder[str(i)] = ob
+    result = [r.data for t in db.storage.iterator() for r in t]
+    db.close()
+    return result
+
+def class_via_json(data):
+    # How Jsonifier used to get class names
+    unpickler = JsonUnpickler(data)
+    klass = json.loads(unpickler.load())
+    if isinstance(klass, list):
+        klass, args = klass
+    return klass['name'], unpickler.pos
+
+def class_via_load_class(data):
+    unpickler = JsonUnpickler(data)
+    class_name, _ = unpickler.load_class()
+    return class_name, unpickler.pos
+
+def measure(name, func, data, repeat, nrecords=None):
+    def run():
+        for d in data:
+            func(d)
+    seconds = min(timeit.repeat(run, number=1, repeat=repeat))
+    print("%-30s %8.3f seconds %10.1f usec/record" % (
+        name, seconds, seconds * 1e6 / (nrecords or len(data))))
+    return seconds
+
+def main(args=None):
+    options = parser.parse_args(args)
+    data = records(options.objects)
+    print("%d records" % len(data))
+
+    old = measure('class via JSON round trip', class_via_json,
+                  data, options.repeat)
+    new = measure('class via load_class', class_via_load_class,
+                  data, options.repeat)
+    print("load_class saves %.0f%% of the class conversion time"
+          % ((old - new) * 100 / old))
+
+    for name, encoder in encoders():
+        jsonifier = Jsonifier(encoder=encoder)
+        measure('Jsonifier, ' + name,
+                lambda d: jsonifier(None, d), data, options.repeat)
+
+    jsonifier = Jsonifier()
+
+    batch = list(enumerate(data))
+    measure('Jsonifier.map, inline', jsonifier.map, [batch], options.repeat,
+            len(batch))
+    if options.jsonify_processes:
+        jsonifier = Jsonifier(processes=options.jsonify_processes)
+        jsonifier.map(batch[:2]) # Start the workers before measuring
+        measure('Jsonifier.map, %s processes' % options.jsonify_processes,
+                jsonifier.map, [batch], options.repeat, len(batch))
+        jsonifier.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Commit latency with concurrent newt writers, by newt-lock strategy
+
+Usage::
+
+  python benchmarks/newt_lock.py DSN [-c COMMITTERS] [-n TRANSACTIONS]
+
+The database at DSN is cleared before each measurement.
+
+Committer threads repeatedly change their own objects and commit,
+while another connection keeps writing a different newt record,
+holding its transaction open for a while each time, the way an
+updater, a bulk job, or an index build might.  This is the same sort
+of workload as the ``shootout`` configuration (``shootout.cfg`` has
+an entry per strategy), but with the outside writer that makes the
+lock strategy matter.  RelStorage serializes committers with its own
+commit lock, so the differences come from interactions with other
+writers.
+"""
+from __future__ import print_function
+import argparse
+import threading
+import time
+
+from ZODB.utils import u64
+import newt.db
+from newt.db import Object
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('dsn', help="PostgreSQL connection string")
+parser.add_argument('-c', '--committers', type=int, default=4,
+                    help="Number of committing threads")
+parser.add_argument('-n', '--transactions', type=int, default=50,
+                    help="Number of transactions per committer")
+parser.add_argument('-w', '--writer-hold', type=float, default=.05,
+                    help="Seconds the outside writer holds each transaction")
+parser.add_argument('-s', '--strategies', default='table,rows',
+                    help="Comma-separated newt-lock strategies to measure")
+
+def committer(db, name, transactions, times):
+    conn = db.open()
+    obs = conn.root()[name]
+    for t in range(transactions):
+        for ob in obs:
+            ob.t = t
+        start = time.time()
+        conn.commit()
+        times.append(time.time() - start)
+    conn.close()
+
+def writer(dsn, zoid, hold, stop):
+    pg = newt.db.pg_connection(dsn)
+    cursor = pg.cursor()
+    while not stop.is_set():
+        cursor.execute("update newt set class_name = class_name"
+                       " where zoid = %s", (zoid, ))
+        time.sleep(hold)
+        pg.commit()
+    pg.close()
+
+def measure(options, strategy):
+    storage = newt.db.storage(options.dsn, newt_lock=strategy)
+    storage.zap_all()
+    storage.close()
+    db = newt.db.DB(options.dsn, newt_lock=strategy)
+    names = ['obs%s' % c for c in range(options.committers)]
+    with db.transaction() as conn:
+        other = conn.root.other = Object(name='other')
+        for name in names:
+            conn.root()[name] = [Object(i=i) for i in range(10)]
+
+    stop = threading.Event()
+    writer_thread = threading.Thread(
+        target=writer,
+        args=(options.dsn, u64(other._p_oid), options.writer_hold, stop))
+    writer_thread.start()
+
+    times = []
+    threads = [threading.Thread(target=committer,
+                                args=(db, name, options.transactions, times))
+               for name in names]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    stop.set()
+    writer_thread.join()
+    db.close()
+
+    times.sort()
+    print("%-10s %8.1f commits/s  median %6.1f ms  max %7.1f ms" % (
+        strategy, len(times) / elapsed,
+        times[len(times) // 2] * 1000, times[-1] * 1000))
+
+def main(args=None):
+    options = parser.parse_args(args)
+    for strategy in options.strategies.split(','):
+        measure(options, strategy)
+
+if __name__ == '__main__':
+    main()
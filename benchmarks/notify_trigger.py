@@ -0,0 +1,75 @@
+"""Commit overhead of change-notification triggers
+
+Usage::
+
+  python benchmarks/notify_trigger.py DSN [-o OBJECTS] [-n TRANSACTIONS]
+
+The database at DSN is cleared before each measurement.
+
+Transactions that each change the given number of objects are
+committed without a notification trigger, with the row-level trigger
+installed by earlier versions of newt.db, which sends a notification
+per object, and with the statement-level triggers that send a
+notification per transaction.  Notifications are queued, and
+deduplicated, as transactions commit, whether or not anything is
+listening.
+"""
+from __future__ import print_function
+import argparse
+import time
+
+import newt.db
+from newt.db import Object
+from newt.db import follow
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('dsn', help="PostgreSQL connection string")
+parser.add_argument('-o', '--objects', type=int, default=20000,
+                    help="Number of objects changed per transaction")
+parser.add_argument('-n', '--transactions', type=int, default=5,
+                    help="Number of transactions to commit")
+
+def install(dsn, sql):
+    pg = newt.db.pg_connection(dsn)
+    cursor = pg.cursor()
+    for name in (follow.ROW_TRIGGER, ) + follow.STATEMENT_TRIGGERS:
+        cursor.execute("drop trigger if exists %s on object_state" % name)
+    if sql:
+        cursor.execute(sql)
+    pg.commit()
+    pg.close()
+
+def measure(options, name, sql):
+    storage = newt.db.storage(options.dsn)
+    storage.zap_all()
+    storage.close()
+    db = newt.db.DB(options.dsn)
+    install(options.dsn, sql)
+
+    with db.transaction() as conn:
+        conn.root.obs = [Object(i=i) for i in range(options.objects)]
+
+    times = []
+    conn = db.open()
+    for t in range(options.transactions):
+        for ob in conn.root.obs:
+            ob.t = t
+        start = time.time()
+        conn.commit()
+        times.append(time.time() - start)
+    conn.close()
+    db.close()
+
+    times.sort()
+    print("%-10s median %8.1f ms  max %8.1f ms" % (
+        name, times[len(times) // 2] * 1000, times[-1] * 1000))
+
+def main(args=None):
+    options = parser.parse_args(args)
+    print("%d objects per transaction" % options.objects)
+    measure(options, 'none', None)
+    measure(options, 'row', follow.row_trigger_sql)
+    measure(options, 'statement', follow.trigger_sql)
+
+if __name__ == '__main__':
+    main()
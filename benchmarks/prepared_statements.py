@@ -0,0 +1,80 @@
+"""Search latency with and without server-side prepared statements
+
+Usage::
+
+  python benchmarks/prepared_statements.py DSN [-n OBJECTS] [-q QUERIES] [-r REPEAT]
+
+The database at DSN is cleared before the measurements.
+
+The same parameterized search is run repeatedly, with different
+parameter values, with ``prepared_statement_cache_size`` unset, so
+each query is parsed and planned, and with it set, so the first query
+prepares a statement and the rest execute it.  Queries are run with
+``read_only_cursor`` and only executing and fetching are timed, so
+times don't include getting cursors or loading objects.
+Measurements alternate, ``-r`` times, to even out noise.
+"""
+from __future__ import print_function
+import argparse
+import time
+
+import newt.db
+from newt.db import Object
+from newt.db.search import prepared_statements, read_only_cursor
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('dsn', help="PostgreSQL connection string")
+parser.add_argument('-n', '--objects', type=int, default=100,
+                    help="Number of objects to search")
+parser.add_argument('-q', '--queries', type=int, default=5000,
+                    help="Number of queries to measure")
+parser.add_argument('-r', '--repeat', type=int, default=3,
+                    help="Number of times to repeat the measurements")
+
+query = """
+select zoid from newt
+where state->>'kind' = %s and (state->>'i')::int between %s and %s
+and state @> %s
+order by (state->>'i')::int desc
+limit 10
+"""
+
+def measure(options, name, size):
+    db = newt.db.DB(options.dsn, prepared_statement_cache_size=size)
+    conn = db.open()
+    kinds = ('a', 'b', 'c')
+    times = []
+    for q in range(options.queries):
+        i = q % options.objects
+        cursor = read_only_cursor(conn)
+        start = time.time()
+        cursor.execute(query, (kinds[q % 3], i, i + 50, '{"tag": "t"}'))
+        cursor.fetchall()
+        times.append(time.time() - start)
+        cursor.close()
+    statements = prepared_statements(conn)
+    conn.close()
+    db.close()
+
+    times.sort()
+    print("%-12s %6.3f ms per query (median), %6.3f ms (min)%s" % (
+        name, times[len(times) // 2] * 1000, times[0] * 1000,
+        '  ' + repr(statements.stats()) if statements else ''))
+
+def main(args=None):
+    options = parser.parse_args(args)
+    storage = newt.db.storage(options.dsn)
+    storage.zap_all()
+    storage.close()
+    db = newt.db.DB(options.dsn)
+    with db.transaction() as conn:
+        conn.root.obs = [Object(i=i, kind='abc'[i % 3], tag='t')
+                         for i in range(options.objects)]
+    db.close()
+
+    for r in range(options.repeat):
+        measure(options, 'unprepared', 0)
+        measure(options, 'prepared', 10)
+
+if __name__ == '__main__':
+    main()
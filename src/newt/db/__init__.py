@@ -1,6 +1,7 @@
 from . import _ook; del _ook # Monkey patches
 from ._db import connection, DB, storage, Connection, pg_connection
 from ._object import Object
+from .auxiliary import AuxiliaryTable
 from persistent import Persistent
 from persistent.list import PersistentList as List
 from BTrees.OOBTree import BTree
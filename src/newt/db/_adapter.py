@@ -1,9 +1,16 @@
+import binascii
+import csv
+import hashlib
+import io
 import relstorage.adapters.postgresql
+import relstorage.adapters.postgresql.locker
 import relstorage.adapters.postgresql.mover
 import relstorage.adapters.postgresql.schema
+import threading
 
+from . import auxiliary
 from .jsonpickle import Jsonifier
-from ._util import trigger_exists
+from ._util import column_exists, trigger_exists
 
 class Adapter(relstorage.adapters.postgresql.PostgreSQLAdapter):
 
@@ -11,6 +18,11 @@ class Adapter(relstorage.adapters.postgresql.PostgreSQLAdapter):
         super(Adapter, self).__init__(*args, **kw)
 
         driver = relstorage.adapters.postgresql.select_driver(self.options)
+        self.locker = Locker(
+            options=self.options,
+            lock_exceptions=driver.lock_exceptions,
+            version_detector=self.version_detector,
+        )
         self.schema = SchemaInstaller(
             connmanager=self.connmanager,
             runner=self.runner,
@@ -25,15 +37,153 @@ class Adapter(relstorage.adapters.postgresql.PostgreSQLAdapter):
             Binary=driver.Binary,
         )
         self.connmanager.set_on_store_opened(self.mover.on_store_opened)
+        self.locker.before_commit_lock = self.mover.before_commit_lock
 
         self.mover.jsonifier = Jsonifier(
-            transform=getattr(self.options, 'transform', None))
+            transform=getattr(self.options, 'transform', None),
+            processes=getattr(self.options, 'jsonify_processes', None),
+            encoder=getattr(self.options, 'json_encoder', None),
+            )
         self.mover.auxiliary_tables = getattr(self.options,
                                               'auxiliary_tables', ())
+        self.mover.skip_unchanged = getattr(self.options,
+                                            'skip_unchanged', False)
+        self.schema.skip_unchanged = self.mover.skip_unchanged
+        self.mover.copy_json = getattr(self.options, 'copy_json', False)
+        self.mover.newt_lock = getattr(self.options, 'newt_lock', 'table')
+        if self.mover.newt_lock not in Mover._lock_newt_sql:
+            raise ValueError("Invalid newt_lock option",
+                             self.mover.newt_lock)
+        self.mover.write_stats = WriteStats()
+        self.read_replicas = ReadReplicas(
+            getattr(self.options, 'read_replicas', ()),
+            driver, self.txncontrol)
+
+    def new_instance(self):
+        inst = super(Adapter, self).new_instance()
+        # Share the jsonifier, and thus any worker processes it uses.
+        inst.mover.jsonifier = self.mover.jsonifier
+        inst.mover.write_stats = self.mover.write_stats
+        return inst
+
+def state_digest(ghost_pickle, state):
+    """Compute the digest of newt data stored in the state_digest column
+    """
+    return hashlib.md5(ghost_pickle + state.encode('utf-8')).digest()
+
+def _bytea(data):
+    # Format binary data for COPY
+    return '\\x' + binascii.b2a_hex(data).decode('ascii')
+
+class WriteStats(object):
+    """Counts of newt records written and of unchanged records skipped
+    """
+
+    written = unchanged = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def add(self, written, unchanged):
+        with self._lock:
+            self.written += written
+            self.unchanged += unchanged
+
+class ReadReplicas(object):
+    """Connections to read replicas, used for searches
+
+    There's a connection to each replica DSN, opened when first used.
+    Connections use repeatable-read transactions, so queries see the
+    data as of the lag check.
+    """
+
+    def __init__(self, dsns, driver, txncontrol):
+        self.dsns = tuple(dsns)
+        self.driver = driver
+        self.txncontrol = txncontrol
+        self._connections = {}
+        self._next = 0
+
+    def __bool__(self):
+        return bool(self.dsns)
+
+    __nonzero__ = __bool__
+
+    def _connection(self, dsn):
+        conn = self._connections.get(dsn)
+        if conn is None:
+            conn = self.driver.connect(dsn)
+            conn.set_session(isolation_level='REPEATABLE READ',
+                             readonly=True)
+            self._connections[dsn] = conn
+        return conn
+
+    def cursor(self, tid, name=None):
+        """Return a cursor for a replica that's caught up with a tid
+
+        Replicas are tried in turn, starting with the one after the
+        last one used.  ``None`` is returned if no replica has
+        committed the transaction with the given integer id, or if
+        none are available.
+        """
+        dsns = self.dsns
+        for i in range(len(dsns)):
+            dsn = dsns[(self._next + i) % len(dsns)]
+            try:
+                conn = self._connection(dsn)
+                conn.rollback()
+                cursor = conn.cursor()
+                try:
+                    replica_tid = self.txncontrol.get_tid(cursor)
+                finally:
+                    cursor.close()
+            except self.driver.disconnected_exceptions:
+                self._close(dsn)
+                continue
+            if replica_tid >= tid:
+                self._next = (self._next + i + 1) % len(dsns)
+                return conn.cursor(name)
+        return None
+
+    def _close(self, dsn):
+        conn = self._connections.pop(dsn, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for dsn in list(self._connections):
+            self._close(dsn)
+
+class Locker(relstorage.adapters.postgresql.locker.PostgreSQLLocker):
+
+    # Called with the cursor before the commit lock is taken, so
+    # work can be finished without holding it
+    before_commit_lock = None
+
+    def hold_commit_lock(self, cursor, ensure_current=False, nowait=False):
+        if self.before_commit_lock is not None:
+            self.before_commit_lock(cursor)
+        return super(Locker, self).hold_commit_lock(
+            cursor, ensure_current, nowait)
 
 class Mover(relstorage.adapters.postgresql.mover.PostgreSQLObjectMover):
 
+    # Number of records sent to jsonifier worker processes at a time
+    json_batch_size = 100
+
     def on_store_opened(self, cursor, restart=False):
+        # When using jsonifier worker processes, records waiting to be
+        # sent to the workers, and batches of records being converted,
+        # with their pending results:
+        self.json_records = []
+        self.json_conversions = []
+        # Converted records to be copied to temp_store_json when the
+        # transaction is voted, when using copy_json:
+        self.json_rows = {}
+
         cursor.execute("""\
         select from information_schema.tables
         where table_name = 'temp_store' and table_type = 'LOCAL TEMPORARY'
@@ -46,46 +196,193 @@ class Mover(relstorage.adapters.postgresql.mover.PostgreSQLObjectMover):
                 zoid         BIGINT NOT NULL,
                 class_name   TEXT,
                 ghost_pickle BYTEA,
-                state        JSONB
+                state        JSONB,
+                state_digest BYTEA
             ) ON COMMIT DROP""")
 
     def store_temp(self, cursor, batcher, oid, prev_tid, data):
         super(Mover, self).store_temp(cursor, batcher, oid, prev_tid, data)
-        class_name, ghost_pickle, state = self.jsonifier(oid, data)
+        if self.jsonifier.processes:
+            self._queue_json_record(oid, data)
+            self._store_json_conversions(batcher)
+        elif self.copy_json:
+            self.json_rows[oid] = self.jsonifier(oid, data)
+        else:
+            batcher.delete_from('temp_store_json', zoid=oid)
+            self._store_temp_json(batcher, oid, *self.jsonifier(oid, data))
+
+    def replace_temp(self, cursor, oid, prev_tid, data):
+        super(Mover, self).replace_temp(cursor, oid, prev_tid, data)
+        if self.jsonifier.processes:
+            self._queue_json_record(oid, data)
+        elif oid in self.json_rows:
+            self.json_rows[oid] = self.jsonifier(oid, data)
+
+    def _store_temp_json(self, batcher, oid, class_name, ghost_pickle, state):
         if class_name is None:
             return
-        batcher.delete_from('temp_store_json', zoid=oid)
         batcher.insert_into(
-            "temp_store_json (zoid, class_name, ghost_pickle, state)",
-            "%s, %s, %s, %s",
-            (oid, class_name, self.Binary(ghost_pickle), state),
+            "temp_store_json (zoid, class_name, ghost_pickle, state,"
+            " state_digest)",
+            "%s, %s, %s, %s, %s",
+            (oid, class_name, self.Binary(ghost_pickle), state,
+             self.Binary(state_digest(ghost_pickle, state))),
             rowkey=oid,
             size=len(state),
             )
 
-    _move_json_sql = """
-    LOCK TABLE newt IN SHARE MODE;
+    def _queue_json_record(self, oid, data):
+        # Records are converted by worker processes in batches as
+        # they're stored, so most of the work is done before the
+        # transaction is voted and the commit lock is held.
+        self.json_records.append((oid, data))
+        if len(self.json_records) >= self.json_batch_size:
+            self._start_json_conversion()
+
+    def _start_json_conversion(self):
+        records = self.json_records
+        self.json_records = []
+        self.json_conversions.append(
+            (records, self.jsonifier.map_async(records)))
 
-    INSERT INTO newt (zoid, class_name, ghost_pickle, state)
-    SELECT zoid, class_name, ghost_pickle, state
+    def _store_json_conversions(self, batcher, wait=False):
+        # Store the results of finished conversions, in the order
+        # they were started, so later records for an object (e.g.
+        # from conflict resolution) replace earlier ones.
+        conversions = self.json_conversions
+        while conversions and (wait or conversions[0][1].ready()):
+            records, result = conversions.pop(0)
+            for (oid, _), converted in zip(records, result.get()):
+                if self.copy_json:
+                    self.json_rows[oid] = converted
+                else:
+                    batcher.delete_from('temp_store_json', zoid=oid)
+                    self._store_temp_json(batcher, oid, *converted)
+
+    def before_commit_lock(self, cursor):
+        # Finish converting records before the transaction is voted.
+        # Records replaced by conflict resolution, after the lock is
+        # taken, are converted in move_from_temp.
+        if self.json_records or self.json_conversions:
+            self._convert_json_records(cursor)
+
+    def _convert_json_records(self, cursor):
+        if self.json_records:
+            self._start_json_conversion()
+        batcher = self.make_batcher(cursor, None)
+        self._store_json_conversions(batcher, True)
+        batcher.flush()
+
+    _copy_json_sql = """
+    COPY temp_store_json (zoid, class_name, ghost_pickle, state, state_digest)
+    FROM STDIN WITH (FORMAT csv)
+    """
+
+    def _copy_json_rows(self, cursor):
+        rows = self.json_rows
+        self.json_rows = {}
+        copy_expert = getattr(cursor, 'copy_expert', None)
+        if copy_expert is None:
+            # The driver can't copy, so insert the rows instead.
+            batcher = self.make_batcher(cursor, None)
+            for oid in sorted(rows):
+                self._store_temp_json(batcher, oid, *rows[oid])
+            batcher.flush()
+            return
+
+        data = io.StringIO()
+        writer = csv.writer(data, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        for oid in sorted(rows):
+            class_name, ghost_pickle, state = rows[oid]
+            if class_name is None:
+                continue
+            writer.writerow((
+                oid, class_name, _bytea(ghost_pickle), state,
+                _bytea(state_digest(ghost_pickle, state)),
+                ))
+        data.seek(0)
+        copy_expert(self._copy_json_sql, data)
+
+    # Statements that lock newt records before they're written, by
+    # newt_lock option value.  Committers are already serialized by
+    # the RelStorage commit lock, so these only order committers
+    # with other writers of the newt table.  Locking the whole table
+    # makes committers wait for other writers, including the
+    # updater and index builds, to finish.  Locking the existing
+    # records being written, in zoid order, only waits for writers of
+    # those records.  The updater locks the records it writes in zoid
+    # order too, but a writer that locks records in another order
+    # can deadlock with a committer, in which case PostgreSQL aborts
+    # one of the transactions.
+    _lock_newt_sql = {
+        'table': "LOCK TABLE newt IN SHARE MODE",
+        'rows': """
+            SELECT FROM newt WHERE zoid IN (SELECT zoid FROM temp_store)
+            ORDER BY zoid FOR UPDATE
+            """,
+        }
+
+    _move_json_sql = """
+    INSERT INTO newt (zoid, class_name, ghost_pickle, state, state_digest)
+    SELECT zoid, class_name, ghost_pickle, state, state_digest
     FROM temp_store_json order by zoid
     ON CONFLICT (zoid) DO UPDATE SET
       class_name = EXCLUDED.class_name,
       ghost_pickle = EXCLUDED.ghost_pickle,
-      state = EXCLUDED.state;
+      state = EXCLUDED.state,
+      state_digest = EXCLUDED.state_digest;
     """
 
-    _update_aux_sql = """
-    DELETE FROM %(name)s WHERE zoid IN (SELECT zoid FROM temp_store);
-    INSERT INTO %(name)s (zoid)
-    SELECT zoid FROM temp_store join newt using (zoid);
+    # Like _move_json_sql, but rows with unchanged data aren't updated
+    # and the numbers of rows to write and rows written are returned.
+    # The delete trigger doesn't remove the records of stored objects
+    # (see move_from_temp), so records for objects that no longer
+    # have JSON data are removed here.
+    _move_changed_json_sql = """
+    DELETE FROM newt
+    WHERE zoid IN (SELECT zoid FROM temp_store)
+      AND zoid NOT IN (SELECT zoid FROM temp_store_json);
+
+    WITH written AS (
+      INSERT INTO newt (zoid, class_name, ghost_pickle, state, state_digest)
+      SELECT zoid, class_name, ghost_pickle, state, state_digest
+      FROM temp_store_json order by zoid
+      ON CONFLICT (zoid) DO UPDATE SET
+        class_name = EXCLUDED.class_name,
+        ghost_pickle = EXCLUDED.ghost_pickle,
+        state = EXCLUDED.state,
+        state_digest = EXCLUDED.state_digest
+      WHERE newt.state_digest IS DISTINCT FROM EXCLUDED.state_digest
+      RETURNING zoid)
+    SELECT (SELECT count(*) FROM temp_store_json),
+           (SELECT count(*) FROM written);
     """
 
     def move_from_temp(self, cursor, tid, txn_has_blobs):
+        # Lock before history-free storages delete object_state rows,
+        # as the delete trigger may delete newt records.
+        cursor.execute(self._lock_newt_sql[self.newt_lock])
+        if self.skip_unchanged:
+            # History-free storages delete and reinsert object_state
+            # rows. Keep the delete trigger from removing the newt
+            # records so unchanged ones needn't be rewritten.
+            cursor.execute("SELECT set_config('newt.storing', 'true', true)")
         r = super(Mover, self).move_from_temp(cursor, tid, txn_has_blobs)
-        cursor.execute(self._move_json_sql)
-        for name in self.auxiliary_tables:
-            cursor.execute(self._update_aux_sql % dict(name=name))
+        if self.skip_unchanged:
+            cursor.execute("SELECT set_config('newt.storing', '', true)")
+        if self.json_records or self.json_conversions:
+            self._convert_json_records(cursor)
+        if self.json_rows:
+            self._copy_json_rows(cursor)
+        if self.skip_unchanged:
+            cursor.execute(self._move_changed_json_sql)
+            [[stored, written]] = cursor.fetchall()
+            self.write_stats.add(written, stored - written)
+        else:
+            cursor.execute(self._move_json_sql)
+        if self.auxiliary_tables:
+            auxiliary.refresh(cursor, self.auxiliary_tables,
+                              "SELECT zoid FROM temp_store")
         return r
 
     def restore(self, cursor, batcher, oid, tid, data):
@@ -95,15 +392,16 @@ class Mover(relstorage.adapters.postgresql.mover.PostgreSQLObjectMover):
             return
         batcher.delete_from('newt', zoid=oid)
         batcher.insert_into(
-            "newt (zoid, class_name, ghost_pickle, state)",
-            "%s, %s, %s, %s",
-            (oid, class_name, self.Binary(ghost_pickle), state),
+            "newt (zoid, class_name, ghost_pickle, state, state_digest)",
+            "%s, %s, %s, %s, %s",
+            (oid, class_name, self.Binary(ghost_pickle), state,
+             self.Binary(state_digest(ghost_pickle, state))),
             rowkey=oid,
             size=len(state),
             )
 
 _newt_delete_on_state_delete = """
-create function newt_delete_on_state_delete() returns trigger
+create or replace function newt_delete_on_state_delete() returns trigger
 as $$
 begin
   delete from newt where zoid = OLD.zoid;
@@ -112,6 +410,38 @@ end;
 $$ language plpgsql;
 """
 
+# Used when skipping unchanged records.  The setting is looked up in
+# an exception block, because current_setting's missing_ok argument
+# requires PostgreSQL 9.6.
+_newt_delete_on_state_delete_storing = """
+create or replace function newt_delete_on_state_delete() returns trigger
+as $$
+declare
+  storing text;
+begin
+  -- When skipping unchanged records, object_state rows deleted to be
+  -- replaced are handled by the mover.
+  begin
+    storing := current_setting('newt.storing');
+  exception when undefined_object then
+    storing := null;
+  end;
+  if storing is distinct from 'true' then
+    delete from newt where zoid = OLD.zoid;
+  end if;
+  return old;
+end;
+$$ language plpgsql;
+"""
+
+def _update_newt_delete_on_state_delete(cursor):
+    # Older functions don't know about newt.storing, or need
+    # PostgreSQL 9.6.
+    cursor.execute("select prosrc from pg_catalog.pg_proc"
+                   " where proname = 'newt_delete_on_state_delete'")
+    if 'undefined_object' not in ''.join(src for [src] in cursor):
+        cursor.execute(_newt_delete_on_state_delete_storing)
+
 _newt_delete_on_state_delete_HP = """
 create function newt_delete_on_state_delete() returns trigger
 as $$
@@ -132,15 +462,22 @@ create table newt (
   zoid bigint primary key,
   class_name text,
   ghost_pickle bytea,
-  state jsonb);
+  state jsonb,
+  state_digest bytea);
 create index newt_json_idx on newt using gin (state);
 """
 
+def _add_state_digest(cursor):
+    # newt tables created by older versions don't have state digests
+    if not column_exists(cursor, 'newt', 'state_digest'):
+        cursor.execute("alter table newt add column state_digest bytea")
+
 DELETE_TRIGGER = 'newt_delete_on_state_delete_trigger'
 
-def _create_newt_delete_trigger(cursor, keep_history):
+def _create_newt_delete_trigger(cursor, keep_history, skip_unchanged=False):
     cursor.execute(
         _newt_delete_on_state_delete_HP if keep_history else
+        _newt_delete_on_state_delete_storing if skip_unchanged else
         _newt_delete_on_state_delete)
     cursor.execute("""
     create trigger %s
@@ -148,23 +485,30 @@ def _create_newt_delete_trigger(cursor, keep_history):
       execute procedure newt_delete_on_state_delete();
     """ % DELETE_TRIGGER)
 
-def create_newt(cursor, keep_history=None):
+def create_newt(cursor, keep_history=None, skip_unchanged=False):
     keep_history = determine_keep_history(cursor, keep_history)
     cursor.execute(_newt_ddl)
-    _create_newt_delete_trigger(cursor, keep_history)
+    _create_newt_delete_trigger(cursor, keep_history, skip_unchanged)
 
 class SchemaInstaller(
     relstorage.adapters.postgresql.schema.PostgreSQLSchemaInstaller):
 
+    skip_unchanged = False
+
     def create(self, cursor):
         super(SchemaInstaller, self).create(cursor)
-        create_newt(cursor, self.keep_history)
+        create_newt(cursor, self.keep_history, self.skip_unchanged)
 
     def update_schema(self, cursor, tables):
         if 'newt' not in tables:
-            create_newt(cursor)
+            create_newt(cursor, self.keep_history, self.skip_unchanged)
+        else:
+            _add_state_digest(cursor)
         if not trigger_exists(cursor, DELETE_TRIGGER):
-            _create_newt_delete_trigger(cursor, self.keep_history)
+            _create_newt_delete_trigger(cursor, self.keep_history,
+                                        self.skip_unchanged)
+        elif self.skip_unchanged and not self.keep_history:
+            _update_newt_delete_on_state_delete(cursor)
 
     def drop_all(self):
         def callback(_conn, cursor):
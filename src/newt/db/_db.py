@@ -3,6 +3,7 @@ import relstorage.storage
 import relstorage.options
 import ZODB
 
+from . import query as _query
 from . import search as _search
 from ._adapter import Adapter
 
@@ -10,11 +11,13 @@ class NewtDB:
     """Wrapper for a ZODB.DB object that provides newt.db-specific connections
     """
 
-    def __init__(self, db):
+    def __init__(self, db, search_cache_size=0):
         self._db = db
+        self.search_cache = (_search.SearchCache(search_cache_size)
+                             if search_cache_size else None)
 
     def open(self, *args, **kw):
-        return Connection(self._db.open(*args, **kw))
+        return Connection(self._db.open(*args, **kw), self.search_cache)
 
     def __getattr__(self, name):
         return getattr(self._db, name)
@@ -30,20 +33,49 @@ class Connection:
         return _search.search(self, query, *args, **kw)
     search.__doc__ = _search.search.__doc__
 
-    def search_batch(self, query, args, batch_start, batch_size=None):
-        return _search.search_batch(self, query, args, batch_start, batch_size)
+    def search_batch(self, query, args, batch_start, batch_size=None,
+                     count='exact', prefetch=False):
+        return _search.search_batch(
+            self, query, args, batch_start, batch_size, count, prefetch)
     search_batch.__doc__ = _search.search_batch.__doc__
 
+    def search_iter(self, query, args=None, fetch_size=1000):
+        return _search.search_iter(self, query, args, fetch_size)
+    search_iter.__doc__ = _search.search_iter.__doc__
+
+    def search_page(self, query, args=None, token=None, page_size=20,
+                    sort=None, descending=False):
+        return _search.search_page(
+            self, query, args, token, page_size, sort, descending)
+    search_page.__doc__ = _search.search_page.__doc__
+
+    def search_count(self, query, args=None, mode='exact'):
+        return _search.search_count(self, query, args, mode)
+    search_count.__doc__ = _search.search_count.__doc__
+
     def create_text_index(self, fname, D=None, C=None, B=None, A=None,
-                          config=None):
-        return _search.create_text_index(self, fname, D, C, B, A, config)
+                          config=None, concurrently=False, progress=None,
+                          progress_interval=1, stored=False, batch_size=1000):
+        return _search.create_text_index(self, fname, D, C, B, A, config,
+                                         concurrently, progress,
+                                         progress_interval, stored,
+                                         batch_size)
     create_text_index.__doc__ = _search.create_text_index.__doc__
 
-    def create_text_index_sql(fname, D=None, C=None, B=None, A=None):
-        return _search.create_text_index_sql(fname, D, C, B, A)
+    def create_text_index_sql(fname, D=None, C=None, B=None, A=None,
+                              config=None, concurrently=False, stored=False):
+        return _search.create_text_index_sql(fname, D, C, B, A, config,
+                                             concurrently, stored)
     create_text_index_sql.__doc__ = _search.create_text_index_sql.__doc__
     create_text_index_sql = staticmethod(create_text_index_sql)
 
+    def text_search(self, fname, text, query_tail=None, args=(), limit=None,
+                    config=None, parser='plainto_tsquery', stored=True,
+                    prefetch=False):
+        return _search.text_search(self, fname, text, query_tail, args,
+                                   limit, config, parser, stored, prefetch)
+    text_search.__doc__ = _search.text_search.__doc__
+
     def query_data(self, query, *args, **kw):
         return _search.query_data(self, query, *args, **kw)
     query_data.__doc__ = _search.query_data.__doc__
@@ -52,13 +84,36 @@ class Connection:
         return _search.where(self, query_tail, *args, **kw)
     where.__doc__ = _search.where.__doc__
 
-    def where_batch(self, query_tail, args, batch_start, batch_size=None):
+    def where_batch(self, query_tail, args, batch_start, batch_size=None,
+                    count='exact', prefetch=False):
         return _search.where_batch(
-            self, query_tail, args, batch_start, batch_size)
+            self, query_tail, args, batch_start, batch_size, count, prefetch)
     where_batch.__doc__ = _search.where_batch.__doc__
 
-    def __init__(self, connection):
+    def where_iter(self, query_tail, args=None, fetch_size=1000):
+        return _search.where_iter(self, query_tail, args, fetch_size)
+    where_iter.__doc__ = _search.where_iter.__doc__
+
+    def where_page(self, query_tail, args=None, token=None, page_size=20,
+                   sort=None, descending=False):
+        return _search.where_page(
+            self, query_tail, args, token, page_size, sort, descending)
+    where_page.__doc__ = _search.where_page.__doc__
+
+    def where_count(self, query_tail, args=None, mode='exact'):
+        return _search.where_count(self, query_tail, args, mode)
+    where_count.__doc__ = _search.where_count.__doc__
+
+    def query(self):
+        """Return a query builder for searching this connection
+
+        See :py:class:`newt.db.query.Query`.
+        """
+        return _query.Query(self)
+
+    def __init__(self, connection, search_cache=None):
         self._connection = connection # A ZODB connection
+        self.search_cache = search_cache
 
     def __getattr__(self, name):
         return getattr(self._connection, name)
@@ -109,7 +164,10 @@ def _split_options(
         large_record_size=large_record_size,
         ), storage_options
 
-def storage(dsn, keep_history=False, transform=None, auxiliary_tables=(), **kw):
+def storage(dsn, keep_history=False, transform=None, auxiliary_tables=(),
+            jsonify_processes=0, json_encoder=None, skip_unchanged=False,
+            copy_json=False, newt_lock='table',
+            prepared_statement_cache_size=0, read_replicas=(), **kw):
     """Create a RelStorage storage using the newt PostgresQL adapter.
 
     Keyword options can be used to provide either `ZODB.DB
@@ -117,13 +175,60 @@ def storage(dsn, keep_history=False, transform=None, auxiliary_tables=(), **kw):
     options or `RelStorage
     <http://relstorage.readthedocs.io/en/latest/relstorage-options.html>`_
     options.
+
+    If ``jsonify_processes`` is non-zero, it's the number of worker
+    processes used to convert object state to JSON.  A transaction's
+    records are then sent to the workers in batches as they're
+    stored, and conversion is finished before the commit lock is
+    taken when the transaction is voted.
+
+    A ``json_encoder`` function may be provided to encode object state
+    as JSON. See ``newt.db.jsonpickle.encode`` for details.
+
+    If ``skip_unchanged`` is true, then newt records whose data haven't
+    changed aren't rewritten when objects are saved.
+
+    If ``copy_json`` is true, then JSON data are sent to the database
+    with a single ``COPY`` statement when a transaction is voted,
+    rather than with insert statements as objects are stored.  This
+    is faster for large transactions.
+
+    ``newt_lock`` controls how newt records are locked when
+    transactions are committed.  (Committers are always serialized
+    with each other by the commit lock.)  The default, ``'table'``,
+    locks the whole newt table, so commits wait for other writers to
+    the table, such as the updater, to finish.  ``'rows'`` locks the
+    existing records being written, in object-id order, so commits
+    only wait for writers of those records.  Writers that lock records
+    in a different order can deadlock with commits, in which case
+    PostgreSQL aborts one of the transactions.
+
+    If ``prepared_statement_cache_size`` is non-zero, parameterized
+    search queries are executed using server-side prepared
+    statements, keeping up to the given number of statements per
+    database connection.  See ``newt.db.search.PreparedStatements``.
+
+    ``read_replicas`` is a sequence of connection strings for read
+    replicas of the database, such as PostgreSQL hot standbys.
+    Search queries are routed to them in turn, skipping replicas that
+    haven't yet replayed the last transaction seen by the connection
+    searched, and using the primary database if none have.  Replica
+    results may reflect transactions committed after the ones the
+    connection has seen.
     """
     options = relstorage.options.Options(keep_history=keep_history, **kw)
     options.transform = transform
     options.auxiliary_tables = auxiliary_tables
+    options.jsonify_processes = jsonify_processes
+    options.json_encoder = json_encoder
+    options.skip_unchanged = skip_unchanged
+    options.copy_json = copy_json
+    options.newt_lock = newt_lock
+    options.prepared_statement_cache_size = prepared_statement_cache_size
+    options.read_replicas = tuple(read_replicas)
     return relstorage.storage.RelStorage(Adapter(dsn, options), options=options)
 
-def DB(dsn, **kw):
+def DB(dsn, search_cache_size=0, **kw):
     """Create a Newt DB database object.
 
     Keyword options can be used to provide either `ZODB.DB
@@ -135,9 +240,15 @@ def DB(dsn, **kw):
     A Newt DB object is a thin wrapper around ``ZODB.DB``
     objects. When it's ``open`` method is called, it returns
     :py:class:`newt.db.Connection` objects.
+
+    If ``search_cache_size`` is non-zero, results of ``search`` and
+    ``where`` calls are cached, keeping up to the given number of
+    results.  The cache is available as the database's
+    ``search_cache`` attribute.  See ``newt.db.search.SearchCache``.
     """
     db_options, storage_options = _split_options(**kw)
-    return NewtDB(ZODB.DB(storage(dsn, **storage_options), **db_options))
+    return NewtDB(ZODB.DB(storage(dsn, **storage_options), **db_options),
+                  search_cache_size)
 
 def connection(dsn, **kw):
     """Create a newt :py:class:`newt.db.Connection`.
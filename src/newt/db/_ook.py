@@ -1,5 +1,6 @@
 import relstorage.storage
 import ZODB.Connection
+from ZODB.utils import p64
 
 # Monkey patches, ook
 def _ex_cursor(self, name=None):
@@ -12,11 +13,86 @@ def _ex_cursor(self, name=None):
 
 relstorage.storage.RelStorage.ex_cursor = _ex_cursor
 
+def _ex_replica_cursor(self, name=None):
+    """Get a cursor for a read replica that's caught up with our view
+
+    ``None`` is returned if there are no replicas, if the storage
+    hasn't polled for changes yet, or if all of the replicas lag
+    behind the last transaction polled.
+    """
+    if self._stale_error is not None:
+        raise self._stale_error
+
+    replicas = getattr(self._adapter, 'read_replicas', None)
+    if not replicas:
+        return None
+
+    with self._lock:
+        tid = self._prev_polled_tid
+        if tid is None:
+            return None
+        return replicas.cursor(tid, name)
+
+relstorage.storage.RelStorage.ex_replica_cursor = _ex_replica_cursor
+
+_drop_load_connection = relstorage.storage.RelStorage._drop_load_connection
+def _ex_drop_load_connection(self):
+    _drop_load_connection(self)
+    replicas = getattr(self._adapter, 'read_replicas', None)
+    if replicas is not None:
+        replicas.close()
+
+relstorage.storage.RelStorage._drop_load_connection = _ex_drop_load_connection
+
 def _ex_connect(self):
     return self._adapter.connmanager.open()
 
 relstorage.storage.RelStorage.ex_connect = _ex_connect
 
+_load_states_sql = {
+    False: "select zoid, tid, state from object_state where zoid = any(%s)",
+    True: """
+    select zoid, tid, state
+    from current_object join object_state using (zoid, tid)
+    where zoid = any(%s)
+    """,
+    }
+
+def _ex_load_states(self, oids):
+    """Load the current states of objects with the given integer oids
+
+    A sequence of oid, tid, and state tuples is returned.  States
+    are added to the storage cache.
+    """
+    if self._stale_error is not None:
+        raise self._stale_error
+
+    cache = self._cache
+    with self._lock:
+        self._before_load()
+        cursor = self._load_cursor
+        cursor.execute(_load_states_sql[self._adapter.keep_history],
+                       (list(oids), ))
+        result = [(oid_int, tid_int, bytes(state))
+                  for oid_int, tid_int, state in cursor
+                  if state]
+
+        if cache.checkpoints:
+            # Like a cache miss in StorageCache.load:
+            cp0 = cache.checkpoints[0]
+            local_client = cache.local_client
+            for oid_int, tid_int, state in result:
+                delta_tid_int = cache.delta_after0.get(oid_int)
+                cache._check_tid_after_load(oid_int, tid_int, delta_tid_int)
+                local_client.set(
+                    '%s:state:%d:%d' % (
+                        cache.prefix, delta_tid_int or cp0, oid_int),
+                    p64(tid_int) + state)
+
+    return result
+
+relstorage.storage.RelStorage.ex_load_states = _ex_load_states
+
 def _ex_get(self, oid, ghost_pickle):
     """Return the persistent object with oid 'oid'."""
     if self.opened is None:
@@ -44,3 +120,30 @@ def _ex_get(self, oid, ghost_pickle):
     return obj
 
 ZODB.Connection.Connection.ex_get = _ex_get
+
+def _ex_setstates(self, states):
+    """Activate ghosts using states loaded from the database
+
+    states is a dictionary mapping oids to objects, states and serials.
+    """
+    original_setstate = self.setstate
+    def setstate(obj):
+        data = states.get(obj._p_oid)
+        if data is None or data[0] is not obj:
+            return original_setstate(obj)
+        _, state, serial = data
+        self._load_count += 1
+        self._reader.setGhostState(obj, state)
+        obj._p_serial = serial
+        self._cache.update_object_size_estimation(obj._p_oid, len(state))
+        obj._p_estimated_size = len(state)
+
+    # Persistent objects call their jar's setstate when activated.
+    self.setstate = setstate
+    try:
+        for obj, _, _ in states.values():
+            obj._p_activate()
+    finally:
+        del self.setstate
+
+ZODB.Connection.Connection.ex_setstates = _ex_setstates
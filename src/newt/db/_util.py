@@ -19,6 +19,14 @@ def table_exists(cursor, name):
         (name, ))
     return bool(list(cursor))
 
+def column_exists(cursor, table, name):
+    cursor.execute(
+        "select from information_schema.columns "
+        "where table_schema = 'public' AND table_name = %s "
+        "AND column_name = %s",
+        (table, name))
+    return bool(list(cursor))
+
 def trigger_exists(cursor, name):
     cursor.execute(
         "select from pg_catalog.pg_trigger "
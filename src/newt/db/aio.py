@@ -0,0 +1,407 @@
+"""Asyncio search API
+
+Searches are run in a dedicated thread pool, with a PostgreSQL
+connection per thread, so they don't block the event loop::
+
+  searcher = newt.db.aio.Searcher(dsn)
+  rows = await searcher.where("state @> %s", '{"status": "open"}')
+  tasks = newt.db.aio.ghosts(conn, rows)
+
+Search methods return rows of object ids and ghost pickles rather
+than objects, because ZODB connections can't be used from other
+threads.  Use ``ghosts`` to get objects from them with a ZODB
+connection.
+
+Each search is run in its own database transaction, so results may
+reflect newer (or older) data than a ZODB connection's view.
+
+Asynchronous versions of ``newt.db.follow.listen`` and
+``newt.db.follow.updates`` are also provided.  These use
+asynchronous PostgreSQL connections, so they don't need threads::
+
+  async for batch in newt.db.aio.updates(dsn):
+      async for tid, zoid, data in batch:
+          ...
+"""
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+import relstorage.adapters.postgresql
+import relstorage.options
+from ZODB.utils import p64, u64
+
+from . import follow as _follow
+from . import pg_connection
+from . import search as _search
+from ._util import closing
+
+class _Reader(object):
+    # Stand-in for a ZODB connection and storage used by the search
+    # module, using a PostgreSQL connection, and returning rows
+    # rather than objects
+
+    _options = None
+
+    def __init__(self, pg):
+        self._storage = self
+        self._pg = pg
+
+    def ex_cursor(self, name=None):
+        return self._pg.cursor(name)
+
+    def ex_get(self, oid, ghost_pickle):
+        return u64(oid), ghost_pickle
+
+class Searcher(object):
+    """Run searches asynchronously
+
+    Searches are run with up to ``max_workers`` threads, each with
+    its own connection to the database given by ``dsn``.
+    """
+
+    def __init__(self, dsn, max_workers=4, driver_name='auto'):
+        self.dsn = dsn
+        self.driver_name = driver_name
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _reader(self):
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            pg = pg_connection(self.dsn, self.driver_name)
+            with self._lock:
+                self._connections.append(pg)
+            reader = self._local.reader = _Reader(pg)
+        return reader
+
+    def _call(self, func, *args, **kw):
+        reader = self._reader()
+        try:
+            return func(reader, *args, **kw)
+        finally:
+            reader._pg.rollback()
+
+    def _run(self, func, *args, **kw):
+        if kw.pop('prefetch', False):
+            # There are no ghosts to load states into.
+            raise ValueError("prefetch isn't supported by Searcher")
+        return asyncio.get_event_loop().run_in_executor(
+            self._executor,
+            functools.partial(self._call, func, *args, **kw))
+
+    async def search(self, query, *args, **kw):
+        """Search using an SQL query
+
+        See ``newt.db.search.search``.  A list of object id and
+        ghost pickle tuples is returned.  The ``prefetch`` option
+        isn't supported.
+        """
+        return await self._run(_search.search, query, *args, **kw)
+
+    async def where(self, query_tail, *args, **kw):
+        """Search for objects satisfying criteria
+
+        See ``newt.db.search.where``.  A list of object id and ghost
+        pickle tuples is returned.  The ``prefetch`` option isn't
+        supported.
+        """
+        return await self._run(_search.where, query_tail, *args, **kw)
+
+    async def search_batch(self, query, args, batch_start, batch_size=None,
+                           count='exact'):
+        """Search for a batch of results
+
+        See ``newt.db.search.search_batch``.  A count and a list of
+        object id and ghost pickle tuples are returned.
+        """
+        return await self._run(_search.search_batch, query, args,
+                               batch_start, batch_size, count)
+
+    async def where_batch(self, query_tail, args, batch_start,
+                          batch_size=None, count='exact'):
+        """Search for a batch of objects satisfying criteria
+
+        See ``newt.db.search.where_batch``.  A count and a list of
+        object id and ghost pickle tuples are returned.
+        """
+        return await self._run(_search.where_batch, query_tail, args,
+                               batch_start, batch_size, count)
+
+    async def search_count(self, query, args=None, mode='exact'):
+        """Count the results of a query
+
+        See ``newt.db.search.search_count``.
+        """
+        return await self._run(_search.search_count, query, args, mode)
+
+    async def where_count(self, query_tail, args=None, mode='exact'):
+        """Count objects satisfying criteria
+
+        See ``newt.db.search.where_count``.
+        """
+        return await self._run(_search.where_count, query_tail, args, mode)
+
+    async def text_search(self, fname, text, query_tail=None, args=(),
+                          limit=None, config=None, parser='plainto_tsquery',
+                          stored=True):
+        """Search a text index, ordering results by rank
+
+        See ``newt.db.search.text_search``.  A list of object id and
+        ghost pickle tuples is returned.
+        """
+        return await self._run(_search.text_search, fname, text, query_tail,
+                               args, limit, config, parser, stored)
+
+    async def query_data(self, query, *args, **kw):
+        """Query for raw data
+
+        See ``newt.db.search.query_data``.
+        """
+        return await self._run(_search.query_data, query, *args, **kw)
+
+    def close(self):
+        """Stop the worker threads and close their database connections
+        """
+        self._executor.shutdown()
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for pg in connections:
+            try:
+                pg.close()
+            except Exception:
+                pass
+
+def ghosts(conn, rows):
+    """Return objects for rows returned by ``Searcher`` search methods
+    """
+    get = conn.ex_get
+    return [get(p64(zoid), ghost_pickle) for zoid, ghost_pickle in rows]
+
+# Connection poll states of the asynchronous protocol implemented by
+# psycopg2 and psycopg2cffi
+POLL_OK, POLL_READ, POLL_WRITE = range(3)
+
+def _async_connection(dsn, driver_name='auto'):
+    options = relstorage.options.Options(driver=driver_name)
+    driver = relstorage.adapters.postgresql.select_driver(options)
+    return driver.connect(dsn, async_=True)
+
+async def _ready(conn, write=False, timeout=None):
+    # Wait for a connection's socket to be readable or writable.
+    # Return False if the timeout expired first.
+    loop = asyncio.get_event_loop()
+    fileno = conn.fileno()
+    ready = loop.create_future()
+
+    def callback():
+        if not ready.done():
+            ready.set_result(None)
+
+    if write:
+        loop.add_writer(fileno, callback)
+    else:
+        loop.add_reader(fileno, callback)
+    try:
+        await asyncio.wait_for(ready, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        if write:
+            loop.remove_writer(fileno)
+        else:
+            loop.remove_reader(fileno)
+
+async def _wait(conn):
+    # Wait for the current operation of a connection to complete
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+        await _ready(conn, state == POLL_WRITE)
+
+async def _execute(conn, cursor, sql, args=None):
+    cursor.execute(sql, args)
+    await _wait(conn)
+
+def _install_trigger(dsn, driver_name):
+    with closing(pg_connection(dsn, driver_name)) as conn:
+        with closing(conn.cursor()) as cursor:
+            _follow.install_trigger(cursor)
+        conn.commit()
+
+async def listen(dsn, timeout_on_start=False, poll_timeout=300,
+                 driver_name='auto'):
+    """Listen for newt database updates
+
+    Returns an asynchronous iterator that returns transaction ids or
+    None values, like ``newt.db.follow.listen``.
+    """
+    await asyncio.get_event_loop().run_in_executor(
+        None, _install_trigger, dsn, driver_name)
+
+    conn = _async_connection(dsn, driver_name)
+    try:
+        await _wait(conn)
+        await _execute(conn, conn.cursor(), "LISTEN " + _follow.NOTIFY)
+
+        if timeout_on_start:
+            # avoid a race between catching up and starting to LISTEN
+            yield None
+
+        while True:
+            if not await _ready(conn, timeout=poll_timeout):
+                yield None
+            else:
+                conn.poll()
+                if conn.notifies:
+                    notifies = conn.notifies[:]
+                    del conn.notifies[:]
+                    if any(n.payload == 'STOP' for n in notifies):
+                        return # for tests
+                    # yield the last
+                    yield notifies[-1].payload
+    finally:
+        conn.close()
+
+async def _non_empty(rows):
+    try:
+        first = await rows.__anext__()
+    except StopAsyncIteration:
+        return None
+
+    async def it():
+        yield first
+        async for row in rows:
+            yield row
+
+    return it()
+
+async def _no_rows():
+    for row in ():
+        yield row
+
+class Updates(_follow.Updates):
+
+    driver_name = 'auto'
+
+    def _prepare_query(self):
+        with closing(pg_connection(self.dsn, self.driver_name)) as conn:
+            with closing(conn.cursor()) as cursor:
+                self._prepare(cursor)
+            conn.commit()
+
+    async def _rows(self, conn, cursor):
+        # Asynchronous connections can't use named cursors, so a
+        # server-side cursor is declared explicitly.
+        tid = self.tid
+        args = dict(tid=tid)
+        await _execute(conn, cursor, "begin")
+        try:
+            if self.partitions > 1:
+                await _execute(conn, cursor, self._max_tid_query)
+                [[max_tid]] = cursor.fetchall()
+                args['max_tid'] = max_tid = self._max_tid(max_tid)
+
+            await _execute(
+                conn, cursor,
+                "declare object_state_updates no scroll cursor for "
+                + self._query,
+                args)
+            n = 0
+            while True:
+                await _execute(conn, cursor,
+                               "fetch %s from object_state_updates",
+                               (self.internal_batch_size, ))
+                rows = cursor.fetchall()
+                if not rows:
+                    if self.partitions > 1:
+                        self.tid = max_tid # caught up
+                    break
+                for row in rows:
+                    if row[0] != tid:
+                        if n >= self.batch_limit:
+                            return
+                        tid = self.tid = row[0]
+                    yield row
+                    n += 1
+        finally:
+            try:
+                await _execute(conn, cursor, "rollback")
+            except Exception:
+                pass
+
+    async def __aiter__(self):
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._prepare_query)
+
+        conn = _async_connection(self.dsn, self.driver_name)
+        try:
+            await _wait(conn)
+            cursor = conn.cursor()
+
+            # Catch up:
+            while True:
+                tid = self.tid
+                rows = self._rows(conn, cursor)
+                batch = await _non_empty(rows)
+                if batch is None:
+                    if self.tid != tid:
+                        # Partition progress, without records
+                        yield _no_rows()
+                    break # caught up
+                try:
+                    yield batch
+                finally:
+                    await rows.aclose()
+
+            if self.end_tid is None:
+                notifications = listen(self.dsn, True, self.poll_timeout,
+                                       self.driver_name)
+                try:
+                    async for payload in notifications:
+                        tid = self.tid
+                        rows = self._rows(conn, cursor)
+                        batch = await _non_empty(rows)
+                        if batch is not None:
+                            try:
+                                yield batch
+                            finally:
+                                await rows.aclose()
+                        elif self.tid != tid:
+                            yield _no_rows()
+                finally:
+                    await notifications.aclose()
+        finally:
+            conn.close()
+
+def updates(dsn, start_tid=-1, end_tid=None,
+            batch_limit=100000, internal_batch_size=100,
+            poll_timeout=300, driver_name='auto', partition=0, partitions=1,
+            tombstones=False):
+    """Create an asynchronous data-update iterator
+
+    This is an asynchronous version of ``newt.db.follow.updates``,
+    with the same arguments and batching, except that the iterator,
+    and the batches it returns, are asynchronous iterators::
+
+      async for batch in newt.db.aio.updates(dsn):
+          async for tid, zoid, data in batch:
+              print(tid, zoid, len(data))
+
+    Records are fetched from a server-side cursor,
+    ``internal_batch_size`` at a time, without blocking the event
+    loop.  A batch should be fully processed before the next batch is
+    requested.
+    """
+    result = Updates(dsn, start_tid, end_tid, batch_limit,
+                     internal_batch_size, poll_timeout,
+                     partition=partition, partitions=partitions,
+                     tombstones=tombstones)
+    result.driver_name = driver_name
+    return result
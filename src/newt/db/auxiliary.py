@@ -0,0 +1,102 @@
+"""Auxiliary tables maintained from newt data
+
+Auxiliary tables have a ``zoid`` primary key and are refreshed for
+object ids whose newt records have been written, both when
+transactions are committed (see the ``auxiliary_tables`` storage
+option) and by the updater (see its ``--auxiliary-tables`` option).
+"""
+
+class AuxiliaryTable(object):
+    """Declaration of an auxiliary table computed from newt records
+
+    ``columns`` is a sequence of ``(column, expression)`` pairs (or a
+    mapping from columns to expressions).  Expressions are SQL
+    expressions evaluated against ``newt`` records, for example::
+
+      AuxiliaryTable('titles', [('title', "state->>'title'")],
+                     where="class_name = 'myapp.Book'")
+
+    The table has a row for each newt record that satisfies the
+    optional ``where`` condition.  Rows for other records are removed.
+
+    ``changed`` is an optional SQL condition that must be true for an
+    existing row to be updated.  The existing row is referred to as
+    ``aux`` and the new one as ``excluded``.  By default, rows are
+    updated only if a column value is different.
+    """
+
+    def __init__(self, name, columns=(), where=None, changed=None):
+        self.name = name
+        if hasattr(columns, 'items'):
+            columns = sorted(columns.items())
+        self.columns = tuple(columns)
+        self.where = where
+        if changed is None and self.columns:
+            changed = "(%s) IS DISTINCT FROM (%s)" % (
+                ', '.join('aux.' + c for c, _ in self.columns),
+                ', '.join('excluded.' + c for c, _ in self.columns),
+                )
+        self.changed = changed
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+    def refresh_sql(self, zoids):
+        """Return a statement that refreshes rows for object ids
+
+        ``zoids`` is a query that returns the object ids in a ``zoid``
+        column.
+        """
+        names = ''.join(', ' + c for c, _ in self.columns)
+        if self.columns:
+            conflict = "DO UPDATE SET %s" % ', '.join(
+                "%s = excluded.%s" % (c, c) for c, _ in self.columns)
+            if self.changed:
+                conflict += " WHERE " + self.changed
+        else:
+            conflict = "DO NOTHING"
+        return _refresh_sql % dict(
+            name=self.name,
+            zoids=zoids,
+            names=names,
+            expressions=''.join(', %s AS %s' % (e, c)
+                                for c, e in self.columns),
+            where=(' AND (%s)' % self.where) if self.where else '',
+            conflict=conflict,
+            )
+
+_refresh_sql = """
+WITH changed_zoids AS (%(zoids)s),
+  projected AS (
+    SELECT zoid%(expressions)s FROM newt
+    WHERE zoid IN (SELECT zoid FROM changed_zoids)%(where)s),
+  deleted AS (
+    DELETE FROM %(name)s
+    WHERE zoid IN (SELECT zoid FROM changed_zoids)
+      AND zoid NOT IN (SELECT zoid FROM projected))
+INSERT INTO %(name)s AS aux (zoid%(names)s)
+SELECT * FROM projected ORDER BY zoid
+ON CONFLICT (zoid) %(conflict)s
+"""
+
+# Tables given by name get rows with just zoids, and they're
+# replaced rather than updated, so insert triggers can compute
+# other columns.
+_replace_sql = """
+DELETE FROM %(name)s WHERE zoid IN (%(zoids)s);
+INSERT INTO %(name)s (zoid)
+SELECT zoid FROM newt WHERE zoid IN (%(zoids)s);
+"""
+
+def refresh(cursor, tables, zoids):
+    """Refresh auxiliary tables for object ids
+
+    ``tables`` is a sequence of ``AuxiliaryTable`` objects or table
+    names. ``zoids`` is a query that returns the object ids to be
+    refreshed in a ``zoid`` column.
+    """
+    for table in tables:
+        if isinstance(table, AuxiliaryTable):
+            cursor.execute(table.refresh_sql(zoids))
+        else:
+            cursor.execute(_replace_sql % dict(name=table, zoids=zoids))
@@ -11,6 +11,14 @@ class Adapter:
     def __init__(self, config):
         self.auxiliary_tables = config.auxiliary_tables
         self.transform = config.transform
+        self.jsonify_processes = config.jsonify_processes
+        self.json_encoder = config.json_encoder
+        self.skip_unchanged = config.skip_unchanged
+        self.copy_json = config.copy_json
+        self.newt_lock = config.newt_lock
+        self.prepared_statement_cache_size = (
+            config.prepared_statement_cache_size)
+        self.read_replicas = config.read_replicas
         self.config = config.adapter.config
 
     def create(self, options):
@@ -19,6 +27,16 @@ class Adapter:
         if transform is not None:
             options.transform = global_by_name(transform)
         options.auxiliary_tables = self.auxiliary_tables or ()
+        options.jsonify_processes = self.jsonify_processes
+        json_encoder = self.json_encoder
+        if json_encoder is not None:
+            options.json_encoder = global_by_name(json_encoder)
+        options.skip_unchanged = self.skip_unchanged
+        options.copy_json = self.copy_json
+        options.newt_lock = self.newt_lock
+        options.prepared_statement_cache_size = (
+            self.prepared_statement_cache_size)
+        options.read_replicas = tuple(self.read_replicas or ())
 
         return Adapter(dsn=self.config.dsn, options=options)
 
@@ -40,4 +58,4 @@ class DB:
                        relstorage.adapters.postgresql.PostgreSQLAdapter)
             ), "Invalid storage"
         from ._db import NewtDB
-        return NewtDB(db)
+        return NewtDB(db, self.config.search_cache_size)
@@ -1,4 +1,5 @@
 import logging
+import struct
 
 from . import pg_connection
 from ._util import closing, table_exists, trigger_exists
@@ -20,8 +21,13 @@ def non_empty_generator(gen):
             yield v
     return it()
 
-trigger_sql = """
-create function newt_notify_object_state_changed() returns trigger
+# Row-level notification trigger, used with PostgreSQL versions
+# before 10, which don't support transition tables, and by older
+# versions of newt.db:
+ROW_TRIGGER = 'newt_trigger_notify_object_state_changed'
+
+row_trigger_sql = """
+create or replace function newt_notify_object_state_changed() returns trigger
 as $$
 begin
   perform pg_notify('%s', NEW.tid::text);
@@ -29,21 +35,233 @@ begin
 end;
 $$ language plpgsql;
 
-create trigger newt_trigger_notify_object_state_changed
+create trigger %s
   after insert or update on object_state for each row
   execute procedure newt_notify_object_state_changed();
-""" % NOTIFY
+""" % (NOTIFY, ROW_TRIGGER)
+
+# Statement-level notification triggers send a single notification
+# per statement, and thus per committed transaction, rather than one
+# per object.  Transition tables can only be used with single-event
+# triggers, so there's a trigger for each of inserts and updates.
+# Notifications with the same payload in a transaction are delivered
+# once.
+STATEMENT_TRIGGERS = ('newt_trigger_notify_object_state_inserted',
+                      'newt_trigger_notify_object_state_updated')
+
+trigger_sql = """
+create or replace function newt_notify_object_state_statement()
+returns trigger
+as $$
+declare
+  max_tid bigint;
+begin
+  select max(tid) into max_tid from newt_changed_states;
+  if max_tid is not null then
+    perform pg_notify('%(notify)s', max_tid::text);
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists %(row_trigger)s on object_state;
+
+create trigger %(inserted)s
+  after insert on object_state
+  referencing new table as newt_changed_states
+  for each statement
+  execute procedure newt_notify_object_state_statement();
+
+create trigger %(updated)s
+  after update on object_state
+  referencing new table as newt_changed_states
+  for each statement
+  execute procedure newt_notify_object_state_statement();
+""" % dict(notify=NOTIFY, row_trigger=ROW_TRIGGER,
+           inserted=STATEMENT_TRIGGERS[0], updated=STATEMENT_TRIGGERS[1])
+
+# Deletion log, from which tombstone records are returned by updates.
+# Objects deleted, typically by packing, are logged without a tid.
+# They get the tid of the next transaction committed, so followers
+# see them after the data they've already processed.
+DELETION_LOG = 'newt_follow_deleted'
+DELETION_TRIGGERS = ('newt_trigger_log_deleted',
+                     'newt_trigger_stamp_deleted',
+                     'newt_trigger_stamp_deleted_updated')
+
+deletion_log_sql = """
+create table if not exists %(log)s (
+  zoid bigint primary key,
+  tid bigint);
+create index if not exists %(log)s_tid_idx on %(log)s (tid);
+
+create or replace function newt_log_deleted() returns trigger
+as $$
+begin
+  if to_regclass('pg_temp.temp_store') is null then
+    insert into %(log)s (zoid)
+    select zoid from newt_deleted_states
+    on conflict (zoid) do update set tid = null;
+  else
+    -- History-free storages delete the rows of objects they store
+    -- before reinserting them.
+    insert into %(log)s (zoid)
+    select zoid from newt_deleted_states
+    where zoid not in (select zoid from temp_store)
+    on conflict (zoid) do update set tid = null;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create or replace function newt_stamp_deleted() returns trigger
+as $$
+begin
+  update %(log)s set tid = (select max(tid) from newt_stored_states)
+  where tid is null;
+  return null;
+end;
+$$ language plpgsql;
+
+-- Updates only stamp deletions when they write records for new
+-- transactions, rather than, for example, when packing updates
+-- prev_tid:
+create or replace function newt_stamp_deleted_updated() returns trigger
+as $$
+declare
+  stored_tid bigint;
+begin
+  select max(tid) into stored_tid from newt_stored_states;
+  if stored_tid > (select max(tid) from newt_replaced_states) then
+    update %(log)s set tid = stored_tid where tid is null;
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists %(log_trigger)s on TABLE;
+create trigger %(log_trigger)s
+  after delete on TABLE
+  referencing old table as newt_deleted_states
+  for each statement
+  execute procedure newt_log_deleted();
+
+-- Objects may be written with inserts or, with "insert ... on
+-- conflict do update", updates:
+drop trigger if exists %(stamp_trigger)s on object_state;
+create trigger %(stamp_trigger)s
+  after insert on object_state
+  referencing new table as newt_stored_states
+  for each statement
+  execute procedure newt_stamp_deleted();
+
+drop trigger if exists %(stamp_updated_trigger)s on object_state;
+create trigger %(stamp_updated_trigger)s
+  after update on object_state
+  referencing old table as newt_replaced_states
+              new table as newt_stored_states
+  for each statement
+  execute procedure newt_stamp_deleted_updated();
+""" % dict(log=DELETION_LOG, log_trigger=DELETION_TRIGGERS[0],
+           stamp_trigger=DELETION_TRIGGERS[1],
+           stamp_updated_trigger=DELETION_TRIGGERS[2])
+
+def install_deletion_log(cursor, keep_history=None):
+    """Install the deletion log used for tombstone records
+
+    Deleted objects are recorded in the ``newt_follow_deleted`` table
+    by triggers, for ``updates`` iterators created with the
+    ``tombstones`` option.  Objects deleted from ``object_state`` in
+    history-free databases, or from ``current_object`` in
+    history-preserving databases, are logged.  This requires
+    PostgreSQL 10 or later.
+
+    Return a boolean indicating whether the log was installed.
+    """
+    if all(trigger_exists(cursor, name) for name in DELETION_TRIGGERS):
+        return False
+    keep_history = determine_keep_history(cursor, keep_history)
+    cursor.execute(deletion_log_sql.replace(
+        'TABLE', 'current_object' if keep_history else 'object_state'))
+    return True
+
+def prune_deletion_log(connection, tid):
+    """Remove deletion log records for transactions up to ``tid``
+
+    Tombstone records are kept until they're pruned.  Pass the lowest
+    transaction id processed by all followers that use tombstones,
+    for example, as returned by ``get_progress_tid``.
+
+    The ``connection`` argument must be a PostgreSQL connection string
+    or connection.
+
+    Return the number of records removed.
+    """
+    if isinstance(connection, str):
+        with closing(pg_connection(connection)) as conn:
+            result = prune_deletion_log(conn, tid)
+            conn.commit()
+            return result
+
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("delete from %s where tid <= %%s" % DELETION_LOG,
+                       (tid, ))
+        return cursor.rowcount
+
+def install_trigger(cursor):
+    """Install the trigger that notifies listeners of committed changes
+
+    With PostgreSQL 10 and later, statement-level triggers are
+    installed, replacing the row-level trigger installed by earlier
+    versions of newt.db, which sent a notification for each object
+    changed.  With earlier PostgreSQL versions, the row-level trigger
+    is installed if necessary.
+
+    ``listen`` calls this function, so existing databases are
+    migrated when the updater or other follow clients start.
+
+    Return a boolean indicating whether the trigger was changed.
+    """
+    cursor.execute("select current_setting('server_version_num')::int")
+    [[version]] = cursor.fetchall()
+    if version < 100000:
+        if trigger_exists(cursor, ROW_TRIGGER):
+            return False
+        cursor.execute(row_trigger_sql)
+    else:
+        if trigger_exists(cursor, STATEMENT_TRIGGERS[0]):
+            return False
+        cursor.execute(trigger_sql)
+    return True
 
 class Updates:
 
     _query = """
     select s.tid, s.zoid, state from object_state s
-    where s.tid > %s UPPER order by s.tid
+    where s.tid > %(tid)s UPPER
+    TOMBSTONES
+    order by tid
     """
 
+    _tombstones_query = """
+    union all
+    select s.tid, s.zoid, null::bytea from %s s
+    where s.tid > %%(tid)s UPPER
+    """ % DELETION_LOG
+
+    # Partitioned iterators only return transactions committed when a
+    # batch starts, so they can advance past all of them when caught
+    # up, including those without records for the partition.
+    # Transactions are committed in tid order, so this includes all
+    # transactions up to the maximum tid.
+    _max_tid_query = "select max(tid) from object_state"
+
     def __init__(self, dsn, start_tid =-1, end_tid=None,
                  batch_limit=100000, internal_batch_size=100,
-                 poll_timeout=300, keep_history=None):
+                 poll_timeout=300, keep_history=None,
+                 partition=0, partitions=1, tombstones=False):
+        if not 0 <= partition < partitions:
+            raise ValueError("Invalid partition", partition, partitions)
         self.dsn = dsn
         self.tid = start_tid
         self.end_tid = end_tid
@@ -51,13 +269,32 @@ class Updates:
         self.internal_batch_size = internal_batch_size
         self.poll_timeout = poll_timeout
         self.keep_history = keep_history
+        self.partition = partition
+        self.partitions = partitions
+        self.tombstones = tombstones
+
+    def _max_tid(self, max_tid):
+        # Return the tid to advance to when caught up, given the
+        # maximum tid when a batch started
+        if max_tid is None:
+            return self.tid
+        if self.end_tid is not None:
+            max_tid = min(max_tid, self.end_tid)
+        return max(max_tid, self.tid)
 
     def _batch(self, conn):
         tid = self.tid
+        args = dict(tid=tid)
         try:
+            if self.partitions > 1:
+                with closing(conn.cursor()) as cursor:
+                    cursor.execute(self._max_tid_query)
+                    [[max_tid]] = cursor.fetchall()
+                args['max_tid'] = max_tid = self._max_tid(max_tid)
+
             updates = conn.cursor('object_state_updates')
             updates.itersize = self.internal_batch_size
-            updates.execute(self._query, (tid, ))
+            updates.execute(self._query, args)
 
             n = 0
             for row in updates:
@@ -67,6 +304,9 @@ class Updates:
                     tid = self.tid = row[0]
                 yield row
                 n += 1
+            else:
+                if self.partitions > 1:
+                    self.tid = max_tid # caught up
         finally:
             try:
                 conn.rollback()
@@ -74,28 +314,47 @@ class Updates:
             except Exception:
                 pass
 
+    def _prepare(self, cursor):
+        # Adjust the query for the database, end tid, partition and
+        # tombstones.  Callers must commit.
+        keep_history = determine_keep_history(cursor, self.keep_history)
+
+        if self.tombstones:
+            install_deletion_log(cursor, keep_history)
+        self._query = self._query.replace(
+            'TOMBSTONES', self._tombstones_query if self.tombstones else '')
+
+        if keep_history:
+            self._query = self._query.replace(
+                'object_state s',
+                'object_state s natural join current_object',
+                )
+
+        conditions = ''
+        if self.end_tid is not None:
+            conditions += cursor.mogrify(
+                "and s.tid <= %s ", (self.end_tid, )).decode('ascii')
+        if self.partitions > 1:
+            conditions += cursor.mogrify(
+                "and mod(s.zoid, %s) = %s ",
+                (self.partitions, self.partition)).decode('ascii')
+            conditions += "and s.tid <= %(max_tid)s "
+        self._query = self._query.replace('UPPER', conditions)
+
     def __iter__(self):
         with closing(pg_connection(self.dsn)) as conn:
             with closing(conn.cursor()) as cursor:
-                keep_history = determine_keep_history(cursor, self.keep_history)
-
-                if keep_history:
-                    self._query = self._query.replace(
-                        'object_state s',
-                        'object_state s natural join current_object',
-                        )
-
-                self._query = self._query.replace(
-                    'UPPER',
-                    '' if self.end_tid is None else
-                    cursor.mogrify("and s.tid <= %s",
-                                   (self.end_tid, )).decode('ascii'),
-                    )
+                self._prepare(cursor)
+                conn.commit()
 
                 # Catch up:
                 while True:
+                    tid = self.tid
                     batch = non_empty_generator(self._batch(conn))
                     if batch is None:
+                        if self.tid != tid:
+                            # Partition progress, without records
+                            yield iter(())
                         break # caught up
                     else:
                         yield batch
@@ -103,9 +362,12 @@ class Updates:
                 if self.end_tid is None:
                     for payload in listen(self.dsn, True,
                                           poll_timeout=self.poll_timeout):
+                        tid = self.tid
                         batch = non_empty_generator(self._batch(conn))
                         if batch is not None:
                             yield batch
+                        elif self.tid != tid:
+                            yield iter(())
 
 def listen(dsn, timeout_on_start=False, poll_timeout=300):
     """Listen for newt database updates.
@@ -139,9 +401,7 @@ def listen(dsn, timeout_on_start=False, poll_timeout=300):
     with closing(pg_connection(dsn)) as conn:
         conn.autocommit = True
         with closing(conn.cursor()) as cursor:
-            if not trigger_exists(cursor,
-                                  'newt_trigger_notify_object_state_changed'):
-                cursor.execute(trigger_sql)
+            install_trigger(cursor)
 
             cursor.execute("LISTEN " + NOTIFY)
 
@@ -165,7 +425,7 @@ def listen(dsn, timeout_on_start=False, poll_timeout=300):
 
 def updates(conn, start_tid=-1, end_tid=None,
             batch_limit=100000, internal_batch_size=100,
-            poll_timeout=300):
+            poll_timeout=300, partition=0, partitions=1, tombstones=False):
     """Create a data-update iterator
 
     The iterator returns an iterator of batchs, where each batch is an
@@ -213,10 +473,332 @@ def updates(conn, start_tid=-1, end_tid=None,
       for changes.  Note that a trigger is created and used to notify the
       iterator of changes, so changes ne detected quickly. The poll
       timeout is just a backstop.
+
+    partition, partitions
+      Return only records for one of ``partitions`` disjoint sets of
+      objects, those whose object ids modulo ``partitions`` are
+      ``partition``, so that multiple followers can process changes in
+      parallel.  Each follower should save its progress separately,
+      using an id returned by ``partition_id``.  See
+      ``get_partitioned_progress_tid``.
+
+      A partition may not have records for many transactions, so
+      partitioned followers should save the iterator's ``tid``
+      attribute, which is the last transaction id processed, after
+      processing each batch.  When it has caught up, a partitioned
+      iterator returns an empty batch if there were transactions
+      without records for its partition, so that its progress can
+      be saved.
+
+    tombstones
+      Also return records for deleted objects, typically deleted by
+      packing, with ``None`` data.  Deletions are recorded in a log
+      (see ``install_deletion_log``, which is called if necessary),
+      and get the transaction id of the first transaction committed
+      after them.  Old log records should be removed with
+      ``prune_deletion_log``.
     """
 
     return Updates(conn, start_tid, end_tid, batch_limit, internal_batch_size,
-                   poll_timeout)
+                   poll_timeout, partition=partition, partitions=partitions,
+                   tombstones=tombstones)
+
+class _PgOutput(object):
+    # Decoder for messages of the pgoutput logical decoding plugin
+    # (protocol version 1), with column values in text format.
+
+    def __init__(self):
+        self.relations = {} # relid -> (name, column names)
+
+    def decode(self, data):
+        """Decode a message
+
+        Return ``None`` for messages other than inserts, updates, and
+        deletes, and otherwise an action (``'I'``, ``'U'``, or ``'D'``),
+        table name and a dictionary of column values, which are
+        strings, ``None`` for nulls, or ``self.UNCHANGED`` for unchanged
+        toasted values.
+        """
+        data = bytes(data)
+        kind = data[:1]
+        if kind == b'R':
+            self._relation(data)
+        elif kind in (b'I', b'U', b'D'):
+            [relid] = struct.unpack_from('>I', data, 1)
+            pos = 5
+            if kind == b'U' and data[pos:pos+1] in (b'K', b'O'):
+                _, pos = self._tuple(data, pos + 1) # old tuple
+            if kind == b'D':
+                assert data[pos:pos+1] in (b'K', b'O')
+            else:
+                assert data[pos:pos+1] == b'N'
+            values, _ = self._tuple(data, pos + 1)
+            name, columns = self.relations[relid]
+            return kind.decode('ascii'), name, dict(zip(columns, values))
+
+    UNCHANGED = object()
+
+    def _relation(self, data):
+        [relid] = struct.unpack_from('>I', data, 1)
+        pos = 5
+        _, pos = self._string(data, pos) # namespace
+        name, pos = self._string(data, pos)
+        [ncols] = struct.unpack_from('>H', data, pos + 1)
+        pos += 3
+        columns = []
+        for i in range(ncols):
+            column, pos = self._string(data, pos + 1) # skip flags
+            columns.append(column)
+            pos += 8 # type oid and modifier
+        self.relations[relid] = name, columns
+
+    def _string(self, data, pos):
+        end = data.index(b'\0', pos)
+        return data[pos:end].decode('utf-8'), end + 1
+
+    def _tuple(self, data, pos):
+        [ncols] = struct.unpack_from('>H', data, pos)
+        pos += 2
+        values = []
+        for i in range(ncols):
+            kind = data[pos:pos+1]
+            pos += 1
+            if kind == b'n':
+                values.append(None)
+            elif kind == b'u':
+                values.append(self.UNCHANGED)
+            else:
+                [size] = struct.unpack_from('>I', data, pos)
+                pos += 4
+                values.append(data[pos:pos+size].decode('utf-8'))
+                pos += size
+        return values, pos
+
+def _bytea(text):
+    # Convert the hex text format of a bytea value to bytes
+    assert text.startswith('\\x')
+    return bytes(bytearray.fromhex(text[2:]))
+
+def create_logical_slot(cursor, slot_name='newt_follow', keep_history=None):
+    """Create a logical replication slot for ``logical_updates``
+
+    A publication for the RelStorage tables is created, with the
+    same name as the slot, if it doesn't exist, and a slot using the
+    ``pgoutput`` plugin is created, if it doesn't exist.  The slot
+    retains changes from the time it's created until they're
+    consumed.
+
+    The cursor must be for a connection in autocommit mode.  The
+    database server must be configured with ``wal_level`` set to
+    ``logical``.
+
+    Return a boolean indicating whether the slot was created.
+    """
+    from psycopg2 import sql
+    keep_history = determine_keep_history(cursor, keep_history)
+    cursor.execute("select from pg_publication where pubname = %s",
+                   (slot_name, ))
+    if not list(cursor):
+        cursor.execute(
+            sql.SQL("create publication {} for table " +
+                    ('object_state, current_object' if keep_history else
+                     'object_state')
+                    ).format(sql.Identifier(slot_name)))
+
+    cursor.execute("select from pg_replication_slots where slot_name = %s",
+                   (slot_name, ))
+    if list(cursor):
+        return False
+    cursor.execute(
+        "select pg_create_logical_replication_slot(%s, 'pgoutput')",
+        (slot_name, ))
+    return True
+
+def drop_logical_slot(connection, slot_name='newt_follow'):
+    """Drop a logical replication slot and its publication
+
+    The ``connection`` argument must be a PostgreSQL connection string
+    or connection.
+
+    Slots that aren't used any more should be dropped, because the
+    database server retains changes until a slot's consumer has seen
+    them.
+    """
+    if isinstance(connection, str):
+        with closing(pg_connection(connection)) as conn:
+            conn.autocommit = True
+            return drop_logical_slot(conn, slot_name)
+
+    from psycopg2 import sql
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(
+            "select pg_drop_replication_slot(slot_name)"
+            " from pg_replication_slots where slot_name = %s",
+            (slot_name, ))
+        cursor.execute(sql.SQL("drop publication if exists {}").format(
+            sql.Identifier(slot_name)))
+
+class LogicalUpdates(object):
+
+    _peek_sql = """
+    select lsn, data
+    from pg_logical_slot_peek_binary_changes(
+      %s, NULL, %s, 'proto_version', '1', 'publication_names', %s)
+    """
+
+    def __init__(self, dsn, slot_name='newt_follow', start_tid=-1,
+                 batch_limit=100000, poll_timeout=300, keep_history=None):
+        self.dsn = dsn
+        self.slot_name = slot_name
+        self.start_tid = self.tid = start_tid
+        self.batch_limit = batch_limit
+        self.poll_timeout = poll_timeout
+        self.keep_history = keep_history
+
+    def _batch(self, cursor, keep_history):
+        # Return records for the next batch of changes and the LSN to
+        # advance the slot to after they've been processed.
+        cursor.execute(self._peek_sql, (self.slot_name, self.batch_limit,
+                                        self.slot_name))
+        decoder = _PgOutput()
+        records = []
+        unchanged = []
+        deleted = {} # ordered set
+        skipped = False # Whether the transaction is at or before start_tid
+        lsn = None
+        for lsn, data in cursor.fetchall():
+            change = decoder.decode(data)
+            if change is None:
+                if bytes(data[:1]) == b'C':
+                    # Deleted objects get the tid of the transaction
+                    # that deleted them, if it stored any states
+                    # (which isn't the case for packs), or of the last
+                    # transaction seen.
+                    if not skipped:
+                        records.extend((self.tid, zoid, None)
+                                       for zoid in deleted)
+                    deleted.clear()
+                    skipped = False
+                continue
+
+            action, table, values = change
+            zoid = int(values['zoid'])
+            if action == 'D':
+                if table == ('current_object' if keep_history
+                             else 'object_state'):
+                    deleted[zoid] = None
+                continue
+
+            if keep_history and action == 'U' and table == 'object_state':
+                # History-preserving object_state rows are only
+                # updated by packing, which sets prev_tid of old
+                # revisions.  They aren't new data.
+                continue
+
+            deleted.pop(zoid, None) # Rewritten, not deleted
+            if table == 'object_state':
+                tid = int(values['tid'])
+                if tid <= self.start_tid:
+                    skipped = True
+                    continue
+                self.tid = tid
+                state = values['state']
+                if state is decoder.UNCHANGED:
+                    unchanged.append(len(records))
+                    records.append((tid, zoid, None))
+                else:
+                    records.append((tid, zoid,
+                                    None if state is None else _bytea(state)))
+
+        if unchanged:
+            # Load unchanged toasted states, which aren't included in
+            # logical decoding output.  History-preserving storages
+            # have many revisions per object, so look them up by tid
+            # too.
+            cursor.execute(
+                "select zoid, tid, state from object_state"
+                " join unnest(%s::bigint[], %s::bigint[]) as r(zoid, tid)"
+                "   using (zoid, tid)",
+                ([records[i][1] for i in unchanged],
+                 [records[i][0] for i in unchanged]))
+            states = dict(((zoid, tid), state)
+                          for zoid, tid, state in cursor.fetchall())
+            for i in unchanged:
+                tid, zoid, _ = records[i]
+                state = states.get((zoid, tid))
+                # Revisions that are gone have been replaced or
+                # deleted by later changes, which are still to come.
+                records[i] = (
+                    None if state is None else (tid, zoid, bytes(state)))
+            records = [r for r in records if r is not None]
+
+        return records, lsn
+
+    def __iter__(self):
+        with closing(pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                keep_history = determine_keep_history(cursor,
+                                                      self.keep_history)
+                cursor.execute("set bytea_output = 'hex'")
+                create_logical_slot(cursor, self.slot_name, keep_history)
+
+                notifications = None
+                try:
+                    while True:
+                        records, lsn = self._batch(cursor, keep_history)
+                        if lsn is not None:
+                            if records:
+                                yield iter(records)
+                            # The batch has been processed, so consume it:
+                            cursor.execute(
+                                "select from pg_replication_slot_advance("
+                                "%s, %s)", (self.slot_name, lsn))
+                            continue
+
+                        if notifications is None:
+                            notifications = listen(
+                                self.dsn, True,
+                                poll_timeout=self.poll_timeout)
+                        try:
+                            next(notifications)
+                        except StopIteration:
+                            return
+                finally:
+                    if notifications is not None:
+                        notifications.close()
+
+def logical_updates(dsn, slot_name='newt_follow', start_tid=-1,
+                    batch_limit=100000, poll_timeout=300):
+    """Create a data-update iterator that reads a logical replication slot
+
+    This is an alternative to ``updates`` that gets changes from a
+    PostgreSQL `logical replication slot
+    <https://www.postgresql.org/docs/current/static/logicaldecoding.html>`_,
+    using the built-in ``pgoutput`` plugin, rather than by querying
+    the ``object_state`` table.  The slot and a publication of the
+    RelStorage tables are created if necessary (see
+    ``create_logical_slot``), which requires the server's
+    ``wal_level`` to be ``logical``.
+
+    The iterator returns batches, like those returned by ``updates``,
+    except that deleted objects are included, with ``None`` data.
+    Changes made by transactions with ids less than or equal to
+    ``start_tid`` are skipped.  Objects deleted by packing have the
+    transaction id of the last transaction seen, starting with
+    ``start_tid``.
+
+    A batch's changes are consumed from the slot when the next batch
+    is requested, so an iterator started after a failure resumes with
+    the first batch that wasn't fully processed.  The iterator waits
+    for new changes indefinitely, waking up when transactions are
+    committed, or after ``poll_timeout`` seconds.
+
+    ``batch_limit`` is a soft limit on the number of changes
+    decoded for a batch.  Batches end at transaction boundaries.
+    """
+    return LogicalUpdates(dsn, slot_name, start_tid, batch_limit,
+                          poll_timeout)
 
 def _ex_progress(conn, cursor, sql, *args):
     try:
@@ -295,6 +877,39 @@ def set_progress_tid(connection, id, tid):
             "insert into %s(id, tid) values(%%s, %%s)" % PROGRESS_TABLE,
             (id, tid))
 
+def partition_id(id, partition, partitions):
+    """Return the progress id for a partition of a follow client
+
+    Followers that process partitions of updates (see ``updates``)
+    should save their progress with ids returned by this function.
+    """
+    return '%s/%s/%s' % (id, partition, partitions)
+
+def get_partitioned_progress_tid(connection, id, partitions):
+    """Get the progress common to all partitions of a follow client
+
+    Return the lowest transaction id saved for the partitions of the
+    client with the given ``id`` (see ``partition_id``), which is the
+    last transaction processed by all of the partitions, or -1 if any
+    of the partitions hasn't saved progress.
+
+    The ``connection`` argument must be a PostgreSQL connection string
+    or connection.
+    """
+    if isinstance(connection, str):
+        with closing(pg_connection(connection)) as conn:
+            return get_partitioned_progress_tid(conn, id, partitions)
+
+    with closing(connection.cursor()) as cursor:
+        _ex_progress(
+            connection, cursor,
+            "select count(*), min(tid) from %s where id = any(%%s)"
+            % PROGRESS_TABLE,
+            [partition_id(id, partition, partitions)
+             for partition in range(partitions)])
+        [[count, tid]] = cursor.fetchall()
+        return tid if count == partitions else -1
+
 def stop_updates(conn):
     """Notify all ``updates`` iterators that they should stop.
 
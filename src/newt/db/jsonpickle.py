@@ -5,15 +5,18 @@ indexing, querying and reporting in external systems like Postgres and
 Elasticsearch.
 """
 import binascii
-from six import BytesIO, PY3
+from six import PY3
 from six.moves import copyreg
 import _codecs
+import codecs
 import datetime
 import json
 import logging
+from pickle import decode_long
 import pickletools
 import re
-from struct import unpack
+from struct import Struct, unpack
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -198,6 +201,244 @@ def default(ob):
             except Exception:
                 return {'::': 'hex', 'hex': binascii.b2a_hex(ob)}
 
+def encode(ob, **json_args):
+    """Encode decoded pickle data using the standard library json module
+
+    This is the default encoder.  Newt-specific values are converted
+    by the ``json`` module calling ``default`` for each of them.
+    """
+    return json.dumps(ob, default=default, **json_args)
+
+# Encoders are called with decoded pickle data and keyword arguments
+# for ``json.dumps`` (like ``sort_keys`` or ``indent``) and return a
+# JSON string. Alternative encoders must produce the same JSON data as
+# ``encode``.  An easy way to write one is to convert data with
+# ``jsonable`` and pass the result to a faster JSON library.
+
+def encode_tree(ob, **json_args):
+    """Encode decoded pickle data by converting it with ``jsonable``
+
+    The ``json`` module then encodes the result without calling back
+    into Python.  With the standard library ``json`` module, this is
+    about as fast as ``encode``.  It's mainly a model for encoders
+    that use faster JSON libraries.
+    """
+    return json.dumps(jsonable(ob), **json_args)
+
+scalar_types = frozenset((type(u''), int, type(1<<99), float, bool, type(None)))
+
+def jsonable(ob):
+    """Convert decoded pickle data to data that can be encoded as JSON
+
+    The data returned contain only dictionaries, lists, strings,
+    numbers, booleans and None, and encode to the same JSON as
+    ``encode`` produces.
+    """
+    t = type(ob)
+    if t in scalar_types:
+        return ob
+    convert = jsonable_converters.get(t)
+    if convert is None:
+        return jsonable_other(ob)
+    return convert(ob)
+
+def jsonable_list(ob):
+    return [v if type(v) in scalar_types else jsonable(v) for v in ob]
+
+def jsonable_dict(ob):
+    return {k: v if type(v) in scalar_types else jsonable(v)
+            for k, v in ob.items()}
+
+def jsonable_bytes(ob):
+    try:
+        return ob.decode('ascii')
+    except Exception:
+        return jsonable_Bytes(Bytes(ob))
+
+def jsonable_Bytes(ob):
+    return {'::': 'hex', 'hex': binascii.b2a_hex(ob.data).decode('ascii')}
+
+def jsonable_Persistent(ob):
+    return {'::': 'persistent', 'id': jsonable(ob.id), '::=>': ob.zoid}
+
+def jsonable_Global(ob):
+    return {'::': 'global', 'name': ob.name}
+
+def jsonable_Instance(ob):
+    state = ob.state
+    if isinstance(state, Put):
+        if state.got:
+            # Rare, so leave it to json_reduce.
+            return jsonable_other(ob)
+        state = state.v
+
+    if isinstance(state, dict):
+        result = jsonable_dict(state)
+    else:
+        result = dict(state=jsonable(state)) if state else {}
+
+    result['::'] = ob.class_name
+    if ob.args:
+        result['::()'] = jsonable(ob.args)
+    if ob.id is not None:
+        result['::id'] = ob.id
+
+    return result
+
+def jsonable_Get(ob):
+    if ob.unpickler.cyclic:
+        return {'::->': ob.id}
+    else:
+        return jsonable(ob.v)
+
+def jsonable_Put(ob):
+    v = ob.v
+    if ob.got and ob.unpickler.cyclic:
+        if isinstance(v, Instance):
+            v.id = ob.id
+        elif isinstance(v, dict):
+            v = jsonable_dict(v)
+            v['::id'] = ob.id
+            return v
+        else:
+            return {'::': 'shared', '::id': ob.id, 'value': jsonable(v)}
+    return jsonable(v)
+
+def jsonable_other(ob):
+    # Subclasses of basic types and anything we don't know about
+    if isinstance(ob, dict):
+        return jsonable_dict(ob)
+    if isinstance(ob, (list, tuple)):
+        return jsonable_list(ob)
+    if isinstance(ob, scalar_types_tuple):
+        return ob
+    return jsonable(default(ob))
+
+scalar_types_tuple = tuple(scalar_types)
+
+jsonable_converters = {
+    list: jsonable_list,
+    tuple: jsonable_list,
+    dict: jsonable_dict,
+    bytes: jsonable_bytes,
+    Bytes: jsonable_Bytes,
+    Persistent: jsonable_Persistent,
+    Global: jsonable_Global,
+    Instance: jsonable_Instance,
+    Get: jsonable_Get,
+    Put: jsonable_Put,
+    }
+
+# Opcode argument readers.
+#
+# Each reader takes the pickle data and the position just past the
+# opcode and returns the argument and the position just past the
+# argument.  The values returned are the same as the ones computed by
+# the corresponding readers in ``pickletools``, which is what
+# ``JsonUnpickler`` used to use.
+
+def _reader(struct_format):
+    s = Struct(struct_format)
+    size = s.size
+    unpack_from = s.unpack_from
+
+    def read(data, pos):
+        if len(data) < pos + size:
+            raise ValueError("not enough data in stream")
+        return unpack_from(data, pos)[0], pos + size
+
+    return read
+
+read_uint1 = _reader('<B')
+read_uint2 = _reader('<H')
+read_int4 = _reader('<i')
+read_uint4 = _reader('<I')
+read_uint8 = _reader('<Q')
+read_float8 = _reader('>d')
+
+def read_line(data, pos):
+    end = data.find(b'\n', pos)
+    if end < 0:
+        raise ValueError("no newline found when trying to read stringnl")
+    return data[pos:end], end + 1
+
+def read_decimalnl_short(data, pos):
+    s, pos = read_line(data, pos)
+    # There's a hack for True and False here.
+    if s == b"00":
+        return False, pos
+    elif s == b"01":
+        return True, pos
+    return int(s), pos
+
+def read_decimalnl_long(data, pos):
+    s, pos = read_line(data, pos)
+    if s[-1:] == b'L':
+        s = s[:-1]
+    return int(s), pos
+
+def read_floatnl(data, pos):
+    s, pos = read_line(data, pos)
+    return float(s), pos
+
+def read_stringnl(data, pos):
+    s, pos = read_line(data, pos)
+    for q in (b'"', b"'"):
+        if s.startswith(q):
+            if not s.endswith(q):
+                raise ValueError("strinq quote %r not found at both "
+                                 "ends of %r" % (q, s))
+            s = s[1:-1]
+            break
+    else:
+        raise ValueError("no string quotes around %r" % s)
+    return codecs.escape_decode(s)[0].decode("ascii"), pos
+
+def read_stringnl_noescape(data, pos):
+    s, pos = read_line(data, pos)
+    return codecs.escape_decode(s)[0].decode("ascii"), pos
+
+def read_stringnl_noescape_pair(data, pos):
+    module, pos = read_stringnl_noescape(data, pos)
+    name, pos = read_stringnl_noescape(data, pos)
+    return "%s %s" % (module, name), pos
+
+def read_unicodestringnl(data, pos):
+    s, pos = read_line(data, pos)
+    return s.decode('raw-unicode-escape'), pos
+
+def _counted_reader(read_count, convert, name):
+
+    def read(data, pos):
+        n, pos = read_count(data, pos)
+        if n < 0:
+            raise ValueError("%s byte count < 0: %d" % (name, n))
+        end = pos + n
+        if len(data) < end:
+            raise ValueError("expected %d bytes in a %s, but only %d remain"
+                             % (n, name, len(data) - pos))
+        return convert(data[pos:end]), end
+
+    return read
+
+def _unicode(data):
+    return data.decode('utf-8', 'surrogatepass')
+
+def _latin1(data):
+    return data.decode('latin-1')
+
+read_string1 = _counted_reader(read_uint1, _latin1, 'string1')
+read_string4 = _counted_reader(read_int4, _latin1, 'string4')
+read_bytes1 = _counted_reader(read_uint1, bytes, 'bytes1')
+read_bytes4 = _counted_reader(read_uint4, bytes, 'bytes4')
+read_bytes8 = _counted_reader(read_uint8, bytes, 'bytes8')
+read_bytearray8 = _counted_reader(read_uint8, bytearray, 'bytearray8')
+read_unicodestring1 = _counted_reader(read_uint1, _unicode, 'unicodestring1')
+read_unicodestring4 = _counted_reader(read_uint4, _unicode, 'unicodestring4')
+read_unicodestring8 = _counted_reader(read_uint8, _unicode, 'unicodestring8')
+read_long1 = _counted_reader(read_uint1, decode_long, 'long1')
+read_long4 = _counted_reader(read_int4, decode_long, 'long4')
+
 class JsonUnpickler:
     """Unpickler that returns JSON
 
@@ -211,8 +452,11 @@ class JsonUnpickler:
     """
 
     cyclic = False
+    encoder = staticmethod(encode)
 
-    def __init__(self, pickle):
+    def __init__(self, pickle, encoder=None):
+        if encoder is not None:
+            self.encoder = encoder
         self.stack = []
         self.append = self.stack.append
         self.marks = []
@@ -220,26 +464,67 @@ class JsonUnpickler:
         self.set_pickle(pickle)
 
     def set_pickle(self, pickle):
+        if not isinstance(pickle, bytes):
+            pickle = bytes(pickle) # e.g. a memoryview from a bytea column
         self.pickle = pickle
-        self.ops = pickletools.genops(BytesIO(pickle))
+        self.pos = 0
+
+    def _decode(self):
+        """Decode the pickle at the current position
+
+        Opcodes are read directly from the pickle data and dispatched
+        through a table computed when the class is defined.  The
+        position is left just past the ``STOP`` opcode and the
+        decoded (but not yet JSON-encoded) value is returned.
+        """
+        data = self.pickle
+        pos = self.pos
+        dispatch = self.dispatch
+        while True:
+            try:
+                read, handle = dispatch[data[pos]]
+            except IndexError:
+                raise ValueError("pickle exhausted before seeing STOP")
+            pos += 1
+            if read is not None:
+                arg, pos = read(data, pos)
+                handle(self, arg)
+            elif handle is not None:
+                handle(self, None)
+            else: # STOP
+                self.pos = pos
+                return self.stack[-1]
+
+    def load_class(self):
+        """Load the class part of a ZODB data record
+
+        A class name and class arguments (typically None) are returned
+        without doing any JSON conversion, leaving the unpickler
+        positioned at the start of the state pickle, which can then be
+        converted with ``load``::
+
+          >>> unpickler = JsonUnpickler(apickle)
+          >>> class_name, args = unpickler.load_class()
+          >>> state_json = unpickler.load()
+        """
+        klass = self._decode()
+        args = None
+        if isinstance(klass, Get):
+            klass = klass.v
+        if isinstance(klass, (tuple, list)):
+            klass, args = klass
+            if isinstance(klass, Get):
+                klass = klass.v
+        if isinstance(klass, Global):
+            return klass.name, args
+        elif isinstance(klass, (tuple, list)):
+            return '.'.join(klass), args
+        raise ValueError("Invalid class pickle", klass)
 
     def load(self, **json_args):
-        for op, arg, pos in self.ops:
-            # print(op.name, arg, pos, self.stack) # uncomment to trace
-            if op.name == 'STOP':
-                self.pos = pos + 1
-                self.set_pickle(self.pickle[self.pos:])
-                try:
-                    return json.dumps(self.stack[-1],
-                                      default=default,
-                                      **json_args)
-                except ValueError:
-                    self.cyclic = True
-                    return json.dumps(self.stack[-1],
-                                      default=default,
-                                      **json_args)
-
-            getattr(self, op.name)(arg)
+        # Note that cycles are detected while decoding, so we know
+        # whether to use cyclic mode before encoding.
+        return self.encoder(self._decode(), **json_args)
 
     def push_arg(self, arg):
         self.append(arg)
@@ -261,6 +546,14 @@ class JsonUnpickler:
         self.append(v)
     SHORT_BINBYTES = BINBYTES8 = BINBYTES
 
+    def BYTEARRAY8(self, v):
+        self.BINBYTES(bytes(v))
+
+    def NEXT_BUFFER(self, _):
+        raise ValueError("Out-of-band buffers aren't supported")
+
+    def READONLY_BUFFER(self, _): pass
+
     UNICODE = BINUNICODE = SHORT_BINUNICODE = BINUNICODE8 = push_arg
     FLOAT = BINFLOAT = push_arg
     STOP = None # for checking completeness
@@ -273,9 +566,22 @@ class JsonUnpickler:
     def  EMPTY_DICT(self, _): self.push_arg( {} )
     def   EMPTY_SET(self, _): self.push_arg( [] )
 
+    def target(self):
+        """Return the object on top of the stack that's about to be updated.
+
+        Objects are updated after the data they're updated with have
+        been unpickled.  If the object was already fetched from the
+        memo, then it's referenced from the data it's being updated
+        with (or their contents), so the data are cyclic.
+        """
+        target = self.stack[-1]
+        if isinstance(target, Put) and target.got:
+            self.cyclic = True
+        return target
+
     def APPEND(self, _):
         ob = self.stack.pop()
-        self.stack[-1].append(ob)
+        self.target().append(ob)
 
     def pop(self, count):
         result = self.stack[-count:]
@@ -290,7 +596,7 @@ class JsonUnpickler:
 
     def APPENDS(self, _):
         marked = self.pop_marked()
-        self.stack[-1].extend(marked)
+        self.target().extend(marked)
 
     def LIST(self, _):
         marked = self.pop_marked()
@@ -312,17 +618,17 @@ class JsonUnpickler:
 
     def SETITEM(self, _):
         k, v = self.pop(2)
-        self.stack[-1][k] = v
+        self.target()[k] = v
 
     def SETITEMS(self, _):
         marked = self.pop_marked()
-        self.stack[-1].update({marked[i]: marked[i+1]
-                                 for i in range(0, len(marked), 2)
-                                 })
+        self.target().update({marked[i]: marked[i+1]
+                              for i in range(0, len(marked), 2)
+                              })
 
     def ADDITEMS(self, _):
         marked = self.pop_marked()
-        self.stack[-1].extend(sorted(marked))
+        self.target().extend(sorted(marked))
 
     def FROZENSET(self, _):
         marked = self.pop_marked()
@@ -369,7 +675,7 @@ class JsonUnpickler:
 
     def BUILD(self, _):
         state = self.stack.pop()
-        self.stack[-1].__setstate__(state)
+        self.target().__setstate__(state)
 
     def INST(self, arg):
         self.append(instance(Global(*arg.split()), tuple(self.pop_marked())))
@@ -400,6 +706,29 @@ class JsonUnpickler:
     def BINPERSID(self, _):
         self.stack[-1] = Persistent(self.stack[-1])
 
+def _unknown_opcode(data, pos):
+    raise ValueError("at position %s, opcode %r unknown"
+                     % (pos - 1, data[pos-1:pos]))
+
+def _dispatch_table(cls):
+    """Compute an unpickler dispatch table
+
+    The table maps opcodes, as they come out of indexing pickle data,
+    to argument reader and handler pairs.  Opcodes without arguments
+    have a reader of None and ``STOP`` has a handler of None too.
+    """
+    dispatch = {}
+    for i in range(256):
+        key = i if PY3 else chr(i)
+        dispatch[key] = _unknown_opcode, None
+    for opcode in pickletools.opcodes:
+        key = ord(opcode.code) if PY3 else opcode.code
+        read = globals()['read_' + opcode.arg.name] if opcode.arg else None
+        dispatch[key] = read, getattr(cls, opcode.name)
+    return dispatch
+
+JsonUnpickler.dispatch = _dispatch_table(JsonUnpickler)
+
 unicode_surrogates = re.compile(r'\\ud[89a-f][0-9a-f]{2,2}', flags=re.I)
 NoneNoneNone = None, None, None
 
@@ -433,7 +762,8 @@ class Jsonifier:
     skip_class = re.compile('BTrees[.]|ZODB.blob').match
     skip = object() # marker
 
-    def __init__(self, skip_class=None, transform=None):
+    def __init__(self, skip_class=None, transform=None, processes=None,
+                 chunksize=None, encoder=None):
         """Create a callable for converting database data to Newt JSON
 
         Parameters:
@@ -463,10 +793,101 @@ class Jsonifier:
 
           Returning anything other than None or a string is an
           error and behavior is undefined.
+
+        processes
+          The number of worker processes used by the ``map`` method.
+          If not provided (or 0), records are converted in the
+          calling process.
+
+          Worker processes are started the first time they're needed.
+          Depending on the platform's multiprocessing start method,
+          the ``skip_class`` and ``transform`` functions may need to
+          be picklable.
+
+        chunksize
+          The number of records sent to a worker process at a time.
+          If not provided, records are divided evenly among the
+          worker processes.
+
+        encoder
+          A function used to encode decoded pickle data as JSON,
+          like ``encode`` (the default) or ``encode_tree``.  It's
+          called with decoded data and must return a JSON string.
         """
         if skip_class is not None:
             self.skip_class = skip_class
         self.transform = transform
+        self.processes = processes
+        self.chunksize = chunksize
+        self.encoder = encoder
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Jsonifiers are sent to worker processes without their pools
+        state = self.__dict__.copy()
+        del state['_pool'], state['_pool_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                import multiprocessing
+                self._pool = multiprocessing.Pool(
+                    self.processes, _init_worker, (self, ))
+            return self._pool
+
+    def map(self, records):
+        """Convert a sequence of records.
+
+        The records are ``(id, data)`` pairs, where ``id`` and
+        ``data`` are what would be passed to the Jsonifier when
+        converting a single record.  A list of class name, ghost
+        pickle, and state triples is returned, in the same order as
+        the records.
+
+        If the Jsonifier was created with a number of processes,
+        records are converted in parallel by worker processes.
+        """
+        if not self.processes:
+            return [self(id, data) for id, data in records]
+
+        records = _bytes_records(records)
+        if len(records) < 2:
+            return [self(id, data) for id, data in records]
+
+        chunksize = self.chunksize or -(-len(records) // self.processes)
+        return self._get_pool().map(_jsonify, records, chunksize)
+
+    def map_async(self, records):
+        """Start converting a sequence of records in worker processes.
+
+        This is like ``map``, except that an object is returned
+        whose ``get`` method returns the list of converted data,
+        waiting for the conversion to finish if necessary, so the
+        caller can do other work in the meantime.
+
+        The Jsonifier must have been created with a number of
+        processes.
+        """
+        records = _bytes_records(records)
+        chunksize = self.chunksize or -(-len(records) // self.processes)
+        return self._get_pool().map_async(_jsonify, records, chunksize)
+
+    def close(self):
+        """Stop any worker processes.
+        """
+        with self._pool_lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     def __call__(self, id, data):
         """Convert data from a ZODB data record to data used by newt.
@@ -489,23 +910,13 @@ class Jsonifier:
         """
         if not data:
             return NoneNoneNone
-        unpickler = JsonUnpickler(data)
+        unpickler = JsonUnpickler(data, self.encoder)
         try:
-            klass = json.loads(unpickler.load())
-
-            if isinstance(klass, list):
-                klass, args = klass
-                if isinstance(klass, list):
-                    class_name = '.'.join(klass)
-                else:
-                    class_name = klass['name']
-            else:
-                class_name = klass['name']
-
+            class_name, _ = unpickler.load_class()
             if self.skip_class(class_name):
                 return NoneNoneNone
 
-            ghost_pickle = data[:unpickler.pos]
+            ghost_pickle = unpickler.pickle[:unpickler.pos]
             state = unpickler.load()
 
             if self.transform is not None:
@@ -524,3 +935,16 @@ class Jsonifier:
 
         return class_name, ghost_pickle, state
 
+_worker_jsonifier = None
+
+def _init_worker(jsonifier):
+    global _worker_jsonifier
+    _worker_jsonifier = jsonifier
+
+def _jsonify(record):
+    return _worker_jsonifier(*record)
+
+def _bytes_records(records):
+    return [(id, data if data is None or isinstance(data, bytes)
+             else bytes(data)) # e.g. memoryviews from bytea columns
+            for id, data in records]
@@ -0,0 +1,273 @@
+"""Query builder
+
+Queries are built from criteria on object state and class, and
+compiled to SQL criteria for the ``where`` family of search APIs.
+Criteria are expressed, where possible, as ``jsonb`` containment
+(``@>``) and key-existence (``?``) predicates, which can use the
+``newt_json_idx`` GIN index.  Other criteria, like ranges, are
+expressed using ``jsonb`` comparisons of state values, which only
+match values of the same JSON type as the values they're compared
+with.
+
+For example::
+
+  query = conn.query().eq(status='open').gt('priority', 2).order_by(
+      'priority', descending=True)
+  tasks = query.search()
+
+Paths to values in object state are given as property names, as
+dotted names for nested values (``'owner.name'``) or as sequences
+of names.
+"""
+import json
+
+JSON_INDEX = 'newt_json_idx'
+
+def _json(value):
+    return json.dumps(value, sort_keys=True)
+
+def _json_type(value):
+    # The jsonb_typeof name of a value's JSON type
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, (list, tuple)):
+        return 'array'
+    return 'string'
+
+def _path(path):
+    if isinstance(path, (tuple, list)):
+        return list(path)
+    return path.split('.')
+
+def _nest(path, value):
+    for name in reversed(path):
+        value = {name: value}
+    return value
+
+def _merge(a, b):
+    # Merge containment documents, or return None if they conflict
+    result = dict(a)
+    for name, value in b.items():
+        if name in result:
+            if isinstance(result[name], dict) and isinstance(value, dict):
+                value = _merge(result[name], value)
+                if value is None:
+                    return None
+            elif result[name] != value:
+                return None
+        result[name] = value
+    return result
+
+def _value_sql(path):
+    if len(path) == 1:
+        return "state -> %s", [path[0]]
+    return "state #> %s", [path]
+
+class Predicate(object):
+    """An SQL predicate with its arguments and the index it can use
+    """
+
+    def __init__(self, sql, args, index=None):
+        self.sql = sql
+        self.args = args
+        self.index = index
+
+    def __repr__(self):
+        return "Predicate(%r, %r, %r)" % (self.sql, self.args, self.index)
+
+class Query(object):
+    """Build a query from criteria
+
+    Criteria methods return the query, so calls can be chained.  If
+    the query was created with a connection (for example, by calling
+    a newt connection's ``query`` method), search methods can be used
+    to execute it.
+    """
+
+    def __init__(self, conn=None):
+        self._conn = conn
+        self._contains = []
+        self._predicates = []
+        self._order = []
+
+    def eq(self, path=None, value=None, **values):
+        """Require values at paths to equal given values
+
+        Either a path and a value, or keyword arguments mapping
+        top-level property names to values, are given.  Scalar
+        values are compared for equality.  Objects and arrays
+        compare using containment.
+        """
+        if path is not None:
+            values = {None: value}
+        for name, value in sorted(values.items(), key=lambda i: str(i[0])):
+            doc = _nest(_path(path) if name is None else [name], value)
+            for i, contains in enumerate(self._contains):
+                merged = _merge(contains, doc)
+                if merged is not None:
+                    self._contains[i] = merged
+                    break
+            else:
+                self._contains.append(doc)
+        return self
+
+    def in_(self, path, values):
+        """Require the value at a path to be one of the given values
+        """
+        path = _path(path)
+        values = list(values)
+        if len(values) == 1:
+            return self.eq(path, values[0])
+        if not values:
+            self._predicates.append(Predicate('false', []))
+        else:
+            self._predicates.append(Predicate(
+                '(%s)' % ' or '.join(["state @> %s::jsonb"] * len(values)),
+                [_json(_nest(path, v)) for v in values],
+                JSON_INDEX))
+        return self
+
+    def has(self, path):
+        """Require a value to exist at a path
+        """
+        path = _path(path)
+        if len(path) == 1:
+            self._predicates.append(
+                Predicate("state ? %s", [path[0]], JSON_INDEX))
+        else:
+            self._predicates.append(
+                Predicate("state #> %s ? %s", [path[:-1], path[-1]]))
+        return self
+
+    def _compare(self, path, op, value):
+        # jsonb orders values of different types (e.g. all strings
+        # sort before all numbers), so require the same type.
+        sql, args = _value_sql(_path(path))
+        self._predicates.append(
+            Predicate("jsonb_typeof(%s) = %%s and %s %s %%s::jsonb"
+                      % (sql, sql, op),
+                      args + [_json_type(value)] + args + [_json(value)]))
+        return self
+
+    def gt(self, path, value):
+        """Require the value at a path to be greater than a value
+        """
+        return self._compare(path, '>', value)
+
+    def ge(self, path, value):
+        """Require the value at a path to be at least a value
+        """
+        return self._compare(path, '>=', value)
+
+    def lt(self, path, value):
+        """Require the value at a path to be less than a value
+        """
+        return self._compare(path, '<', value)
+
+    def le(self, path, value):
+        """Require the value at a path to be at most a value
+        """
+        return self._compare(path, '<=', value)
+
+    def range(self, path, min=None, max=None):
+        """Require the value at a path to be in a half-open range
+
+        Values must be at least ``min`` and less than ``max``.
+        Either bound may be omitted.
+        """
+        if min is not None:
+            self.ge(path, min)
+        if max is not None:
+            self.lt(path, max)
+        return self
+
+    def class_(self, *class_names):
+        """Require objects to be instances of the named classes
+        """
+        if len(class_names) == 1:
+            self._predicates.append(
+                Predicate("class_name = %s", list(class_names)))
+        else:
+            self._predicates.append(
+                Predicate("class_name = any(%s)", [list(class_names)]))
+        return self
+
+    def order_by(self, path, descending=False):
+        """Order results by the value at a path
+
+        Values are ordered as ``jsonb`` values, so numbers are
+        ordered numerically.  ``order_by`` may be called more than
+        once to order by more than one value.
+        """
+        sql, args = _value_sql(_path(path))
+        self._order.append((sql + (' desc' if descending else ''), args))
+        return self
+
+    def predicates(self):
+        """Return the query's predicates
+
+        Containment predicates come first, so they can be used to
+        select records using the GIN index.
+        """
+        return ([Predicate("state @> %s::jsonb", [_json(doc)], JSON_INDEX)
+                 for doc in self._contains] +
+                self._predicates)
+
+    def where_sql(self, order=True):
+        """Return SQL criteria and arguments for the ``where`` APIs
+        """
+        predicates = self.predicates()
+        sql = ' and '.join(p.sql for p in predicates) or 'true'
+        args = [arg for p in predicates for arg in p.args]
+        if order and self._order:
+            sql += ' order by ' + ', '.join(o for o, _ in self._order)
+            args.extend(arg for _, order_args in self._order
+                        for arg in order_args)
+        return sql, tuple(args)
+
+    def explain(self):
+        """Explain which indexes the query is expected to use
+
+        A sequence of predicate SQL and index name pairs is returned.
+        The index name is ``None`` for predicates that can't use the
+        newt JSON index.
+        """
+        return [(p.sql, p.index) for p in self.predicates()]
+
+    def search(self, prefetch=False):
+        """Return the objects satisfying the query
+        """
+        sql, args = self.where_sql()
+        return self._conn.where(sql, *args, prefetch=prefetch)
+
+    def search_iter(self, fetch_size=1000):
+        """Iterate over the objects satisfying the query
+
+        See the ``where_iter`` search API.
+        """
+        sql, args = self.where_sql()
+        return self._conn.where_iter(sql, args, fetch_size)
+
+    def search_batch(self, batch_start, batch_size, count='exact',
+                     prefetch=False):
+        """Return a result count and batch of objects
+
+        See the ``where_batch`` search API.
+        """
+        sql, args = self.where_sql()
+        return self._conn.where_batch(sql, args, batch_start, batch_size,
+                                      count, prefetch)
+
+    def count(self, mode='exact'):
+        """Count the objects satisfying the query
+
+        See the ``where_count`` search API.
+        """
+        sql, args = self.where_sql(order=False)
+        return self._conn.where_count(sql, args, mode)
@@ -4,8 +4,17 @@ It's assumed that the API is used with an object stored in a
 RelStorage with a Postgres back end.
 """
 
+import base64
+import collections
+import itertools
+import json
 import re
-from ZODB.utils import p64
+import threading
+import weakref
+from ZODB.blob import Blob
+from ZODB.utils import p64, u64
+
+from ._util import closing
 
 def _try_to_close_cursor(cursor):
     try:
@@ -13,6 +22,157 @@ def _try_to_close_cursor(cursor):
     except Exception:
         pass
 
+def _prefetch(conn, obs):
+    # Load the states of ghosts with a single query
+    ghosts = dict((u64(ob._p_oid), ob) for ob in obs
+                  if ob._p_changed is None and not isinstance(ob, Blob))
+    if ghosts:
+        conn.ex_setstates(dict(
+            (p64(oid_int), (ghosts[oid_int], state, p64(tid_int)))
+            for oid_int, tid_int, state
+            in _storage(conn).ex_load_states(ghosts)))
+    return obs
+
+_changed_objects_sql = """
+select distinct zoid, n.class_name
+from object_state s left join newt n using (zoid)
+where s.tid > %s and s.tid <= %s
+"""
+
+class SearchCache(object):
+    """Cache of search results, invalidated by new transactions
+
+    Results are stored, as object ids and ghost pickles, for the
+    transaction id of the connection views they were computed in.
+    When a connection sees a newer transaction, entries are
+    invalidated.  Entries stored with class names are only
+    invalidated if objects of those classes (or objects without newt
+    records) were changed, or if objects in their results were
+    changed, which covers objects whose classes changed.
+    Connections with views older than the cache's transaction don't
+    use the cache.
+
+    At most ``size`` entries are kept and least-recently used
+    entries are evicted first.  ``hits``, ``misses`` and
+    ``invalidations`` statistics are kept.
+
+    Note that object deletions from packing don't create
+    transactions, so don't invalidate entries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tid = None
+        self.hits = self.misses = self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dictionary of cache statistics
+        """
+        return dict(size=len(self._entries), hits=self.hits,
+                    misses=self.misses, invalidations=self.invalidations)
+
+    def _sync(self, conn):
+        # Invalidate entries if conn's view is newer than the cache's
+        # and return the view's transaction id.  The caller must
+        # check that it's the cache's with the lock held.  Changes
+        # are queried without the lock held, so other threads aren't
+        # blocked.
+        tid = _storage(conn)._prev_polled_tid
+        if tid is None:
+            return None
+        with self._lock:
+            start = self.tid
+            if start is not None and tid <= start:
+                return tid
+            query = start is not None and any(
+                classes is not None for classes, _ in self._entries.values())
+
+        changed = None
+        if query:
+            rows = query_data(conn, _changed_objects_sql, start, tid)
+            changed = (set(class_name for _, class_name in rows),
+                       set(zoid for zoid, _ in rows))
+
+        with self._lock:
+            # Other threads may have synced in the meantime.  Our
+            # changes include theirs, so more isn't missed.
+            if self.tid is None or tid > self.tid:
+                if self.tid is not None and self._entries:
+                    self._invalidate(changed)
+                self.tid = tid
+        return tid
+
+    def _invalidate(self, changed):
+        # Call with the lock held
+        entries = self._entries
+        if changed is None or None in changed[0]:
+            self.invalidations += len(entries)
+            entries.clear()
+        else:
+            changed_classes, changed_zoids = changed
+            for key, (classes, rows) in list(entries.items()):
+                if (classes is None or changed_classes.intersection(classes)
+                    or any(zoid in changed_zoids for zoid, _ in rows)):
+                    del entries[key]
+                    self.invalidations += 1
+
+    def get(self, conn, key):
+        """Return cached rows for a key, or None
+        """
+        tid = self._sync(conn)
+        with self._lock:
+            if tid is not None and tid == self.tid:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return entry[1]
+            self.misses += 1
+
+    def set(self, conn, key, rows, classes=None):
+        """Store rows for a key
+
+        If ``classes`` is given, it's a collection of the class names
+        of the objects the query depends on.
+        """
+        tid = self._sync(conn)
+        with self._lock:
+            if tid is not None and tid == self.tid:
+                entries = self._entries
+                entries.pop(key, None)
+                entries[key] = (
+                    None if classes is None else frozenset(classes), rows)
+                while len(entries) > self.size:
+                    entries.popitem(False)
+
+# Quoted strings and identifiers, and runs of whitespace outside them
+_quoted_or_space = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+")
+
+def _normalize_query(query):
+    # Collapse whitespace outside of quotes.  Queries with escapes,
+    # dollar quoting or comments, which could hide quotes, are left
+    # as they are.
+    if '\\' in query or '$' in query or '--' in query or '/*' in query:
+        return query
+    return _quoted_or_space.sub(
+        lambda m: m.group(1) or ' ', query).strip()
+
+def _search_cache_key(query, args):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8')
+    if isinstance(args, dict):
+        args = sorted(args.items())
+    return _normalize_query(query), repr(args)
+
 def search(conn, query, *args, **kw):
     """Search for newt objects using an SQL query.
 
@@ -26,24 +186,149 @@ def search(conn, query, *args, **kw):
     select all columns (using ``*``) from the ``newt`` table.
 
     A sequence of newt objects is returned.
+
+    If a true ``prefetch`` keyword argument is given, then the states
+    of the objects found are loaded together, with one additional
+    query, rather than one at a time as objects are used.
+    (``prefetch`` can't be used as a query parameter name.)
+
+    If the connection's database has a search cache (see the
+    ``search_cache_size`` database option), results are cached.  A
+    ``cache_classes`` keyword argument may be used to provide a
+    collection of the names of the classes of objects the query
+    depends on, so that the result is only invalidated when objects
+    of those classes change.
     """
+    prefetch = kw.pop('prefetch', False)
+    cache_classes = kw.pop('cache_classes', None)
     if kw:
         if args:
             raise TypeError("Only positional or keyword arguments can be used,"
                             " not both")
         args = kw
+
+    cache = getattr(conn, 'search_cache', None)
+    rows = None
+    if cache is not None:
+        key = _search_cache_key(query, args)
+        rows = cache.get(conn, key)
+
+    if rows is None:
+        cursor = read_only_cursor(conn)
+        try:
+            cursor.execute(b"select zoid, ghost_pickle from (" + query + b")_"
+                           if isinstance(query, bytes) else
+                           "select zoid, ghost_pickle from (" + query + ")_",
+                           args or None)
+            rows = [(zoid, bytes(ghost_pickle))
+                    for (zoid, ghost_pickle) in cursor]
+        finally:
+            _try_to_close_cursor(cursor)
+        if cache is not None:
+            cache.set(conn, key, rows, cache_classes)
+
     get = conn.ex_get
-    cursor = read_only_cursor(conn)
+    result = [get(p64(zoid), ghost_pickle) for (zoid, ghost_pickle) in rows]
+
+    if prefetch:
+        _prefetch(conn, result)
+    return result
+
+_cursor_names = itertools.count()
+
+def search_iter(conn, query, args=None, fetch_size=1000):
+    """Iterate over newt objects found using an SQL query.
+
+    This is like ``search``, but rather than reading all of the
+    results at once, results are read from a server-side cursor,
+    ``fetch_size`` rows at a time, and objects are returned as
+    they're iterated over.  This allows very large results to be
+    processed using constant memory.
+
+    Query parameters are provided using the ``args`` argument,
+    which may be a tuple or a dictionary.
+
+    The server-side cursor belongs to the current database
+    transaction, so iteration must be completed before the
+    connection is committed, aborted, or synchronized.  Iteration
+    may be stopped early by closing the returned iterator.
+    """
+    get = conn.ex_get
+    cursor = read_only_cursor(conn, 'newt_search_%s' % next(_cursor_names))
     try:
+        cursor.itersize = fetch_size
         cursor.execute(b"select zoid, ghost_pickle from (" + query + b")_"
                        if isinstance(query, bytes) else
                        "select zoid, ghost_pickle from (" + query + ")_",
                        args or None)
-        return [get(p64(zoid), ghost_pickle) for (zoid, ghost_pickle) in cursor]
+        for zoid, ghost_pickle in cursor:
+            yield get(p64(zoid), ghost_pickle)
     finally:
         _try_to_close_cursor(cursor)
 
-def search_batch(conn, query, args, batch_start, batch_size=None):
+class Count(int):
+    """A count of search results
+
+    The count's ``mode`` tells what kind of count it is:
+
+    ``'exact'``
+      The number of results.
+
+    ``'capped'``
+      There are more results than the count, which is the cap the
+      count was computed with.
+
+    ``'estimate'``
+      The PostgreSQL query planner's estimate of the number of
+      results.
+    """
+
+    def __new__(cls, value, mode='exact'):
+        self = int.__new__(cls, value)
+        self.mode = mode
+        return self
+
+    def __repr__(self):
+        return "Count(%d, %r)" % (self, self.mode)
+
+def _wrap(before, query, after):
+    if isinstance(query, bytes):
+        return before.encode('ascii') + query + after.encode('ascii')
+    else:
+        return before + query + after
+
+def _check_count_mode(mode):
+    if not (mode is None or mode in ('exact', 'estimate') or
+            (isinstance(mode, int) and not isinstance(mode, bool)
+             and mode >= 0)):
+        raise ValueError("Invalid count mode", mode)
+
+def _count(cursor, query, args, mode):
+    if mode is None:
+        return None
+    elif mode == 'exact':
+        cursor.execute(_wrap("select count(*) from (", query, ")_"),
+                       args or None)
+        [[count]] = cursor
+        return Count(count)
+    elif mode == 'estimate':
+        cursor.execute(_wrap("explain (format json) ", query, ""),
+                       args or None)
+        [[plan]] = cursor
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return Count(plan[0]['Plan']['Plan Rows'], 'estimate')
+    else:
+        cursor.execute(
+            _wrap("select count(*) from (select from (",
+                  query,
+                  ")_ limit %d)_" % (mode + 1)),
+            args or None)
+        [[count]] = cursor
+        return Count(mode, 'capped') if count > mode else Count(count)
+
+def search_batch(conn, query, args, batch_start, batch_size=None,
+                 count='exact', prefetch=False):
     """Query for a batch of newt objects.
 
     Query parameters are provided using the ``args``
@@ -59,6 +344,30 @@ def search_batch(conn, query, args, batch_start, batch_size=None):
     The total result count and sequence of batch result objects
     are returned.
 
+    The ``count`` argument controls how results are counted:
+
+    ``'exact'`` (the default)
+      Count all of the results.
+
+    an integer
+      Count results up to the given number.  If there are more
+      results, the number is returned as a count with a ``'capped'``
+      mode.
+
+    ``'estimate'``
+      Use the query planner's estimate from ``EXPLAIN``, which is
+      much faster than counting for large results, but may be
+      quite inaccurate.
+
+    ``None``
+      Don't count results. ``None`` is returned as the count.
+
+    Counts are ``Count`` objects, which are integers with a ``mode``
+    attribute that tells what kind of count was computed.
+
+    If ``prefetch`` is true, then the states of the batch objects are
+    loaded together, rather than one at a time as objects are used.
+
     The query parameters, ``args``, may be omitted. (In this case,
     ``batch_size`` will be None and the other arguments will be
     re-arranged appropriately. ``batch_size`` *is required*.)  You
@@ -75,29 +384,151 @@ def search_batch(conn, query, args, batch_start, batch_size=None):
         else:
             raise AssertionError("Invalid batch size %r" % batch_size)
 
-    if isinstance(query, str):
-        query = """select zoid, ghost_pickle, count(*) over()
-        from (%s) _
-        offset %d limit %d
-        """ % (query, batch_start, batch_size)
+    _check_count_mode(count)
+    # Pass the batch bounds as parameters, if we can, so batch
+    # queries can be prepared.
+    if isinstance(args, dict) and args:
+        bounds = "%(newt_batch_start)s limit %(newt_batch_size)s"
+        batch_args = dict(args, newt_batch_start=batch_start,
+                          newt_batch_size=batch_size)
+    elif args:
+        bounds = "%s limit %s"
+        batch_args = tuple(args) + (batch_start, batch_size)
     else:
-        # Python 3.4, whimper
-        query = (
-            b"select zoid, ghost_pickle, count(*) over()\nfrom (" +
-            query +
-            (") _\noffset %s limit %d" % (batch_start, batch_size)
-             ).encode('ascii')
-            )
+        bounds = "%d limit %d" % (batch_start, batch_size)
+        batch_args = None
+    batch_query = _wrap(
+        "select zoid, ghost_pickle, %s\nfrom (" % (
+            "count(*) over()" if count == 'exact' else "null"),
+        query,
+        ") _\noffset " + bounds)
 
     get = conn.ex_get
     cursor = read_only_cursor(conn)
     try:
-        cursor.execute(query, args or None)
-        count = 0
+        cursor.execute(batch_query, batch_args)
+        total = 0
         result = []
-        for zoid, ghost_pickle, count in cursor:
+        for zoid, ghost_pickle, total in cursor:
             result.append(get(p64(zoid), ghost_pickle))
-        return count, result
+        if count == 'exact':
+            total = Count(total)
+        else:
+            total = _count(cursor, query, args, count)
+    finally:
+        _try_to_close_cursor(cursor)
+
+    if prefetch:
+        _prefetch(conn, result)
+    return total, result
+
+def _page_token(key, zoid):
+    return base64.urlsafe_b64encode(
+        json.dumps([key, zoid]).encode('utf-8')).decode('ascii')
+
+def _page_token_data(token):
+    try:
+        key, zoid = json.loads(
+            base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError("Invalid page token", token)
+    return key, int(zoid)
+
+def search_page(conn, query, args=None, token=None, page_size=20,
+                sort=None, descending=False):
+    """Query for a page of newt objects, using keyset pagination.
+
+    Query parameters are provided using the ``args`` argument, which
+    may be a tuple or a dictionary.
+
+    Results are ordered by the SQL expression given by the ``sort``
+    argument, evaluated against the query results, and by ``zoid``
+    to break ties, or just by ``zoid`` if ``sort`` isn't given.
+    Results are in descending order if ``descending`` is true.  The
+    query shouldn't have an ``ORDER BY`` clause and sort values
+    shouldn't be null.
+
+    A sequence of at most ``page_size`` objects and a token for the
+    next page are returned.  The token is ``None`` if there are no
+    more results. Pass the token to get the next page.
+
+    Rather than skipping over the results of previous pages, pages
+    start after the sort value and zoid saved in the token, which
+    can use an index on the sort expression, so getting later pages
+    is as fast as getting the first page.  Use ``search_count`` to
+    count results, if needed.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8')
+    if not args:
+        # We'll pass our own parameters, so escape the query's
+        # percent signs.
+        query = query.replace('%', '%%')
+        sort = sort and sort.replace('%', '%%')
+        args = ()
+
+    if token is None:
+        after = ''
+    else:
+        key, zoid = _page_token_data(token)
+        if isinstance(args, dict):
+            args = dict(args, newt_page_key=key, newt_page_zoid=zoid)
+            key, zoid = '%(newt_page_key)s', '%(newt_page_zoid)s'
+        else:
+            args = tuple(args) + ((key, zoid) if sort else (zoid, ))
+            key = zoid = '%s'
+        after = "where %s %s %s" % (
+            "(%s, zoid)" % sort if sort else "zoid",
+            '<' if descending else '>',
+            "(%s, %s)" % (key, zoid) if sort else zoid,
+            )
+
+    direction = ' desc' if descending else ''
+    query = """select zoid, ghost_pickle, %s
+    from (%s) _
+    %s
+    order by %s
+    limit %d
+    """ % ("(%s)::text" % sort if sort else 'null',
+           query,
+           after,
+           ("%s%s, zoid%s" % (sort, direction, direction)
+            if sort else "zoid" + direction),
+           page_size + 1)
+
+    get = conn.ex_get
+    cursor = read_only_cursor(conn)
+    try:
+        # Always pass parameters, so escaped percent signs are unescaped:
+        cursor.execute(query, args)
+        rows = cursor.fetchmany(page_size + 1)
+    finally:
+        _try_to_close_cursor(cursor)
+
+    if len(rows) > page_size:
+        del rows[page_size:]
+        _, _, key = rows[-1]
+        token = _page_token(key, rows[-1][0])
+    else:
+        token = None
+
+    return [get(p64(zoid), ghost_pickle) for zoid, ghost_pickle, _ in rows
+            ], token
+
+def search_count(conn, query, args=None, mode='exact'):
+    """Count the results of an SQL query.
+
+    Query parameters are provided using the ``args`` argument,
+    which may be a tuple or a dictionary.
+
+    The ``mode`` argument controls how results are counted and may
+    be ``'exact'``, an integer cap, or ``'estimate'``. See
+    ``search_batch``.  A ``Count`` is returned.
+    """
+    _check_count_mode(mode)
+    cursor = read_only_cursor(conn)
+    try:
+        return _count(cursor, query, args, mode)
     finally:
         _try_to_close_cursor(cursor)
 
@@ -151,7 +582,8 @@ def _texts(texts, exprs, weight=None, config=None):
 
 
 identifier = re.compile(r'\w+$').match
-def create_text_index_sql(fname, D=None, C=None, B=None, A=None, config=None):
+def create_text_index_sql(fname, D=None, C=None, B=None, A=None, config=None,
+                          concurrently=False, stored=False):
     """Compute and return SQL to set up a newt text index.
 
     The resulting SQL contains a statement to create a
@@ -176,7 +608,27 @@ def create_text_index_sql(fname, D=None, C=None, B=None, A=None, config=None):
     <https://www.postgresql.org/docs/current/static/textsearch-intro.html#TEXTSEARCH-INTRO-CONFIGURATIONS>`_
     to use. If not specified, the server-configured default
     configuration is used.
+
+    If ``concurrently`` is true, the index is created with ``CREATE
+    INDEX CONCURRENTLY``, which doesn't block writes.  The statements
+    must then be executed separately, outside of a transaction
+    block, as ``psql`` does.
+
+    If ``stored`` is true, text vectors are stored in a ``tsvector``
+    column of the ``newt`` table named by the function name with a
+    ``_tsv`` suffix, which is kept up to date by a trigger as newt
+    records are written, and the index is on the column, rather than
+    the function.  Searches (see ``text_search``) can then use the
+    stored vectors to rank results, rather than extracting text again.
     """
+    sql = [_text_function_sql(fname, D, C, B, A, config)]
+    if stored:
+        sql.append(_text_column_sql % dict(fname=fname))
+        sql.append(_text_backfill_sql % dict(fname=fname))
+    sql.append(_text_index_sql(fname, concurrently, stored))
+    return '\n'.join(sql)
+
+def _text_function_sql(fname, D, C, B, A, config):
     texts = []
     _texts(texts, D, config=config)
     _texts(texts, C, 'C', config=config)
@@ -188,11 +640,53 @@ def create_text_index_sql(fname, D=None, C=None, B=None, A=None, config=None):
 
     texts.insert(0, text_extraction_template[0] % fname)
     texts.append(text_extraction_template[1])
-    texts.append("create index newt_%s_idx on newt using gin (%s(state));\n"
-                 % (fname, fname))
     return '\n'.join(texts)
 
-def create_text_index(conn, fname, D, C=None, B=None, A=None, config=None):
+def _text_index_sql(fname, concurrently=False, stored=False):
+    return "create index %snewt_%s_idx on newt using gin (%s);\n" % (
+        'concurrently ' if concurrently else '', fname,
+        fname + ('_tsv' if stored else '(state)'))
+
+_text_column_sql = """\
+alter table newt add column if not exists %(fname)s_tsv tsvector;
+
+create or replace function %(fname)s_tsv() returns trigger as $$
+begin
+  new.%(fname)s_tsv := %(fname)s(new.state);
+  return new;
+end
+$$ language plpgsql;
+
+drop trigger if exists %(fname)s_tsv_trigger on newt;
+create trigger %(fname)s_tsv_trigger
+  before insert or update of state on newt
+  for each row execute procedure %(fname)s_tsv();
+"""
+
+_text_backfill_sql = """\
+update newt set %(fname)s_tsv = %(fname)s(state);
+"""
+
+_text_backfill_batch_sql = """\
+update newt set %(fname)s_tsv = %(fname)s(state)
+where zoid = any(array(
+  select zoid from newt where zoid > %%s order by zoid limit %%s))
+returning zoid
+"""
+
+_index_valid_sql = """
+select indisvalid from pg_index join pg_class on (pg_class.oid = indexrelid)
+where relname = %s and pg_table_is_visible(pg_class.oid)
+"""
+
+_index_progress_sql = """
+select phase, blocks_done, blocks_total, tuples_done, tuples_total
+from pg_stat_progress_create_index where pid = %s
+"""
+
+def create_text_index(conn, fname, D, C=None, B=None, A=None, config=None,
+                      concurrently=False, progress=None, progress_interval=1,
+                      stored=False, batch_size=1000):
     """Set up a newt full-text index.
 
     The ``create_text_index_sql`` method is used to compute SQL, which
@@ -202,21 +696,209 @@ def create_text_index(conn, fname, D, C=None, B=None, A=None, config=None):
     The SQL is executed against the database associated with the given
     connection, but a separate connection is used, so it's execution
     is independent of the current transaction.
+
+    If ``concurrently`` is true, the index is built with ``CREATE
+    INDEX CONCURRENTLY`` on an autocommit connection, so the ``newt``
+    table isn't locked against writes while the index is built.  If a
+    valid index already exists, it's left alone and isn't rebuilt.  An
+    invalid index left by an earlier failed concurrent build is
+    dropped first, and if the build fails, the invalid index it
+    leaves is dropped before the error is raised.  A concurrent build
+    waits for transactions that started before it, including those of
+    other open connections, which end when the connections' current
+    transactions end.  The given connection's load transaction is
+    ended before the build, so it should be used between
+    transactions.
+
+    While a concurrent build runs, a ``progress`` function, if given,
+    is called every ``progress_interval`` seconds with a dictionary
+    with ``phase``, ``blocks_done``, ``blocks_total``,
+    ``tuples_done``, and ``tuples_total`` items, from PostgreSQL's
+    ``pg_stat_progress_create_index`` view.  (Progress is reported
+    with PostgreSQL 12 and later.)
+
+    If ``stored`` is true, text vectors are stored in a column kept up
+    to date as records are written.  See ``create_text_index_sql``.
+    When building concurrently, the column is filled in batches of
+    ``batch_size`` records, each in its own transaction.  Adding the
+    column waits for transactions that have read the ``newt`` table,
+    so, as for concurrent builds, the given connection's load
+    transaction is ended first.
     """
-    conn, cursor = _storage(conn).ex_connect()
-    sql = create_text_index_sql(fname, D, C, B, A, config)
+    if concurrently:
+        return _create_text_index_concurrently(
+            _storage(conn), fname, D, C, B, A, config,
+            progress, progress_interval, stored, batch_size)
+
+    storage = _storage(conn)
+    if stored:
+        # Adding the column waits for transactions that have read
+        # newt, including our own load transaction:
+        storage.afterCompletion()
+        sql = create_text_index_sql(fname, D, C, B, A, config, stored=True)
+    else:
+        sql = create_text_index_sql(fname, D, C, B, A, config)
+    conn, cursor = storage.ex_connect()
     try:
         cursor.execute(sql)
         conn.commit()
     finally:
-        try:
-            cursor.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
+        _close(conn, cursor)
+
+def _close(conn, cursor):
+    try:
+        cursor.close()
+    except Exception:
+        pass
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def _create_text_index_concurrently(storage, fname, D, C, B, A, config,
+                                    progress, progress_interval,
+                                    stored=False, batch_size=1000):
+    index = 'newt_%s_idx' % fname
+    conn, cursor = storage.ex_connect()
+    try:
+        conn.rollback()
+        conn.autocommit = True
+        # Concurrent index builds and drops wait for transactions
+        # with older snapshots, including our own load transaction:
+        storage.afterCompletion()
+
+        cursor.execute(_text_function_sql(fname, D, C, B, A, config))
+        if stored:
+            cursor.execute(_text_column_sql % dict(fname=fname))
+            zoid = -1
+            while True:
+                cursor.execute(_text_backfill_batch_sql % dict(fname=fname),
+                               (zoid, batch_size))
+                zoids = [z for (z, ) in cursor]
+                if not zoids:
+                    break
+                zoid = max(zoids)
+
+        valid = _index_valid(cursor, index)
+        if valid:
+            return # Already built
+        if valid is not None:
+            # Left by an earlier failed build
+            cursor.execute("drop index concurrently " + index)
+
+        sql = _text_index_sql(fname, True, stored)
+        if progress is None:
+            error = _run_sql(cursor, sql)
+        else:
+            cursor.execute("select pg_backend_pid()")
+            [[pid]] = cursor.fetchall()
+            errors = []
+            thread = threading.Thread(
+                target=lambda: errors.append(_run_sql(cursor, sql)))
+            thread.daemon = True
+            thread.start()
+            _report_index_progress(storage, thread, pid,
+                                   progress, progress_interval)
+            thread.join()
+            [error] = errors
+
+        if error is not None:
+            try:
+                # Drop the invalid index the build left, if any, but
+                # not a valid one built by someone else meanwhile.
+                if _index_valid(cursor, index) is False:
+                    cursor.execute("drop index concurrently " + index)
+            except Exception:
+                pass
+            raise error
+    finally:
+        _close(conn, cursor)
+
+def _index_valid(cursor, index):
+    # Return whether an index is valid, or None if it doesn't exist
+    cursor.execute(_index_valid_sql, (index, ))
+    for (valid, ) in cursor.fetchall():
+        return valid
+
+def _run_sql(cursor, sql):
+    # Run SQL, returning an exception if it fails
+    try:
+        cursor.execute(sql)
+    except Exception as exc:
+        return exc
+
+def _report_index_progress(storage, thread, pid, progress, interval):
+    conn, cursor = storage.ex_connect()
+    try:
+        conn.rollback()
+        conn.autocommit = True
+        while True:
+            thread.join(interval)
+            if not thread.is_alive():
+                break
+            try:
+                cursor.execute(_index_progress_sql, (pid, ))
+            except Exception:
+                break # No progress view
+            for (phase, blocks_done, blocks_total,
+                 tuples_done, tuples_total) in cursor.fetchall():
+                progress(dict(phase=phase,
+                              blocks_done=blocks_done,
+                              blocks_total=blocks_total,
+                              tuples_done=tuples_done,
+                              tuples_total=tuples_total))
+    finally:
+        _close(conn, cursor)
+
+_tsquery_functions = ('plainto_tsquery', 'phraseto_tsquery', 'to_tsquery',
+                      'websearch_to_tsquery')
+
+def text_search(conn, fname, text, query_tail=None, args=(), limit=None,
+                config=None, parser='plainto_tsquery', stored=True,
+                prefetch=False):
+    """Search a text index, ordering results by rank.
+
+    ``fname`` is the name of the text-extraction function the index
+    was created with (see ``create_text_index``).  ``text`` is the
+    text to search for, which is converted to a text query using the
+    function named by ``parser``, one of ``plainto_tsquery``,
+    ``phraseto_tsquery``, ``to_tsquery``, and
+    ``websearch_to_tsquery``, using the given text search ``config``,
+    if any.
+
+    Results are ordered by descending rank, computed with
+    ``ts_rank``.  If the index was created with ``stored=True``, the
+    stored text vectors are used, rather than extracting text from
+    each result.  Pass ``stored=False`` for indexes without stored
+    vectors.
+
+    Additional SQL criteria may be given with ``query_tail``, using
+    positional parameters in ``args``.  At most ``limit`` results are
+    returned, if a limit is given.
+
+    A sequence of newt objects is returned.
+    """
+    if parser not in _tsquery_functions:
+        raise ValueError("Invalid text query parser", parser)
+    if not identifier(fname):
+        raise ValueError("Invalid text function name", fname)
+
+    vector = fname + ('_tsv' if stored else '(state)')
+    if config:
+        tsquery = "%s(%%s::regconfig, %%s)" % parser
+        args = (config, text) + tuple(args)
+    else:
+        tsquery = "%s(%%s)" % parser
+        args = (text, ) + tuple(args)
+
+    query = ("select newt.* from newt, %s newt_query where %s @@ newt_query"
+             % (tsquery, vector))
+    if query_tail:
+        query += " and (%s)" % query_tail
+    query += " order by ts_rank(%s, newt_query) desc, zoid" % vector
+    if limit is not None:
+        query += " limit %d" % limit
+    return search(conn, query, *args, prefetch=prefetch)
 
 def query_data(conn, query, *args, **kw):
     """Query the newt Postgres database for raw data.
@@ -266,6 +948,9 @@ def where(conn, query_tail, *args, **kw):
     positional arguments, or ``%(NAME)s`` for keyword arguments.
 
     A sequence of newt objects is returned.
+
+    A true ``prefetch`` keyword argument causes object states to be
+    loaded together.  See ``search``.
     """
     return search(conn,
                   (b"select * from newt where "
@@ -275,7 +960,26 @@ def where(conn, query_tail, *args, **kw):
                   query_tail,
                   *args, **kw)
 
-def where_batch(conn, query_tail, args, batch_start, batch_size=None):
+def where_iter(conn, query_tail, args=None, fetch_size=1000):
+    """Iterate over objects satisfying criteria
+
+    Like the ``where`` method, this is a convenience wrapper, for
+    the ``search_iter`` method, which reads results from a
+    server-side cursor, ``fetch_size`` rows at a time.
+
+    Query parameters are provided using the ``args`` argument,
+    which may be a tuple or a dictionary.
+    """
+    return search_iter(conn,
+                       (b"select * from newt where "
+                        if isinstance(query_tail, bytes) else
+                        "select * from newt where "
+                        ) +
+                       query_tail,
+                       args, fetch_size)
+
+def where_batch(conn, query_tail, args, batch_start, batch_size=None,
+                count='exact', prefetch=False):
     """Query for batch of objects satisfying criteria
 
     Like the ``where`` method, this is a convenience wrapper for
@@ -292,7 +996,9 @@ def where_batch(conn, query_tail, args, batch_start, batch_size=None):
     used to order results.
 
     The total result count and sequence of batch result objects
-    are returned.
+    are returned.  The ``count`` argument controls how results are
+    counted and ``prefetch`` causes object states to be loaded
+    together. See ``search_batch``.
 
     The query parameters, ``args``, may be omitted. (In this case,
     ``batch_size`` will be None and the other arguments will be
@@ -308,8 +1014,42 @@ def where_batch(conn, query_tail, args, batch_start, batch_size=None):
                          if isinstance(query_tail, bytes) else
                          "select * from newt where ")
                         + query_tail,
-                        args, batch_start, batch_size)
+                        args, batch_start, batch_size, count, prefetch)
+
+def where_page(conn, query_tail, args=None, token=None, page_size=20,
+               sort=None, descending=False):
+    """Query for a page of objects satisfying criteria
 
+    Like the ``where`` method, this is a convenience wrapper, for
+    the ``search_page`` method, which uses keyset pagination.  The
+    criteria shouldn't include an ``ORDER BY`` clause.  Use the
+    ``sort`` and ``descending`` arguments to control ordering.
+
+    A sequence of at most ``page_size`` objects and a token for the
+    next page (or ``None``) are returned.
+    """
+    return search_page(conn,
+                       (b"select * from newt where "
+                        if isinstance(query_tail, bytes) else
+                        "select * from newt where "
+                        ) +
+                       query_tail,
+                       args, token, page_size, sort, descending)
+
+def where_count(conn, query_tail, args=None, mode='exact'):
+    """Count objects satisfying criteria
+
+    Like the ``where`` method, this is a convenience wrapper, for
+    the ``search_count`` method.  See ``search_batch`` for the
+    possible values of ``mode``.
+    """
+    return search_count(conn,
+                        (b"select * from newt where "
+                         if isinstance(query_tail, bytes) else
+                         "select * from newt where "
+                         ) +
+                        query_tail,
+                        args, mode)
 
 def _storage(conn):
     try:
@@ -317,7 +1057,213 @@ def _storage(conn):
     except AttributeError:
         return conn._p_jar._storage
 
-def read_only_cursor(conn):
+_placeholder = re.compile(r'%(?:\(([^)]*)\))?(.)')
+
+def _numbered_parameters(query, args):
+    # Convert a query with Python-style placeholders to one with
+    # numbered parameters, returning the converted query and the
+    # parameter names (or positions).  ValueError is raised if the
+    # query can't be converted.
+    names = []
+    def replace(match):
+        name, conversion = match.groups()
+        if conversion == '%' and name is None:
+            return '%'
+        if conversion != 's' or (name is None) == isinstance(args, dict):
+            raise ValueError(match.group(0))
+        if name is None:
+            name = len(names)
+        elif name in names:
+            return '$%d' % (names.index(name) + 1)
+        names.append(name)
+        return '$%d' % len(names)
+
+    if isinstance(query, bytes):
+        query = query.decode('utf-8')
+    query = _placeholder.sub(replace, query)
+    if not isinstance(args, dict) and len(names) != len(args):
+        raise ValueError("Wrong number of arguments")
+    return query, names
+
+class PreparedStatements(object):
+    """Server-side prepared statements for a database connection
+
+    Parameterized queries are prepared the first time they're
+    executed and later executions use the prepared statements,
+    avoiding parsing and planning.  At most ``size`` statements are
+    kept and least-recently used statements are deallocated first.
+
+    ``hits`` is the number of times prepared statements were used,
+    ``misses`` is the number of statements prepared, ``evictions``
+    is the number of statements deallocated and ``failures`` is the
+    number of queries that couldn't be prepared and were executed
+    normally.  Queries that fail this way aren't prepared again.
+
+    A statement is prepared and executed in a single round trip,
+    under a savepoint, so a failure doesn't abort the transaction.
+    Later executions use no savepoint; if they fail, the error is
+    raised and the statement is prepared again next time.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = self.misses = self.evictions = self.failures = 0
+        self._statements = collections.OrderedDict()
+        self._names = itertools.count()
+
+    def __len__(self):
+        return len(self._statements)
+
+    def stats(self):
+        """Return a dictionary of statistics
+        """
+        return dict(size=len(self._statements), hits=self.hits,
+                    misses=self.misses, evictions=self.evictions,
+                    failures=self.failures)
+
+    def execute(self, cursor, query, args):
+        """Execute a query using a prepared statement, if possible
+
+        Return a boolean indicating whether the query was executed.
+        """
+        statements = self._statements
+        statement = statements.pop(query, None)
+        if statement is None:
+            # Make room first, as the cursor must be left with the
+            # query results.
+            self._evict(cursor, self.size - 1)
+            statement = self._prepare(cursor, query, args)
+            statements[query] = statement
+            if statement:
+                self.misses += 1
+            return bool(statement)
+        elif not statement:
+            # Couldn't be prepared, don't try again.
+            statements[query] = statement
+            return False
+
+        self.hits += 1
+        name, names = statement
+        try:
+            cursor.execute(_execute_sql(name, names), [args[n] for n in names])
+        except Exception:
+            # Prepare the query again, once the transaction has been
+            # rolled back.
+            self._deallocate(cursor, name)
+            raise
+
+        statements[query] = statement
+        return True
+
+    def _prepare(self, cursor, query, args):
+        # Prepare a statement and execute it for the first time,
+        # returning the statement, or False if the query was not
+        # executed.
+        try:
+            sql, names = _numbered_parameters(query, args)
+        except ValueError:
+            self.failures += 1
+            return False
+
+        name = 'newt_%d' % next(self._names)
+        try:
+            # Use a savepoint so a failure doesn't abort the
+            # transaction.  The cursor gets the results of the last
+            # statement, so release the savepoint with another
+            # cursor.
+            cursor.execute(
+                "SAVEPOINT newt_prepare; PREPARE %s AS %s; %s" % (
+                    name, sql.replace('%', '%%'), _execute_sql(name, names)),
+                [args[n] for n in names])
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT newt_prepare;"
+                           " RELEASE SAVEPOINT newt_prepare")
+            self._deallocate(cursor, name)
+            self.failures += 1
+            return False
+
+        with closing(cursor.connection.cursor()) as release_cursor:
+            release_cursor.execute("RELEASE SAVEPOINT newt_prepare")
+        return name, names
+
+    def _deallocate(self, cursor, name):
+        # Deallocate a statement if it exists, as long as the
+        # transaction isn't aborted.
+        try:
+            cursor.execute("SELECT FROM pg_prepared_statements"
+                           " WHERE name = %s", (name, ))
+            if list(cursor):
+                cursor.execute("DEALLOCATE " + name)
+        except Exception:
+            pass
+
+    def _evict(self, cursor, size):
+        statements = self._statements
+        while len(statements) > size:
+            _, statement = statements.popitem(False)
+            if statement:
+                cursor.execute("DEALLOCATE " + statement[0])
+                self.evictions += 1
+
+def _execute_sql(name, names):
+    if names:
+        return "EXECUTE %s (%s)" % (name, ', '.join(['%s'] * len(names)))
+    return "EXECUTE " + name
+
+class _PreparingCursor(object):
+    # Cursor wrapper that executes parameterized queries using
+    # prepared statements
+
+    def __init__(self, cursor, statements):
+        self._cursor = cursor
+        self._statements = statements
+
+    def execute(self, query, args=None):
+        if not (args and self._statements.execute(self._cursor, query, args)):
+            self._cursor.execute(query, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
+
+def prepared_statements(conn):
+    """Return the ``PreparedStatements`` for a connection's load connection
+
+    ``None`` is returned if prepared statements aren't used.  See the
+    ``prepared_statement_cache_size`` storage option.
+    """
+    storage = _storage(conn)
+    size = getattr(storage._options, 'prepared_statement_cache_size', 0)
+    if not size:
+        return None
+    cursor = storage.ex_cursor()
+    try:
+        pg_conn = cursor.connection
+    finally:
+        _try_to_close_cursor(cursor)
+    return _connection_prepared_statements(pg_conn, size)
+
+def _connection_prepared_statements(pg_conn, size):
+    # Prepared statements last as long as the database connection.
+    with _prepared_statements_lock:
+        statements = _prepared_statements.get(pg_conn)
+        if statements is None:
+            statements = _prepared_statements[pg_conn] = PreparedStatements(
+                size)
+        return statements
+
+def read_only_cursor(conn, name=None):
     """Get a database cursor for reading.
 
     The returned `cursor
@@ -326,6 +1272,27 @@ def read_only_cursor(conn):
     using the `cursor's mogrify method
     <http://initd.org/psycopg/docs/cursor.html#cursor.mogrify>`_.
 
+    If a ``name`` is given, a named, server-side, cursor is returned.
+
+    If the ``prepared_statement_cache_size`` storage option is set,
+    and a name isn't given, the cursor executes parameterized
+    queries using server-side prepared statements.
+
+    If the ``read_replicas`` storage option is set, the cursor is for
+    a replica that has caught up with the last transaction the
+    connection has seen, if there is one, or for the primary
+    database otherwise.
+
     The caller must close the returned cursor after use.
     """
-    return _storage(conn).ex_cursor()
+    storage = _storage(conn)
+    cursor = None
+    if getattr(storage._options, 'read_replicas', None):
+        cursor = storage.ex_replica_cursor(name)
+    if cursor is None:
+        cursor = storage.ex_cursor(name)
+    size = getattr(storage._options, 'prepared_statement_cache_size', 0)
+    if size and name is None:
+        cursor = _PreparingCursor(
+            cursor, _connection_prepared_statements(cursor.connection, size))
+    return cursor
@@ -94,6 +94,244 @@ class AdapterTests(DBSetup, unittest.TestCase):
 
         conn.close()
 
+    def test_declared_auxiliary_tables(self):
+        import newt.db
+
+        conn = newt.db.pg_connection(self.dsn)
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "create table aux (zoid bigint primary key, a int)")
+        conn.close()
+
+        conn = newt.db.connection(
+            self.dsn,
+            keep_history=self.keep_history,
+            auxiliary_tables=[
+                newt.db.AuxiliaryTable(
+                    'aux', dict(a="(state->>'a')::int"),
+                    where="state ? 'a'")],
+            )
+        aux = lambda: [tuple(map(int, r)) for r in conn.query_data(
+            'select zoid, a from aux order by zoid')]
+
+        conn.root.x = x = Object(a=1)
+        conn.root.y = y = Object(a=2)
+        conn.commit()
+        self.assertEqual([(1, 1), (2, 2)], aux())
+        [[xmin]] = conn.query_data(
+            'select xmin::text from aux where zoid = 1')
+
+        # Rows that don't change aren't rewritten and rows for records
+        # that no longer satisfy the where condition are removed:
+        x.b = 1
+        y.b = 2
+        del y.a
+        conn.commit()
+        self.assertEqual([(1, 1)], aux())
+        self.assertEqual([(xmin,)], conn.query_data(
+            'select xmin::text from aux where zoid = 1'))
+
+        y.a = 3
+        conn.commit()
+        self.assertEqual([(1, 1), (2, 3)], aux())
+
+        conn.close()
+
+    def test_basic_jsonify_processes(self):
+        import newt.db
+        db = newt.db.DB(self.dsn, keep_history=self.keep_history,
+                        jsonify_processes=2)
+        conn = db.open()
+
+        # Add an object:
+        conn.root.x = o = Object(a=1)
+        conn.commit()
+        self.__assertBasicData(conn, o)
+
+        # Connections share the jsonifier, and its worker processes:
+        conn2 = db.open()
+        jsonifier = conn._storage._adapter.mover.jsonifier
+        self.assertIs(conn2._storage._adapter.mover.jsonifier, jsonifier)
+
+        # Data from several objects are converted together:
+        conn2.root.obs = [Object(i=i) for i in range(9)]
+        conn2.root.x.a = 2
+        conn2.commit()
+        conn.sync()
+        self.assertEqual(
+            [list(range(9)), [dict(a=2)]],
+            [sorted(ob.i for ob in conn.where("state ? 'i'")),
+             [conn.root.x.__getstate__()]],
+            )
+
+        # Records are sent to the workers in batches as they're
+        # stored, and the latest data for each object is used:
+        conn2._storage._adapter.mover.json_batch_size = 4
+        for ob in conn2.root.obs:
+            ob.i += 10
+        conn2.transaction_manager.savepoint()
+        conn2.root.obs[0].i = 20
+        conn2.commit()
+        conn.sync()
+        self.assertEqual(
+            list(range(11, 19)) + [20],
+            sorted(ob.i for ob in conn.where("state ? 'i'")))
+
+        conn2.close()
+        conn.close()
+        db.close()
+        jsonifier.close()
+
+    def test_skip_unchanged(self):
+        import newt.db
+        def veto(class_name, state):
+            if 'veto' in state:
+                return ''
+
+        conn = newt.db.connection(self.dsn, keep_history=self.keep_history,
+                                  skip_unchanged=True, transform=veto)
+        stats = conn._storage._adapter.mover.write_stats
+        written = stats.written
+        conn.root.x = Object(a=1)
+        conn.root.y = Object(a=1)
+        conn.commit()
+        self.assertEqual((stats.written - written, stats.unchanged), (3, 0))
+
+        def xmins():
+            return dict(conn.query_data("select zoid, xmin::text from newt"))
+
+        before = xmins()
+        conn.root.x._p_changed = True
+        conn.root.y.a = 2
+        conn.commit()
+        self.assertEqual((stats.written - written, stats.unchanged), (4, 1))
+        after = xmins()
+        self.assertEqual(after[u64(conn.root.x._p_oid)],
+                         before[u64(conn.root.x._p_oid)])
+        self.assertNotEqual(after[u64(conn.root.y._p_oid)],
+                            before[u64(conn.root.y._p_oid)])
+        self.assertEqual(conn.root.y.a, 2)
+        self.assertEqual(
+            [{'a': 2}],
+            [s for [s] in conn.query_data(
+                "select state from newt where zoid = %s",
+                u64(conn.root.y._p_oid))])
+
+        # Records for objects that no longer have JSON data are removed:
+        conn.root.y.veto = 1
+        conn.commit()
+        self.assertEqual(sorted(xmins()), [0, u64(conn.root.x._p_oid)])
+
+        conn.close()
+
+    def test_skip_unchanged_delete_trigger(self):
+        import newt.db
+        from .. import pg_connection
+
+        def source():
+            cursor.execute("select prosrc from pg_catalog.pg_proc"
+                           " where proname = 'newt_delete_on_state_delete'")
+            [[result]] = cursor.fetchall()
+            pg.commit()
+            return result
+
+        pg = pg_connection(self.dsn)
+        cursor = pg.cursor()
+        conn = newt.db.connection(self.dsn, keep_history=self.keep_history)
+        conn.root.x = Object(a=1)
+        conn.commit()
+        zoid = u64(conn.root.x._p_oid)
+        conn.close()
+        self.assertFalse('newt.storing' in source())
+
+        # The trigger function is updated when skipping unchanged records:
+        conn = newt.db.connection(self.dsn, keep_history=self.keep_history,
+                                  skip_unchanged=True)
+        conn.close()
+        self.assertEqual(not self.keep_history, 'newt.storing' in source())
+
+        # Deletes in new sessions, which haven't used the setting,
+        # remove newt records:
+        if self.keep_history:
+            cursor.execute("delete from current_object where zoid = %s",
+                           (zoid, ))
+        cursor.execute("delete from object_state where zoid = %s", (zoid, ))
+        cursor.execute("select from newt where zoid = %s", (zoid, ))
+        self.assertEqual([], cursor.fetchall())
+        pg.rollback()
+        pg.close()
+
+    def test_copy_json(self, **options):
+        import newt.db
+        db = newt.db.DB(self.dsn, keep_history=self.keep_history,
+                        copy_json=True, **options)
+        conn = db.open()
+        text = u'tab\there, "quotes", \\back\\slash,\nnew line, comma'
+        conn.root.x = o = Object(a=1)
+        conn.commit()
+        self.__assertBasicData(conn, o)
+
+        conn.root.obs = [Object(i=i, text=text, data=b'\x00\xff')
+                         for i in range(99)]
+        conn.commit()
+
+        conn.root.obs[0].i = -1
+        conn.commit()
+        self.assertEqual(
+            [(-1, text, {'::': 'hex', 'hex': '00ff'})] +
+            [(i, text, {'::': 'hex', 'hex': '00ff'}) for i in range(1, 99)],
+            [tuple(s[k] for k in ('i', 'text', 'data'))
+             for [s] in conn.query_data(
+                 "select state from newt where state ? 'i' order by zoid")])
+
+        conn.close()
+        jsonifier = db.storage._adapter.mover.jsonifier
+        db.close()
+        jsonifier.close()
+
+    def test_copy_json_jsonify_processes(self):
+        self.test_copy_json(jsonify_processes=2, skip_unchanged=True)
+
+    def test_newt_lock(self, newt_lock='rows'):
+        import newt.db
+        import threading
+        import time
+        conn = newt.db.connection(self.dsn, keep_history=self.keep_history,
+                                  newt_lock=newt_lock)
+        conn.root.x = o = Object(a=1)
+        conn.root.y = Object(a=1)
+        conn.commit()
+
+        # Another transaction writes a newt record:
+        pg = newt.db.pg_connection(self.dsn)
+        cursor = pg.cursor()
+        cursor.execute("update newt set class_name = class_name"
+                       " where zoid = %s", (u64(conn.root.y._p_oid), ))
+
+        # We can still commit changes to other objects, without
+        # waiting for the other transaction to finish.
+        timer = threading.Timer(3, pg.rollback)
+        timer.start()
+        o.a = 2
+        start = time.time()
+        conn.commit()
+        self.assertTrue(time.time() - start < 2)
+        timer.join()
+        pg.close()
+
+        self.assertEqual(
+            [({'a': 2}, )],
+            conn.query_data("select state from newt where zoid = %s",
+                            u64(o._p_oid)))
+        conn.close()
+
+    def test_newt_lock_invalid(self):
+        import newt.db
+        with self.assertRaises(ValueError):
+            newt.db.storage(self.dsn, keep_history=self.keep_history,
+                            newt_lock='advisory')
+
     def test_restore(self):
         source_db = ZODB.DB(None)
         source_conn = source_db.open()
@@ -184,6 +422,29 @@ class AdapterTests(DBSetup, unittest.TestCase):
         self.assertEqual(conn.root.x.a, 1)
         conn.close()
 
+    def test_state_digest_added_to_existing_newt(self):
+        import newt.db
+        conn = newt.db.connection(self.dsn, keep_history=self.keep_history)
+        conn.root.x = Object(a=1)
+        conn.commit()
+        conn.close()
+
+        # Simulate a newt table created by an older version:
+        pg = newt.db.pg_connection(self.dsn)
+        with pg:
+            with pg.cursor() as cursor:
+                cursor.execute("alter table newt drop column state_digest")
+        pg.close()
+
+        conn = newt.db.connection(self.dsn, keep_history=self.keep_history)
+        conn.root.x.a = 2
+        conn.commit()
+        self.assertEqual(
+            [(16,)],
+            conn.query_data("select length(state_digest) from newt"
+                            " where zoid = %s", u64(conn.root.x._p_oid)))
+        conn.close()
+
 class HPAdapterTests(AdapterTests):
 
     layer = MininalTestLayer('HPAdapterTests')
@@ -0,0 +1,170 @@
+import asyncio
+import unittest
+
+from .. import Object
+from .. import aio
+from .base import DBSetup
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+class AioTests(DBSetup, unittest.TestCase):
+
+    def setUp(self):
+        super(AioTests, self).setUp()
+        import newt.db
+        self.db = newt.db.DB(self.dsn)
+        self.conn = self.db.open()
+        self.conn.root.obs = [Object(i=i) for i in range(20)]
+        self.conn.commit()
+        self.searcher = aio.Searcher(self.dsn, max_workers=2)
+
+    def tearDown(self):
+        self.searcher.close()
+        self.db.close()
+        super(AioTests, self).tearDown()
+
+    def test_search(self):
+        searcher = self.searcher
+
+        async def searches():
+            return await asyncio.gather(
+                searcher.where("state->>'i' = %s", '3'),
+                searcher.search(
+                    "select * from newt where (state->>'i')::int < %(n)s"
+                    " order by zoid", n=5),
+                searcher.where_batch(
+                    "(state->>'i')::int >= %s order by zoid", (10, ), 2, 3),
+                searcher.where_count("(state->>'i')::int >= %s", (10, )),
+                searcher.query_data(
+                    "select count(*) from newt where state ? 'i'"),
+                )
+
+        where, search, (count, batch), n, data = run(searches())
+
+        # Rows are object ids and ghost pickles:
+        [(zoid, ghost_pickle)] = where
+        self.assertEqual(self.conn.root.obs[3]._p_oid, aio.p64(zoid))
+        self.assertTrue(isinstance(ghost_pickle, bytes))
+
+        # which can be materialized on a connection:
+        self.assertEqual([3], [o.i for o in aio.ghosts(self.conn, where)])
+        self.assertEqual([0, 1, 2, 3, 4],
+                         [o.i for o in aio.ghosts(self.conn, search)])
+        self.assertEqual(10, count)
+        self.assertEqual([12, 13, 14],
+                         [o.i for o in aio.ghosts(self.conn, batch)])
+        self.assertEqual(10, n)
+        self.assertEqual([(20, )], data)
+
+        # Searches see committed changes:
+        self.conn.root.obs[3].i = 33
+        self.conn.commit()
+        self.assertEqual(
+            [], run(searcher.where("state->>'i' = %s", '3')))
+
+        # Errors are raised to callers and don't affect later searches:
+        with self.assertRaises(Exception):
+            run(searcher.where("nonesuch"))
+        self.assertEqual(21, run(searcher.where_count("true")))
+
+        # There are no objects to prefetch states for:
+        with self.assertRaises(ValueError):
+            run(searcher.where("true", prefetch=True))
+        with self.assertRaises(ValueError):
+            run(searcher.search("select * from newt", prefetch=True))
+
+    def test_text_search(self):
+        self.conn.root.obs[3].text = 'green eggs'
+        self.conn.root.obs[4].text = 'eggs and eggs'
+        self.conn.commit()
+        self.conn.create_text_index('txt', 'text', stored=True)
+        rows = run(self.searcher.text_search('txt', 'eggs'))
+        self.assertEqual([4, 3], [o.i for o in aio.ghosts(self.conn, rows)])
+        rows = run(self.searcher.text_search(
+            'txt', 'eggs', "state->>'i' = %s", ('3', ), limit=1))
+        self.assertEqual([3], [o.i for o in aio.ghosts(self.conn, rows)])
+
+class AioFollowTests(DBSetup, unittest.TestCase):
+
+    def setUp(self):
+        super(AioFollowTests, self).setUp()
+        from .. import pg_connection
+        self.conn = pg_connection(self.dsn)
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+        self.ex = self.cursor.execute
+        self.ex("create table object_state"
+                " (zoid bigint primary key, tid bigint, state bytea)")
+
+    def tearDown(self):
+        self.cursor.close()
+        self.conn.close()
+        super(AioFollowTests, self).tearDown()
+
+    def store(self, tid, *oids):
+        self.ex("begin")
+        self.ex("delete from object_state where zoid = any(%s)",
+                (list(oids), ))
+        for oid in oids:
+            self.ex("insert into object_state values (%s, %s, 'some data')",
+                    (oid, tid))
+        self.ex("commit")
+
+    def test_updates_batching(self):
+        for t, i in enumerate(range(0, 99, 7)):
+            self.store(t + 1, *range(i, i + 7))
+
+        async def batches(**kw):
+            return [[int(r[1]) async for r in batch]
+                    async for batch in aio.updates(self.dsn, **kw)]
+
+        self.assertEqual(
+            [list(range(0, 21)), list(range(21, 42)), list(range(42, 63)),
+             list(range(63, 84)), list(range(84, 105))],
+            run(batches(end_tid=999, batch_limit=20, internal_batch_size=8)))
+        self.assertEqual([list(range(7, 21))],
+                         run(batches(start_tid=1, end_tid=3)))
+
+    def test_updates_idle_partition(self):
+        self.store(1, 2, 4)
+
+        async def batches():
+            it = aio.updates(self.dsn, end_tid=99, partition=1, partitions=2)
+            return [[r async for r in batch] async for batch in it], it.tid
+
+        self.assertEqual(([[]], 1), run(batches()))
+
+    def test_updates_follow(self):
+        self.store(1, 1, 2)
+
+        async def follow():
+            data = []
+            async for batch in aio.updates(self.dsn, poll_timeout=9):
+                data.append([(int(r[0]), int(r[1])) async for r in batch])
+                if len(data) == 1:
+                    # Commit from another thread while we listen:
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, self.store, 2, 3, 4)
+                else:
+                    return data
+
+        self.assertEqual([[(1, 1), (1, 2)], [(2, 3), (2, 4)]],
+                         run(asyncio.wait_for(follow(), 30)))
+
+    def test_listen(self):
+        async def notifications():
+            it = aio.listen(self.dsn, True, poll_timeout=0.1)
+            result = [await it.__anext__(), await it.__anext__()]
+            self.ex("notify %s, '42'" % aio._follow.NOTIFY)
+            result.append(await it.__anext__())
+            self.ex("notify %s, 'STOP'" % aio._follow.NOTIFY)
+            result.extend([p async for p in it])
+            return result
+
+        self.assertEqual([None, None, '42'],
+                         run(asyncio.wait_for(notifications(), 30)))
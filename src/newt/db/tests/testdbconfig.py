@@ -105,3 +105,104 @@ class DBConfigTest(DBSetup, unittest.TestCase):
 
         db.close()
 
+    def test_search_cache_size(self):
+        db = databaseFromString("""\
+            %%import newt.db
+
+            <newtdb foo>
+              search-cache-size 42
+              <zodb>
+                <relstorage>
+                  <newt>
+                    <postgresql>
+                      dsn dbname=%s
+                    </postgresql>
+                  </newt>
+                </relstorage>
+              </zodb>
+            </newtdb>
+            """ % self.dbname)
+        self.assertEqual(db.search_cache.size, 42)
+        conn = db.open()
+        self.assertIs(conn.search_cache, db.search_cache)
+        conn.close()
+        db.close()
+
+    def test_jsonifier_options(self):
+        db = databaseFromString("""\
+            %%import newt.db
+
+            <newtdb foo>
+              <zodb>
+                <relstorage>
+                  <newt>
+                    jsonify-processes 2
+                    json-encoder newt.db.jsonpickle.encode_tree
+                    skip-unchanged true
+                    <postgresql>
+                      dsn dbname=%s
+                    </postgresql>
+                  </newt>
+                </relstorage>
+              </zodb>
+            </newtdb>
+            """ % self.dbname)
+
+        from ..jsonpickle import encode_tree
+        jsonifier = db.storage._adapter.mover.jsonifier
+        self.assertEqual(jsonifier.processes, 2)
+        self.assertEqual(jsonifier.encoder, encode_tree)
+        self.assertTrue(db.storage._adapter.mover.skip_unchanged)
+
+        db.close()
+
+    def test_prepared_statement_cache_size(self):
+        db = databaseFromString("""\
+            %%import newt.db
+
+            <newtdb foo>
+              <zodb>
+                <relstorage>
+                  <newt>
+                    prepared-statement-cache-size 9
+                    <postgresql>
+                      dsn dbname=%s
+                    </postgresql>
+                  </newt>
+                </relstorage>
+              </zodb>
+            </newtdb>
+            """ % self.dbname)
+
+        conn = db.open()
+        self.assertEqual(conn.where("zoid = %s", 0), [conn.root()])
+        from ..search import prepared_statements
+        self.assertEqual(prepared_statements(conn).size, 9)
+        db.close()
+
+    def test_read_replicas(self):
+        db = databaseFromString("""\
+            %%import newt.db
+
+            <newtdb foo>
+              <zodb>
+                <relstorage>
+                  <newt>
+                    read-replica dbname=%s
+                    read-replica dbname=%s application_name=newt
+                    <postgresql>
+                      dsn dbname=%s
+                    </postgresql>
+                  </newt>
+                </relstorage>
+              </zodb>
+            </newtdb>
+            """ % (self.dbname, self.dbname, self.dbname))
+
+        self.assertEqual(
+            ('dbname=' + self.dbname,
+             'dbname=%s application_name=newt' % self.dbname),
+            db.storage._options.read_replicas)
+        conn = db.open()
+        self.assertEqual(conn.where("zoid = %s", 0), [conn.root()])
+        db.close()
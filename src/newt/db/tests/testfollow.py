@@ -39,12 +39,17 @@ class FollowTests(base.DBSetup, unittest.TestCase):
         self.ex("begin")
         if self.history_preserving:
             self.ex("insert into object_state values {}".format(svalues))
-            self.ex("delete from current_object where zoid = any(%s)",
-                    (list(oids), ))
-            self.ex("insert into current_object values {}".format(cvalues))
+            self.ex("insert into current_object values {}"
+                    " on conflict (zoid) do update set tid = excluded.tid"
+                    .format(cvalues))
         else:
-            self.ex("delete from object_state where zoid = any(%s)",
+            # Like RelStorage, replace rows of objects in temp_store:
+            self.ex("create temporary table temp_store (zoid bigint)"
+                    " on commit drop")
+            self.ex("insert into temp_store select unnest(%s::bigint[])",
                     (list(oids), ))
+            self.ex("delete from object_state"
+                    " where zoid in (select zoid from temp_store)")
             self.ex("insert into object_state values {}".format(svalues))
         self.ex("commit")
 
@@ -81,6 +86,69 @@ class FollowTests(base.DBSetup, unittest.TestCase):
             [list(range(14, 28))],
             )
 
+    def test_update_iterator_partitions(self):
+        for t in range(1, 4):
+            self.store(t, *range(t, t + 10))
+        from ..follow import updates
+
+        def zoids(partition, **kw):
+            return sorted(int(r[1])
+                          for b in updates(self.conn.dsn, end_tid=3,
+                                           partition=partition, partitions=3,
+                                           **kw)
+                          for r in b)
+
+        partitions = [zoids(p) for p in range(3)]
+        self.assertEqual(list(range(1, 13)), sorted(sum(partitions, [])))
+        for p, partition in enumerate(partitions):
+            self.assertEqual([p] * len(partition), [z % 3 for z in partition])
+        self.assertEqual([3, 6, 9, 12], zoids(0, start_tid=2))
+
+        with self.assertRaises(ValueError):
+            updates(self.conn.dsn, partition=3, partitions=3)
+
+    def test_idle_partition_progress(self):
+        from .. import follow
+        self.store(1, 0, 2)
+        self.store(2, 2)
+        self.store(3, 4)
+
+        def follower(partition, start_tid=-1):
+            it = follow.updates(self.dsn, start_tid, end_tid=99,
+                                partition=partition, partitions=2)
+            batches = [[int(r[1]) for r in batch] for batch in it]
+            follow.set_progress_tid(
+                self.dsn, follow.partition_id('test', partition, 2), it.tid)
+            return batches, it.tid
+
+        self.assertEqual(([[0, 2, 4]], 3), follower(0))
+        # A partition without records gets an empty batch, so its
+        # progress can be saved:
+        self.assertEqual(([[]], 3), follower(1))
+        self.assertEqual(
+            3, follow.get_partitioned_progress_tid(self.dsn, 'test', 2))
+
+        self.store(4, 6)
+        self.assertEqual(([[6]], 4), follower(0, 3))
+        self.assertEqual(([[]], 4), follower(1, 3))
+        self.assertEqual(([], 4), follower(1, 4))
+        self.assertEqual(
+            4, follow.get_partitioned_progress_tid(self.dsn, 'test', 2))
+
+    def test_partitioned_progress(self):
+        from .. import follow
+        self.assertEqual(
+            -1, follow.get_partitioned_progress_tid(self.conn, 'test', 2))
+        follow.set_progress_tid(self.conn, follow.partition_id('test', 0, 2), 5)
+        self.assertEqual(
+            -1, follow.get_partitioned_progress_tid(self.conn, 'test', 2))
+        follow.set_progress_tid(self.conn, follow.partition_id('test', 1, 2), 3)
+        self.assertEqual(
+            3, follow.get_partitioned_progress_tid(self.dsn, 'test', 2))
+        follow.set_progress_tid(self.conn, 'test', 1)
+        self.assertEqual(
+            3, follow.get_partitioned_progress_tid(self.dsn, 'test', 2))
+
     def wait_equal(self, expect, got):
         try:
             wait(lambda : expect == got)
@@ -123,6 +191,190 @@ class FollowTests(base.DBSetup, unittest.TestCase):
     def test_update_iterator_follow_no_timeout(self):
         self.test_update_iterator_follow(None)
 
+    def test_logical_updates(self):
+        from .. import follow
+        if self.history_preserving:
+            # RelStorage's table has a primary key:
+            self.ex("alter table object_state replica identity full")
+        self.assertTrue(follow.create_logical_slot(self.cursor, 'newt_test'))
+        self.assertFalse(follow.create_logical_slot(self.cursor, 'newt_test'))
+        try:
+            self.store(1, 1, 2)
+            self.store(2, 2, 3)
+            self.ex("begin")
+            self.ex("delete from object_state where zoid = 1")
+            if self.history_preserving:
+                self.ex("delete from current_object where zoid = 1")
+            self.ex("commit")
+
+            def batches(**kw):
+                return iter(follow.logical_updates(
+                    self.dsn, 'newt_test', poll_timeout=1, **kw))
+
+            # Deleted objects get the last tid seen:
+            expect = [(1, 1, b'some data'), (1, 2, b'some data'),
+                      (2, 2, b'some data'), (2, 3, b'some data'),
+                      (2, 1, None)]
+            it = batches()
+            self.assertEqual(expect, list(next(it)))
+
+            # Changes are consumed when the next batch is requested,
+            # so iteration resumes with an unprocessed batch:
+            it.close()
+            it = batches(batch_limit=1)
+            self.assertEqual(expect[:2], list(next(it)))
+            it.close()
+
+            # Changes from transactions up to start_tid are skipped:
+            it = batches(start_tid=1)
+            self.assertEqual(expect[2:], list(next(it)))
+            it.close()
+
+            it = batches()
+            self.assertEqual(expect, list(next(it)))
+            self.store(3, 4)
+            self.assertEqual([(3, 4, b'some data')], list(next(it)))
+
+            # Unchanged states stored out of line aren't included in
+            # changes, so they're loaded, by object and transaction id:
+            import os
+            tids = (5, 6) if self.history_preserving else (5, )
+            states = dict((tid, os.urandom(9999)) for tid in tids)
+            for tid in tids:
+                self.ex("insert into object_state values (7, %s, %s)",
+                        (tid, states[tid]))
+            self.assertEqual([(tid, 7, states[tid]) for tid in tids],
+                             list(next(it)))
+            if not self.history_preserving:
+                self.ex("update object_state set zoid = zoid"
+                        " where zoid = 7 and tid = 5")
+                self.assertEqual([(5, 7, states[5])], list(next(it)))
+            it.close()
+        finally:
+            follow.drop_logical_slot(self.conn, 'newt_test')
+        self.ex("select from pg_replication_slots")
+        self.assertEqual([], self.cursor.fetchall())
+
+    def test_logical_updates_pack(self):
+        self.ex("drop table object_state")
+        if self.history_preserving:
+            self.ex("drop table current_object")
+
+        import newt.db
+        from .. import follow
+        db = newt.db.DB(self.dsn, keep_history=self.history_preserving)
+        follow.create_logical_slot(self.cursor, 'newt_test')
+        it = iter(follow.logical_updates(
+            self.dsn, 'newt_test', poll_timeout=1))
+        try:
+            conn = db.open()
+            from .._object import Object
+            conn.root.x = Object(a=1)
+            conn.commit()
+            conn.root.x.a = 2
+            conn.commit()
+            next(it)
+
+            # Packing doesn't cause old revisions to be emitted:
+            import time
+            from ZODB.serialize import referencesf
+            db.storage.pack(time.time(), referencesf)
+            conn.root.z = 1
+            conn.commit()
+            self.ex("select max(tid) from object_state")
+            [[tid]] = self.cursor.fetchall()
+            self.assertEqual([(tid, 0)], [r[:2] for r in next(it)])
+            conn.close()
+        finally:
+            it.close()
+            db.close()
+            follow.drop_logical_slot(self.conn, 'newt_test')
+
+    def test_logical_slot_name_quoted(self):
+        from .. import follow
+        self.assertTrue(follow.create_logical_slot(self.cursor, 'user'))
+        self.ex("select from pg_publication where pubname = 'user'")
+        self.assertEqual(1, len(self.cursor.fetchall()))
+        follow.drop_logical_slot(self.conn, 'user')
+        self.ex("select from pg_publication where pubname = 'user'")
+        self.assertEqual([], self.cursor.fetchall())
+
+    def delete(self, *oids):
+        self.ex("delete from %s where zoid = any(%%s)" % (
+            'current_object' if self.history_preserving else 'object_state'),
+                (list(oids), ))
+
+    def test_tombstones(self):
+        from .. import follow
+        self.assertTrue(follow.install_deletion_log(self.cursor))
+        self.assertFalse(follow.install_deletion_log(self.cursor))
+
+        def records(**kw):
+            return sorted((int(r[0]), int(r[1]), r[2] and bytes(r[2]))
+                          for b in follow.updates(self.dsn, end_tid=99,
+                                                  tombstones=True, **kw)
+                          for r in b)
+
+        self.store(1, 1, 2, 3)
+        self.store(2, 2)
+        self.delete(1, 3)
+        # Deletions are logged, but not returned until another
+        # transaction is committed:
+        self.ex("select zoid, tid from newt_follow_deleted order by zoid")
+        self.assertEqual([(1, None), (3, None)], self.cursor.fetchall())
+        self.assertEqual([(2, 2, b'some data')], records())
+        self.store(3, 4)
+        self.assertEqual(
+            [(2, 2, b'some data'),
+             (3, 1, None), (3, 3, None), (3, 4, b'some data')],
+            records())
+        self.assertEqual([(3, 1, None), (3, 3, None)],
+                         records(start_tid=2, partition=1, partitions=2))
+
+        # Without tombstones, only data are returned:
+        self.assertEqual(
+            [(3, 4)],
+            [(int(r[0]), int(r[1]))
+             for b in follow.updates(self.dsn, start_tid=2, end_tid=99)
+             for r in b])
+
+        self.assertEqual(0, follow.prune_deletion_log(self.dsn, 2))
+        self.assertEqual(2, follow.prune_deletion_log(self.dsn, 3))
+        self.assertEqual([(2, 2, b'some data'), (3, 4, b'some data')],
+                         records())
+
+        if not self.history_preserving:
+            # Deletions are also stamped by transactions that only
+            # update existing objects:
+            self.delete(2)
+            self.ex("insert into object_state values (4, 4, 'some data')"
+                    " on conflict (zoid) do update"
+                    " set tid = excluded.tid, state = excluded.state")
+            self.assertEqual([(4, 2, None), (4, 4, b'some data')],
+                             records(start_tid=3))
+
+    def test_install_trigger(self):
+        from .._util import trigger_exists
+        from .. import follow
+
+        # Databases with the old row-level trigger are migrated:
+        self.ex(follow.row_trigger_sql)
+        self.assertTrue(follow.install_trigger(self.cursor))
+        self.assertFalse(trigger_exists(self.cursor, follow.ROW_TRIGGER))
+        for name in follow.STATEMENT_TRIGGERS:
+            self.assertTrue(trigger_exists(self.cursor, name))
+        self.assertFalse(follow.install_trigger(self.cursor))
+
+        # A single notification is sent per transaction:
+        listener = pg_connection(self.dsn)
+        listener.autocommit = True
+        listener.cursor().execute("listen " + follow.NOTIFY)
+        self.store(1, *range(50))
+        self.store(2, *range(25, 75))
+        wait(lambda: listener.poll() or len(listener.notifies) >= 2)
+        self.assertEqual(['1', '2'], [n.payload for n in listener.notifies])
+        listener.close()
+
     def test_garbage(self):
         self.ex("drop table object_state")
         if self.history_preserving:
@@ -152,6 +404,48 @@ class FollowTests(base.DBSetup, unittest.TestCase):
         conn.close()
         db.close()
 
+    def test_tombstones_pack(self):
+        self.ex("drop table object_state")
+        if self.history_preserving:
+            self.ex("drop table current_object")
+
+        import newt.db
+        from .. import follow
+        db = newt.db.DB(self.dsn, keep_history=self.history_preserving)
+        follow.install_deletion_log(self.cursor)
+        conn = db.open()
+        from .._object import Object
+        conn.root.x = Object()
+        conn.root.y = Object()
+        conn.commit()
+        from ZODB.utils import u64
+        zoids = sorted(u64(o._p_oid) for o in (conn.root.x, conn.root.y))
+        del conn.root.x
+        del conn.root.y
+        conn.commit()
+
+        # Storing objects doesn't log deletions:
+        self.ex("select zoid from newt_follow_deleted")
+        self.assertEqual([], self.cursor.fetchall())
+
+        import time
+        from ZODB.serialize import referencesf
+        db.storage.pack(time.time(), referencesf)
+        conn.root.z = 1
+        conn.commit()
+        self.ex("select max(tid) from object_state")
+        [[tid]] = self.cursor.fetchall()
+
+        self.assertEqual(
+            [(tid, 0), (tid, zoids[0]), (tid, zoids[1])],
+            sorted((int(r[0]), int(r[1]))
+                   for b in follow.updates(self.dsn, tid - 1, tombstones=True,
+                                           end_tid=tid)
+                   for r in b))
+
+        conn.close()
+        db.close()
+
 class FollowTestsHP(FollowTests):
 
     history_preserving = True
@@ -17,6 +17,7 @@ import json
 import persistent
 from persistent.mapping import PersistentMapping
 import pickle
+import pickletools
 from pprint import pprint
 from six import BytesIO, PY3
 import textwrap
@@ -24,7 +25,7 @@ import unittest
 import ZODB
 from ZODB.utils import z64, p64, maxtid
 
-from ..jsonpickle import JsonUnpickler, dumps
+from ..jsonpickle import JsonUnpickler, default, dumps
 
 class C(object):
     def __init__(self, **attrs):
@@ -210,6 +211,28 @@ class JsonUnpicklerProtocol0Tests(unittest.TestCase):
     def test_cyclic_instance(self):
         self.test_cyclic_object(I)
 
+    def test_cycles_detected_while_decoding(self):
+        def cyclic(data):
+            unpickler = JsonUnpickler(pickle.dumps(data, self.proto))
+            unpickler._decode()
+            return unpickler.cyclic
+
+        shared = [1]
+        self.assertFalse(cyclic([shared, shared, (shared, shared)]))
+        self.assertFalse(cyclic(dict(a=shared, b=dict(c=shared))))
+        self.assertFalse(cyclic(C(a=shared, b=C(c=shared))))
+
+        data = [1, 2]
+        data.append((3, data))
+        self.assertTrue(cyclic(data))
+        data = dict(a=shared)
+        data['b'] = [data]
+        self.assertTrue(cyclic(data))
+        c = C(a=shared); c.c = [c]
+        self.assertTrue(cyclic(c))
+        i = I(); i.i = i
+        self.assertTrue(cyclic(i))
+
     def test_sets(self):
         data = set((1,2,3)), frozenset((4, 5, 6))
         got = JsonUnpickler(pickle.dumps(data, self.proto)).load()
@@ -305,6 +328,181 @@ class Complete(unittest.TestCase):
         for opcode in pickletools.opcodes:
             self.assertTrue(hasattr(JsonUnpickler, opcode.name))
 
+    def test_unknown_opcode(self):
+        with self.assertRaises(ValueError):
+            JsonUnpickler(b'\x80\x02\xff.').load()
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            JsonUnpickler(pickle.dumps([1, 2], 2)[:-1]).load()
+
+class GenopsJsonUnpickler(JsonUnpickler):
+    """The original, pickletools-based, JsonUnpickler
+
+    This serves as a reference implementation for checking the
+    conformance of the JSON generated by ``JsonUnpickler``.
+    """
+
+    def set_pickle(self, pickle):
+        self.pickle = pickle
+        self.ops = pickletools.genops(BytesIO(pickle))
+
+    old_cyclic = False
+
+    def load(self, **json_args):
+        for op, arg, pos in self.ops:
+            if op.name == 'STOP':
+                self.pos = pos + 1
+                self.set_pickle(self.pickle[self.pos:])
+                # Ignore any cycle detection done while decoding:
+                self.cyclic = self.old_cyclic
+                try:
+                    return json.dumps(self.stack[-1],
+                                      default=default,
+                                      **json_args)
+                except ValueError:
+                    self.cyclic = self.old_cyclic = True
+                    return json.dumps(self.stack[-1],
+                                      default=default,
+                                      **json_args)
+
+            getattr(self, op.name)(arg)
+
+def conformance_corpus():
+    """Generate pickles with a variety of data.
+    """
+    s = 'spam '
+    di = dict(n=None, t=True, f=False, l=[], l1=[1])
+    shared = [1, 2]
+    cyclic = [1, 2]
+    cyclic.append((3, cyclic))
+    c = C(); c.name = 'c'; c.c = c
+    i = I(a=1, b=[s, s])
+    i.me = [i]
+    cyclic_dict = dict(a=shared)
+    cyclic_dict['b'] = [cyclic_dict, (shared, cyclic_dict)]
+    data = [
+        0, 1, -1, 255, 256, 65535, 65536, -(1 << 31), 1 << 31, 1 << 70,
+        -(1 << 70), 1 << 2100, 1.5, -1e300, True, False, None,
+        s, s * 99, u'\ua000', u'\ua000\n\ua000', u'\U0001f600',
+        u'back\\slash', b'abc', b'\xdd', b'\xdd' * 300, b'',
+        (), (1,), (1, 2), (1, 2, 3), (1, 2, 3, 4), [], [[]], {}, di,
+        set((1, 2, 3)), frozenset((4, 5, 6)), set(),
+        datetime.date(2017, 1, 2),
+        datetime.datetime(2017, 1, 2, 4, 5, 6),
+        datetime.datetime(1, 2, 3, 4, 5, 6, 7, TZ()),
+        datetime.timedelta(1, 2, 3),
+        dict(a=shared, b=shared, c=(shared, shared)),
+        [di, di, (di, di)],
+        cyclic, cyclic_dict, c, i, C(a=1, b=C(c=2)), I(),
+        E190(), E60190(), E600000190(),
+        dict((str(k), list(range(k))) for k in range(50)),
+        ]
+    import decimal
+    data.append(decimal.Decimal(6)/decimal.Decimal(5))
+
+    for proto in range(pickle.HIGHEST_PROTOCOL + 1):
+        for d in data:
+            if proto < 2 and isinstance(d, (E190, E60190, E600000190)):
+                continue
+            yield pickle.dumps(d, proto)
+
+        if proto < 1:
+            continue # Persistent ids are binary
+        f = BytesIO()
+        pickler = SpecialPickler(f, protocol=proto)
+        pickler.dump((special, special))
+        yield f.getvalue()
+
+    # Python 2 style strings and odd text-mode opcodes:
+    yield b"S'abc'\np0\n."
+    yield b'S"a\\x00b"\np0\n.'
+    yield b'\x80\x02U\x03abcq\x00.'
+    yield b'\x80\x02T\x03\x00\x00\x00\xddbcq\x00.'
+    yield b'\x80\x02]q\x00(U\x03abcq\x01h\x01e.'
+    yield b'(I00\nI01\nI42\nL42L\nF1.5\nVa\\u1234\ntp0\n.'
+    yield (b'cBTrees.OOBTree\nOOBTree\nq\x01.((((U\x07100x100q\x02(U\x08'
+           b'\x00\x00\x00\x00\x00\x92s\x11q\x03ccontent.models.files\n'
+           b'Thumbnail\nq\x04tq\x05QU\x0550x50q\x06(U\x08\x00\x00\x00'
+           b'\x00\x00\x9cV_q\x07h\x04tq\x08QU\x0675x100q\t(U\x08\x00'
+           b'\x00\x00\x00\x00\x92s\x0eq\nh\x04tq\x0bQU\x0585x85q\x0c'
+           b'(U\x08\x00\x00\x00\x00\x00\x9cV]q\rh\x04tq\x0eQttttq\x0f.')
+
+    for p in database_records():
+        yield p
+
+def database_records():
+    """Generate database records, which consist of class and state pickles
+    """
+    db = ZODB.DB(None)
+    with db.transaction() as conn:
+        root = conn.root()
+        root.name = u'root'
+        root.numbers = 0, 123456789, 1 << 70, 1234.56789
+        root.time = datetime.datetime(2001, 2, 3, 4, 5, 6, 7)
+        root.data = b'\xff'
+        root.p = P(x=1, l=[1, 2], m=PersistentMapping(a=1))
+        root.p.me = root.p
+        root.ps = [P(i=i) for i in range(300)]
+        root.shared = root.ps[:3]
+        root.more = root.shared
+    for trans in db.storage.iterator():
+        for record in trans:
+            yield record.data
+    db.close()
+
+class ConformanceTests(unittest.TestCase):
+
+    maxDiff = None
+
+    def load_all(self, unpickler_factory, p, **json_args):
+        unpickler = unpickler_factory(p)
+        result = [unpickler.load(**json_args)]
+        pos = unpickler.pos
+        if pos < len(p):
+            # There's more, as in database records
+            result.append(unpickler.load(**json_args))
+        return pos, result
+
+    def test_output_matches_genops_implementation(self):
+        n = 0
+        for p in conformance_corpus():
+            for json_args in ({}, dict(sort_keys=True, indent=2)):
+                expected = self.load_all(GenopsJsonUnpickler, p, **json_args)
+                self.assertEqual(self.load_all(JsonUnpickler, p, **json_args),
+                                 expected, p)
+            n += 1
+        self.assertTrue(n > 300)
+
+    def test_encode_tree_matches_encode(self):
+        from ..jsonpickle import encode_tree
+        for p in conformance_corpus():
+            for json_args in ({}, dict(sort_keys=True, indent=2)):
+                self.assertEqual(
+                    self.load_all(lambda p: JsonUnpickler(p, encode_tree),
+                                  p, **json_args),
+                    self.load_all(JsonUnpickler, p, **json_args),
+                    p)
+
+    def test_load_class_matches_json_class_data(self):
+        for p in database_records():
+            unpickler = GenopsJsonUnpickler(p)
+            klass = json.loads(unpickler.load())
+            if isinstance(klass, list):
+                klass, args = klass
+            expected = klass['name'], unpickler.pos, unpickler.load()
+
+            unpickler = JsonUnpickler(p)
+            class_name, _ = unpickler.load_class()
+            self.assertEqual((class_name, unpickler.pos, unpickler.load()),
+                             expected)
+
+    def test_errors_match_genops_implementation(self):
+        for p in (b'', b'\x80\x02', b'\x80\x02K', b'\x80\x02\xff.',
+                  b'I1', b"S'abc\n.", b'\x80\x02X\x05\x00\x00\x00ab.'):
+            self.assertRaises(ValueError, GenopsJsonUnpickler(p).load)
+            self.assertRaises(ValueError, JsonUnpickler(p).load)
+
 class JsonUnpicklerDBTests(unittest.TestCase):
 
     maxDiff = None
@@ -400,6 +598,23 @@ class JsonUnpicklerDBTests(unittest.TestCase):
         _ = self.load()
         _ = self.load()
 
+    def test_load_class(self):
+        def load_class(klass):
+            state = {'a': 1}
+            unpickler = JsonUnpickler(pickle.dumps(klass, 2) +
+                                      pickle.dumps(state, 2))
+            result = unpickler.load_class()
+            self.assertEqual(unpickler.load(), '{"a": 1}')
+            return result
+
+        self.assertEqual(load_class(P), (__name__ + '.P', None))
+        self.assertEqual(load_class((P, None)), (__name__ + '.P', None))
+        self.assertEqual(load_class((P, (1, 2))), (__name__ + '.P', (1, 2)))
+        self.assertEqual(load_class(((__name__, 'P'), None)),
+                         (__name__ + '.P', None))
+        with self.assertRaises(ValueError):
+            load_class(42)
+
     def test_jsonifier(self):
         from zope.testing.loggingsupport import InstalledHandler
         handler = InstalledHandler('newt.db.jsonpickle')
@@ -465,3 +680,50 @@ class JsonUnpicklerDBTests(unittest.TestCase):
                 return ''
 
         self.assertEqual(Jsonifier(transform=veto)('0', p), (None, None, None))
+
+    def test_jsonifier_encoder(self):
+        self.conn.root.x = P(test=1)
+        self.conn.transaction_manager.commit()
+        p, _ = self.conn._storage.load(self.conn.root.x._p_oid)
+
+        from ..jsonpickle import Jsonifier, encode_tree, jsonable
+        self.assertEqual(Jsonifier(encoder=encode_tree)('0', p)[2],
+                         '{"test": 1}')
+
+        def encoder(ob, **json_args):
+            return repr(sorted(jsonable(ob).items()))
+
+        self.assertEqual(Jsonifier(encoder=encoder)('0', p)[2],
+                         "[('test', 1)]")
+
+    def test_jsonifier_map(self):
+        from BTrees.OOBTree import BTree
+        obs = self.root.obs = [P(i=i) if i % 3 else BTree() for i in range(9)]
+        self.conn.transaction_manager.commit()
+        records = [(ob._p_oid, self.conn._storage.load(ob._p_oid)[0])
+                   for ob in obs]
+        records.append((b'bad', b'badness'))
+
+        from ..jsonpickle import Jsonifier
+        jsonifier = Jsonifier()
+        expect = [jsonifier(*r) for r in records]
+        self.assertEqual((None, None, None), expect[0])
+        self.assertEqual('{"i": 1}', expect[1][2])
+        self.assertEqual(jsonifier.map(records), expect)
+
+        # With worker processes, the results are the same, and in order:
+        jsonifier = Jsonifier(processes=2, chunksize=3)
+        try:
+            self.assertEqual(list(map(tuple, jsonifier.map(records))), expect)
+            # Records can be memoryviews, as returned for bytea columns:
+            self.assertEqual(
+                list(map(tuple, jsonifier.map(
+                    [(oid, memoryview(data)) for oid, data in records]))),
+                expect)
+            self.assertEqual(jsonifier.map(records[1:2]), expect[1:2])
+            self.assertEqual(jsonifier.map([]), [])
+            # Conversions can be started and their results collected later:
+            self.assertEqual(
+                list(map(tuple, jsonifier.map_async(records).get())), expect)
+        finally:
+            jsonifier.close()
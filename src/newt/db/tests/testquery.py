@@ -0,0 +1,120 @@
+import unittest
+
+from .. import Object
+from ..query import Query
+from .base import DBSetup
+
+class QueryTests(unittest.TestCase):
+
+    def test_where_sql(self):
+        query = Query().eq(status='open', kind='task').eq('owner.name', 'bob')
+        self.assertEqual(
+            ("state @> %s::jsonb",
+             ('{"kind": "task", "owner": {"name": "bob"}, "status": "open"}',
+              )),
+            query.where_sql())
+
+        # Conflicting equality criteria aren't merged:
+        query.eq('status', 'closed')
+        self.assertEqual(
+            ("state @> %s::jsonb and state @> %s::jsonb",
+             ('{"kind": "task", "owner": {"name": "bob"}, "status": "open"}',
+              '{"status": "closed"}')),
+            query.where_sql())
+
+        query = (Query()
+                 .in_('status', ['open', 'new'])
+                 .range('size', 1, 10)
+                 .has('owner')
+                 .has('owner.name')
+                 .class_('myapp.Task')
+                 .class_('myapp.Task', 'myapp.Bug')
+                 .in_(('a', 'b'), [1])
+                 .order_by('size', True)
+                 .order_by('owner.name')
+                 )
+        self.assertEqual(
+            ("state @> %s::jsonb"
+             " and (state @> %s::jsonb or state @> %s::jsonb)"
+             " and jsonb_typeof(state -> %s) = %s and state -> %s >= %s::jsonb"
+             " and jsonb_typeof(state -> %s) = %s and state -> %s < %s::jsonb"
+             " and state ? %s"
+             " and state #> %s ? %s"
+             " and class_name = %s"
+             " and class_name = any(%s)"
+             " order by state -> %s desc, state #> %s",
+             ('{"a": {"b": 1}}',
+              '{"status": "open"}', '{"status": "new"}',
+              'size', 'number', 'size', '1',
+              'size', 'number', 'size', '10',
+              'owner',
+              ['owner'], 'name',
+              'myapp.Task',
+              ['myapp.Task', 'myapp.Bug'],
+              'size', ['owner', 'name'])),
+            query.where_sql())
+        self.assertEqual(query.where_sql()[0].split(' order by')[0],
+                         query.where_sql(order=False)[0])
+
+        self.assertEqual(("true", ()), Query().where_sql())
+        self.assertEqual(("false", ()), Query().in_('a', ()).where_sql())
+
+    def test_explain(self):
+        query = Query().gt('size', 1).eq(status='open').has('owner')
+        self.assertEqual(
+            [("state @> %s::jsonb", 'newt_json_idx'),
+             ("jsonb_typeof(state -> %s) = %s and state -> %s > %s::jsonb",
+              None),
+             ("state ? %s", 'newt_json_idx'),
+             ],
+            query.explain())
+
+class QuerySearchTests(DBSetup, unittest.TestCase):
+
+    def setUp(self):
+        super(QuerySearchTests, self).setUp()
+        import newt.db
+        self.db = newt.db.DB(self.dsn)
+        self.conn = self.db.open()
+        self.conn.root.obs = [
+            Object(i=i, status=('open', 'closed', 'new')[i % 3],
+                   owner=dict(name=('bob', 'sally')[i % 2]))
+            for i in range(20)]
+        self.conn.commit()
+
+    def tearDown(self):
+        self.db.close()
+        super(QuerySearchTests, self).tearDown()
+
+    def test_search(self):
+        query = self.conn.query().eq(status='open').eq('owner.name', 'bob')
+        self.assertEqual([0, 6, 12, 18],
+                         sorted(o.i for o in query.search(prefetch=True)))
+        self.assertEqual(4, query.count())
+
+        query = (self.conn.query()
+                 .in_('status', ['open', 'new'])
+                 .range('i', 5, 15)
+                 .class_('newt.db._object.Object')
+                 .order_by('i', descending=True))
+        self.assertEqual([14, 12, 11, 9, 8, 6, 5],
+                         [o.i for o in query.search()])
+        self.assertEqual([14, 12, 11, 9, 8, 6, 5],
+                         [o.i for o in query.search_iter(3)])
+        total, batch = query.search_batch(2, 3)
+        self.assertEqual((7, [11, 9, 8]), (total, [o.i for o in batch]))
+        self.assertEqual(7, query.count())
+
+        query = self.conn.query().has('owner.name').lt('owner.name', 'c')
+        self.assertEqual(10, query.count())
+
+    def test_compare_mixed_types(self):
+        # Values of other JSON types don't match comparisons:
+        self.conn.root.others = [
+            Object(i=v) for v in ('x', None, [1], True, {'a': 1})]
+        self.conn.commit()
+        search = lambda query: sorted(o.i for o in query.search())
+        self.assertEqual(list(range(5)), search(self.conn.query().lt('i', 5)))
+        self.assertEqual([18, 19], search(self.conn.query().gt('i', 17)))
+        self.assertEqual(['x'], search(self.conn.query().ge('i', 'a')))
+        self.assertEqual([True], search(self.conn.query().le('i', True)))
@@ -1,9 +1,13 @@
 from ZODB.utils import u64
+import transaction
 import unittest
 
 from .. import Object
 from .base import DBSetup
 
+class Other(Object):
+    pass
+
 class SearchTests(DBSetup, unittest.TestCase):
 
     def setUp(self):
@@ -98,6 +102,395 @@ class SearchTests(DBSetup, unittest.TestCase):
         self.assertEqual(total, 89)
         self.assertEqual(list(range(12, 32)), [o.i for o in batch])
 
+    def test_search_iter(self):
+        self.conn.root.obs = [Object(i=i) for i in range(50)]
+        self.conn.transaction_manager.commit()
+
+        conn2 = self.db.open()
+        sql = """
+        select * from newt
+        where (state->>'i')::int >= %(a)s and (state->>'i')::int <= %(b)s
+        order by zoid
+        """
+        it = conn2.search_iter(sql, dict(a=2, b=40), fetch_size=7)
+
+        # Results are read and objects created as we iterate, and
+        # objects can be loaded while iterating:
+        self.assertEqual([2, 3, 4], [next(it).i for _ in range(3)])
+        self.assertEqual(len(conn2._cache), 3)
+        self.assertEqual(list(range(5, 41)), [o.i for o in it])
+
+        # Stopping early closes the server-side cursor:
+        it = conn2.where_iter("state ? 'i' order by zoid", fetch_size=7)
+        self.assertEqual(0, next(it).i)
+        it.close()
+        self.assertEqual(
+            [], conn2.query_data("select name from pg_cursors"))
+
+        # test stand-alone API and binary/pre-mogrified queries:
+        from .. import search
+        self.assertEqual(
+            list(range(2, 41)),
+            [o.i for o in search.where_iter(
+                conn2,
+                b"(state->>'i')::int >= 2 and (state->>'i')::int <= 40"
+                b" order by zoid")])
+
+    def test_search_page(self):
+        self.conn.root.obs = [Object(i=i, g=i % 3) for i in range(50)]
+        self.conn.transaction_manager.commit()
+
+        conn2 = self.db.open()
+        sql = """
+        select * from newt
+        where (state->>'i')::int >= %(a)s and (state->>'i')::int <= %(b)s
+        """
+        pages = []
+        token = None
+        while True:
+            page, token = conn2.search_page(
+                sql, dict(a=2, b=40), token, 7, "(state->>'g')::int")
+            pages.append([(o.g, o.i) for o in page])
+            if token is None:
+                break
+        self.assertEqual([7] * 5 + [4], list(map(len, pages)))
+        self.assertEqual(sorted((i % 3, i) for i in range(2, 41)),
+                         sum(pages, []))
+
+        # Tokens are opaque strings:
+        page, token = conn2.search_page(sql, dict(a=2, b=40), page_size=7)
+        self.assertTrue(isinstance(token, str))
+        self.assertRaises(ValueError, conn2.search_page, sql, dict(a=2, b=40),
+                          'nonsense')
+
+        # Positional args, descending and zoid order:
+        pages = []
+        token = None
+        while True:
+            page, token = conn2.where_page(
+                "(state->>'i')::int >= %s", (30, ), token, 7,
+                descending=True)
+            pages.append([o.i for o in page])
+            if token is None:
+                break
+        self.assertEqual(list(range(49, 29, -1)), sum(pages, []))
+
+        # Without args, and pre-mogrified:
+        from .. import search
+        page, token = search.where_page(
+            conn2, b"state->>'i' like '1%'", page_size=5, sort="state->>'i'")
+        self.assertEqual(['1', '10', '11', '12', '13'],
+                         [str(o.i) for o in page])
+        page, token = search.where_page(
+            conn2, b"state->>'i' like '1%'", None, token, 5, "state->>'i'")
+        self.assertEqual(['14', '15', '16', '17', '18'],
+                         [str(o.i) for o in page])
+        page, token = search.where_page(
+            conn2, b"state->>'i' like '1%'", None, token, 5, "state->>'i'")
+        self.assertEqual(['19'], [str(o.i) for o in page])
+        self.assertEqual(None, token)
+
+        # Percent signs work as operators without args too:
+        pages = []
+        token = None
+        while True:
+            page, token = search.where_page(
+                conn2, "(state->>'i')::int % 10 = 3", None, token, 3,
+                "(state->>'i')::int % 7")
+            pages.append([o.i for o in page])
+            if token is None:
+                break
+        self.assertEqual([[43, 23, 3], [33, 13]], pages)
+
+        # Counting is separate:
+        self.assertEqual(39, conn2.search_count(sql, dict(a=2, b=40)))
+        self.assertEqual(11, conn2.where_count("state->>'i' like %s", ('1%',)))
+        self.assertEqual(11, search.where_count(conn2,
+                                                "state->>'i' like '1%'"))
+
+    def test_search_batch_count_modes(self):
+        self.conn.root.obs = [Object(i=i) for i in range(50)]
+        self.conn.transaction_manager.commit()
+
+        sql = "select * from newt where (state->>'i')::int >= %s order by zoid"
+        total, batch = self.conn.search_batch(sql, (10, ), 5, 3)
+        self.assertEqual([15, 16, 17], [o.i for o in batch])
+        self.assertEqual((40, 'exact'), (total, total.mode))
+
+        total, batch = self.conn.search_batch(sql, (10, ), 5, 3, count=20)
+        self.assertEqual([15, 16, 17], [o.i for o in batch])
+        self.assertEqual((20, 'capped'), (total, total.mode))
+
+        total, batch = self.conn.where_batch(
+            "(state->>'i')::int >= %s", (10, ), 5, 3, count=40)
+        self.assertEqual((40, 'exact'), (total, total.mode))
+
+        total, batch = self.conn.where_batch(
+            b"(state->>'i')::int >= 10 order by zoid", 5, 3,
+            count='estimate')
+        self.assertEqual([15, 16, 17], [o.i for o in batch])
+        self.assertEqual('estimate', total.mode)
+        self.assertTrue(isinstance(total, int))
+
+        total, batch = self.conn.search_batch(sql, (10, ), 5, 3, count=None)
+        self.assertEqual([15, 16, 17], [o.i for o in batch])
+        self.assertEqual(None, total)
+
+        self.assertRaises(ValueError, self.conn.search_batch, sql, (10, ), 5, 3,
+                          count='lots')
+
+        # Counting on its own:
+        count = self.conn.where_count("(state->>'i')::int >= %s", (10, ), 9)
+        self.assertEqual((9, 'capped'), (count, count.mode))
+        self.assertEqual('estimate', self.conn.search_count(
+            "select * from newt", mode='estimate').mode)
+
+    def test_search_prefetch(self):
+        self.conn.root.obs = [Object(i=i) for i in range(20)]
+        self.conn.transaction_manager.commit()
+
+        conn2 = self.db.open()
+        loads = []
+        load = conn2._storage.load
+        conn2._storage.load = lambda *args: loads.append(args) or load(*args)
+
+        obs = conn2.where("state ? 'i' order by zoid", prefetch=True)
+        self.assertEqual([False] * 20, [o._p_changed for o in obs])
+        self.assertEqual(list(range(20)), [o.i for o in obs])
+
+        total, obs = conn2.where_batch(
+            "state ? 'i' order by zoid", (), 5, 3, prefetch=True)
+        self.assertEqual([5, 6, 7], [o.i for o in obs])
+        self.assertEqual([], loads)
+
+        # States are added to the storage cache, so other connections
+        # don't have to load them from the database:
+        conn3 = self.db.open()
+        [ob] = conn3.where("state->>'i' = '5'")
+        mover = conn3._storage._adapter.mover
+        load_current = mover.load_current
+        mover.load_current = lambda *args: loads.append(args)
+        self.assertEqual(5, ob.i)
+        self.assertEqual([], loads)
+        mover.load_current = load_current
+
+    def test_search_cache(self):
+        import newt.db
+        db = newt.db.DB(self.dsn, search_cache_size=2)
+        self.assertEqual(None, self.db.search_cache)
+        cache = db.search_cache
+        conn = db.open()
+        conn.root.obs = [Object(i=i) for i in range(5)]
+        conn.root.other = newt.db.List([1])
+        conn.commit()
+
+        def where(query, *args, **kw):
+            return sorted(o.i for o in conn.where(query, *args, **kw))
+
+        self.assertEqual([3, 4], where("(state->>'i')::int > %s", 2))
+        self.assertEqual(dict(size=1, hits=0, misses=1, invalidations=0),
+                         cache.stats())
+
+        # Queries are normalized:
+        self.assertEqual([3, 4], where("(state->>'i')::int >  %s\n", 2))
+        self.assertEqual(dict(size=1, hits=1, misses=1, invalidations=0),
+                         cache.stats())
+
+        # Arguments matter
+        self.assertEqual([4], where("(state->>'i')::int > %(i)s", i=3))
+        self.assertEqual([4], where("(state->>'i')::int > %(i)s", i=3))
+        self.assertEqual(dict(size=2, hits=2, misses=2, invalidations=0),
+                         cache.stats())
+
+        # Least recently used entries are evicted:
+        self.assertEqual([], where("(state->>'i')::int > %(i)s", i=4,
+                                   cache_classes=['newt.db._object.Object']))
+        self.assertEqual(dict(size=2, hits=2, misses=3, invalidations=0),
+                         cache.stats())
+        self.assertEqual([3, 4], where("(state->>'i')::int > %s", 2))
+        self.assertEqual(dict(size=2, hits=2, misses=4, invalidations=0),
+                         cache.stats())
+
+        # Results are invalidated by new transactions:
+        conn.root.other.append(2)
+        conn.commit()
+        self.assertEqual([3, 4], where("(state->>'i')::int > %s", 2))
+        self.assertEqual([], where("(state->>'i')::int > %(i)s", i=4,
+                                   cache_classes=['newt.db._object.Object']))
+        # The entry declared to depend on Object data survived:
+        self.assertEqual(dict(size=2, hits=3, misses=5, invalidations=1),
+                         cache.stats())
+
+        conn.root.obs[0].i = 9
+        conn.commit()
+        self.assertEqual([9], where("(state->>'i')::int > %(i)s", i=4,
+                                    cache_classes=['newt.db._object.Object']))
+        self.assertEqual(dict(size=1, hits=3, misses=6, invalidations=3),
+                         cache.stats())
+
+        # Connections with older views don't use the cache:
+        conn2 = db.open(transaction_manager=transaction.TransactionManager())
+        conn2.root.obs[1].i
+        conn.root.obs[1].i = 8
+        conn.commit()
+        self.assertEqual([8, 9], where("(state->>'i')::int > %(i)s", i=4))
+        self.assertEqual(
+            [9], sorted(o.i for o in conn2.where(
+                "(state->>'i')::int > %(i)s", i=4)))
+        self.assertEqual(dict(size=1, hits=3, misses=8, invalidations=4),
+                         cache.stats())
+
+        # Entries are invalidated when objects in their results
+        # change to classes they don't depend on:
+        object_where = lambda: where(
+            "class_name = 'newt.db._object.Object' and (state->>'i')::int > 4",
+            cache_classes=['newt.db._object.Object'])
+        self.assertEqual([8, 9], object_where())
+        conn.root.obs[1].__class__ = Other
+        conn.root.obs[1]._p_changed = True
+        conn.commit()
+        self.assertEqual([9], object_where())
+        self.assertEqual(dict(size=1, hits=3, misses=10, invalidations=6),
+                         cache.stats())
+        db.close()
+
+    def test_search_cache_quoted_whitespace(self):
+        import newt.db
+        db = newt.db.DB(self.dsn, search_cache_size=9)
+        conn = db.open()
+        conn.root.a = Object(name='a b')
+        conn.root.b = Object(name='a  b')
+        conn.commit()
+
+        where = lambda query: [o.name for o in conn.where(query)]
+        self.assertEqual(['a b'], where("state->>'name' = 'a b'"))
+        self.assertEqual(['a  b'], where("state->>'name' = 'a  b'"))
+        # Whitespace outside of quotes is still normalized:
+        self.assertEqual(['a  b'], where("state->>'name'  =\n'a  b'"))
+        self.assertEqual(dict(size=2, hits=1, misses=2, invalidations=0),
+                         db.search_cache.stats())
+        db.close()
+
+    def test_prepared_statements(self):
+        import newt.db
+        from ..search import prepared_statements, read_only_cursor
+        self.assertEqual(None, prepared_statements(self.conn))
+
+        db = newt.db.DB(self.dsn, prepared_statement_cache_size=2)
+        conn = db.open()
+        conn.root.obs = [Object(i=i) for i in range(9)]
+        conn.commit()
+        statements = prepared_statements(conn)
+        server_statements = lambda : conn.query_data(
+            "select statement from pg_prepared_statements"
+            " where name like 'newt%%'")
+
+        where = lambda *args, **kw: sorted(o.i for o in conn.where(*args, **kw))
+        self.assertEqual([7, 8], where("(state->>'i')::int > %s", 6))
+        self.assertEqual([5, 6, 7, 8], where("(state->>'i')::int > %s", 4))
+        self.assertEqual(dict(size=1, hits=1, misses=1, evictions=0,
+                              failures=0), statements.stats())
+        [[statement]] = server_statements()
+        self.assertTrue("(state->>'i')::int > $1" in statement)
+
+        # Named parameters and percents:
+        self.assertEqual(
+            [1], where("state->>'i' like %(a)s and state->>'i' like '%%1'",
+                       a='1'))
+        self.assertEqual(dict(size=2, hits=1, misses=2, evictions=0,
+                              failures=0), statements.stats())
+        self.assertTrue(
+            [statement for [statement] in server_statements()
+             if "like $1 and state->>'i' like '%1'" in statement])
+
+        # Batches and data queries work too, and least-recently-used
+        # statements are deallocated:
+        total, batch = conn.where_batch(
+            "(state->>'i')::int > %s order by zoid", (2, ), 1, 2)
+        self.assertEqual((6, [4, 5]), (total, [o.i for o in batch]))
+        total, batch = conn.where_batch(
+            "(state->>'i')::int > %s order by zoid", (2, ), 3, 2)
+        self.assertEqual((6, [6, 7]), (total, [o.i for o in batch]))
+        self.assertEqual(dict(size=2, hits=2, misses=3, evictions=1,
+                              failures=0), statements.stats())
+        self.assertEqual(2, len(server_statements()))
+
+        # Queries that can't be prepared are executed normally:
+        self.assertEqual([(3,)], conn.query_data("select %s + %s", 1, 2))
+        self.assertEqual([(3,)], conn.query_data("select %s + %s", 1, 2))
+        self.assertEqual(dict(size=2, hits=2, misses=3, evictions=2,
+                              failures=1), statements.stats())
+        self.assertEqual([7, 8], where("(state->>'i')::int > %s", 6))
+
+        # If a prepared statement can't be executed, the error is
+        # raised, and the statement is prepared again once the
+        # transaction is aborted:
+        cursor = read_only_cursor(conn)
+        cursor.execute("deallocate all")
+        cursor.close()
+        self.assertRaises(Exception, where, "(state->>'i')::int > %s", 6)
+        conn.transaction_manager.abort()
+        statements = prepared_statements(conn)
+        before = statements.stats()
+        self.assertEqual([7, 8], where("(state->>'i')::int > %s", 6))
+        self.assertEqual([7, 8], where("(state->>'i')::int > %s", 6))
+        after = statements.stats()
+        self.assertEqual((1, 1, 0), (after['hits'] - before['hits'],
+                                     after['misses'] - before['misses'],
+                                     after['failures'] - before['failures']))
+        self.assertEqual(1, len(server_statements()))
+        db.close()
+
+    def test_read_replicas(self):
+        import newt.db
+        from ..search import read_only_cursor
+
+        # A "replica" that lags the primary:
+        lagging = self.dbname + '_lagging'
+        self.base_cursor.execute('drop database if exists ' + lagging)
+        self.base_cursor.execute('create database ' + lagging)
+        try:
+            newt.db.DB('postgresql://localhost/' + lagging).close()
+
+            self.conn.root.obs = [Object(i=i) for i in range(9)]
+            self.conn.commit()
+
+            def database(conn):
+                cursor = read_only_cursor(conn)
+                try:
+                    cursor.execute("select current_database()")
+                    [[name]] = cursor.fetchall()
+                    primary = cursor.connection is conn._storage._load_conn
+                    return name, primary
+                finally:
+                    cursor.close()
+
+            # Replicas that are caught up are used:
+            db = newt.db.DB(self.dsn, read_replicas=(
+                'postgresql://localhost/' + lagging, self.dsn))
+            conn = db.open()
+            self.assertEqual((self.dbname, False), database(conn))
+            self.assertEqual((self.dbname, False), database(conn))
+            self.assertEqual([7, 8], sorted(
+                o.i for o in conn.where("(state->>'i')::int > %s", 6)))
+            self.assertEqual([7, 8], sorted(
+                o.i for o in conn.where_iter("(state->>'i')::int > %s", [6])))
+            db.close()
+
+            # If all of the replicas lag, the primary is used:
+            db = newt.db.DB(self.dsn, read_replicas=(
+                'postgresql://localhost/' + lagging, ))
+            conn = db.open()
+            self.assertEqual((self.dbname, True), database(conn))
+            self.assertEqual([7, 8], sorted(
+                o.i for o in conn.where("(state->>'i')::int > %s", 6)))
+            db.close()
+        finally:
+            self.base_cursor.execute(
+                "select pg_terminate_backend(pid) from pg_stat_activity"
+                " where datname = %s", (lagging, ))
+            self.base_cursor.execute('drop database ' + lagging)
+
     def test_search_no_args_no_problem_w_percent(self):
         self.assertEqual(
             [],
@@ -220,6 +613,117 @@ class SearchTests(DBSetup, unittest.TestCase):
             set(self.conn.where("txt(state) @@ 'bar | green'")),
             )
 
+    def test_create_text_index_concurrently(self):
+        from .. import pg_connection
+        self.store('a', text='foo bar')
+        self.store('b', text='foo baz', n='x')
+
+        pg = pg_connection(self.dsn)
+        cursor = pg.cursor()
+        def valid(name='newt_txt_idx'):
+            cursor.execute(
+                "select indisvalid from pg_index join pg_class"
+                " on (pg_class.oid = indexrelid) where relname = %s",
+                (name, ))
+            result = cursor.fetchall()
+            pg.commit()
+            return result
+
+        # The build waits for an open writing transaction, which we
+        # see as progress:
+        cursor.execute("update newt set class_name = class_name"
+                       " where zoid = 0")
+        phases = []
+        def progress(status):
+            phases.append(status['phase'])
+            pg.commit()
+
+        self.conn.create_text_index('txt', 'text', concurrently=True,
+                                    progress=progress, progress_interval=.01)
+        self.assertTrue(phases[0].startswith('waiting for'))
+        self.assertEqual([(True, )], valid())
+        self.conn.transaction_manager.abort()
+        self.assertEqual(
+            set((self.conn.root.a, self.conn.root.b)),
+            set(self.conn.where("txt(state) @@ 'foo'")))
+
+        # Existing valid indexes are left alone:
+        def oid():
+            cursor.execute("select 'newt_txt_idx'::regclass::oid")
+            [[result]] = cursor.fetchall()
+            pg.commit()
+            return result
+        old = oid()
+        self.conn.create_text_index('txt', 'text', concurrently=True)
+        self.assertEqual([(True, )], valid())
+        self.assertEqual(old, oid())
+
+        # Invalid indexes left by failed builds are rebuilt:
+        cursor.execute("update pg_index set indisvalid = false"
+                       " where indexrelid = 'newt_txt_idx'::regclass")
+        pg.commit()
+        self.assertEqual([(False, )], valid())
+        from .. import search
+        search.create_text_index(self.conn, 'txt', 'text', concurrently=True)
+        self.assertEqual([(True, )], valid())
+
+        # Failed builds don't leave invalid indexes:
+        with self.assertRaises(Exception):
+            self.conn.create_text_index(
+                'ntxt', "(state->>'n')::int::text", concurrently=True)
+        self.assertEqual([], valid('newt_ntxt_idx'))
+        pg.close()
+
+    def test_create_text_index_stored(self):
+        from .. import search
+        self.store('a', title='eggs', text='foo bar')
+        self.store('b', title='foo', text='green eggs')
+        self.assertEqual(3, len(self.conn.where("true"))) # Read newt
+        self.conn.create_text_index('txt', 'text', A='title', stored=True)
+
+        # Vectors are stored for new and changed records too:
+        self.store('c', title='spam', text='bar foo foo')
+        self.conn.root.a.text = 'foo bar baz'
+        self.conn.transaction_manager.commit()
+        self.assertEqual(
+            [(True, )] * 4,
+            self.conn.query_data(
+                "select txt_tsv = txt(state) from newt order by zoid"))
+
+        text_search = lambda *args, **kw: [
+            o.title for o in self.conn.text_search('txt', *args, **kw)]
+
+        # Results are ordered by rank:
+        self.assertEqual(['foo', 'spam', 'eggs'], text_search('foo'))
+        self.assertEqual(['foo', 'spam'], text_search('foo', limit=2))
+        self.assertEqual(['spam', 'eggs'], text_search(
+            'foo', "state->>'title' <> %s", ('foo', )))
+        self.assertEqual(
+            ['eggs'], text_search('foo bar', parser='phraseto_tsquery'))
+        self.assertEqual(['spam', 'eggs'], text_search(
+            'bar & foo', config='english', parser='to_tsquery'))
+        self.assertEqual(['foo', 'spam', 'eggs'], text_search(
+            'foo', stored=False))
+        self.assertRaises(ValueError, text_search, 'foo', parser='x')
+
+        # Stored columns can be filled in batches for concurrent builds:
+        search.create_text_index(self.conn, 'title', 'title', stored=True,
+                                 concurrently=True, batch_size=1)
+        self.assertEqual(
+            [(True, )] * 4,
+            self.conn.query_data(
+                "select title_tsv is not distinct from title(state)"
+                " from newt order by zoid"))
+        self.assertEqual(['spam'], [
+            o.title for o in search.text_search(self.conn, 'title', 'spam')])
+
+        sql = search.create_text_index_sql('txt', 'text', stored=True)
+        self.assertTrue(
+            'alter table newt add column if not exists txt_tsv' in sql)
+        self.assertTrue(
+            sql.endswith("create index newt_txt_idx on newt using gin"
+                         " (txt_tsv);\n"))
+
     def test_create_text_index_db_object(self):
         from .. import search
         conn = self.conn.root()
@@ -76,8 +76,9 @@ class UpdaterTests(base.TestCase):
                     return
 
     def drop_trigger(self):
-        self.ex("drop trigger newt_trigger_notify_object_state_changed"
-                " on object_state")
+        # Older PostgreSQL versions get the row trigger instead.
+        for name in (follow.ROW_TRIGGER, ) + follow.STATEMENT_TRIGGERS:
+            self.ex("drop trigger if exists %s on object_state" % name)
 
     def last_tid(self, expect=None):
         tid = follow.get_progress_tid(self.conn, updater.__name__)
@@ -116,6 +117,52 @@ class UpdaterTests(base.TestCase):
         self.assertEqual(self.search("""state @> '{"n": 3}'::jsonb"""),
                          [(3,)])
 
+    def test_jsonify_processes(self):
+        self.store_obs(1, *[(i, Object(i=i)) for i in range(1, 10)])
+        self.start_updater('-j2')
+        self.wait_tid(1)
+        self.store_obs(2, (2, Object(i=20)), (10, Object(i=10)))
+        self.wait_tid(2)
+        self.assertEqual(self.search("""state @> '{"i": 20}'::jsonb"""),
+                         [(2,)])
+        self.assertEqual(len(self.search("state ? 'i'")), 10)
+
+    def test_skip_unchanged(self):
+        import BTrees.OOBTree
+        self.store_obs(1, (1, Object(a=1)), (2, Object(a=2)), (3, Object(a=3)))
+        self.start_updater('--skip-unchanged')
+        self.wait_tid(1)
+        xmins = dict(self.fetch("select zoid, xmin::text from newt"))
+        self.store_obs(2, (1, Object(a=1)), (2, Object(a=22)),
+                       (3, BTrees.OOBTree.BTree()))
+        self.wait_tid(2)
+        self.assertEqual(self.fetch("select zoid, state from newt order by zoid"),
+                         [(1, {'a': 1}), (2, {'a': 22})])
+        new_xmins = dict(self.fetch("select zoid, xmin::text from newt"))
+        self.assertEqual(new_xmins[1], xmins[1])
+        self.assertNotEqual(new_xmins[2], xmins[2])
+
+    def test_auxiliary_tables(self):
+        self.ex("create table aux_a (zoid bigint primary key, a int)")
+        self.ex("create table aux_zoids (zoid bigint primary key)")
+        self.store_obs(1, (1, Object(a=1)), (2, Object(a=2)), (3, Object(b=3)))
+        self.start_updater('-a', __name__ + '.auxiliary_tables')
+        self.wait_tid(1)
+        self.assertEqual(self.fetch("select * from aux_a order by zoid"),
+                         [(1, 1), (2, 2)])
+        self.assertEqual(self.fetch("select * from aux_zoids order by zoid"),
+                         [(1, ), (2, ), (3, )])
+        xmins = dict(self.fetch("select zoid, xmin::text from aux_a"))
+        self.store_obs(2, (1, Object(a=1, b=1)), (2, Object(b=2)),
+                       (3, Object(a=3)))
+        self.wait_tid(2)
+        self.assertEqual(self.fetch("select * from aux_a order by zoid"),
+                         [(1, 1), (3, 3)])
+        # Unchanged rows aren't rewritten:
+        self.assertEqual(
+            dict(self.fetch("select zoid, xmin::text from aux_a"))[1],
+            xmins[1])
+
     def test_skip_Uninteresting(self):
         import BTrees.OOBTree
         import ZODB.blob
@@ -326,6 +373,13 @@ def xform(class_name, state):
         import json
         return json.dumps(json.loads(state)['data'])
 
+from .. import AuxiliaryTable
+auxiliary_tables = (
+    AuxiliaryTable('aux_a', [('a', "(state->>'a')::int")],
+                   where="state ? 'a'"),
+    'aux_zoids',
+    )
+
 class TransformTests(base.TestCase):
 
     def test_updater_transform(self):
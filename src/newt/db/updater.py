@@ -10,9 +10,11 @@ import relstorage.options
 import sys
 
 from . import pg_connection
+from . import auxiliary
 from . import follow
 from .jsonpickle import Jsonifier
-from ._adapter import DELETE_TRIGGER
+from ._adapter import DELETE_TRIGGER, WriteStats, state_digest
+from ._adapter import _add_state_digest
 from ._util import closing, table_exists, trigger_exists
 
 logger = logging.getLogger(__name__)
@@ -100,7 +102,70 @@ how your JSON data are generated and also provides a mechanism
 for ignoring some objects.  See the Newt DB transform option.
 """)
 
-def _update_newt(conn, cursor, jsonifier, Binary, batch):
+parser.add_argument(
+    '-j', '--jsonify-processes', type=int, default=0,
+    help = """\
+The number of worker processes to use to convert object state to JSON.
+By default, state is converted in the updater process.
+""")
+
+parser.add_argument(
+    '--json-encoder',
+    help = """\
+The dotted name of a function used to encode object state as JSON.
+See the Newt DB json-encoder option.
+""")
+
+parser.add_argument(
+    '--skip-unchanged', action='store_true',
+    help = """\
+Don't rewrite newt records whose data haven't changed.  This avoids
+index updates and dead rows when objects are saved without changes to
+their JSON data.
+""")
+
+parser.add_argument(
+    '-a', '--auxiliary-tables',
+    help = """\
+The dotted name of a sequence of auxiliary tables to refresh when
+newt records are updated.  Items are table names or
+newt.db.AuxiliaryTable objects.  See the Newt DB auxiliary-tables
+option.
+""")
+
+def _convert(jsonifier, Binary, data):
+    # Convert, filtering out null conversions (uninteresting classes)
+    converted = jsonifier.map(((tid, zoid), state) for tid, zoid, state in data)
+    return [(zoid, class_name, Binary(ghost_pickle), state,
+             Binary(state_digest(ghost_pickle, state)))
+            for (_, zoid, _), (class_name, ghost_pickle, state)
+            in zip(data, converted)
+            if state is not None]
+
+_insert_sql = (
+    "insert into newt (zoid, class_name, ghost_pickle, state, state_digest)"
+    " values %s")
+
+def _values(mogrify, to_save):
+    return ', '.join(mogrify('(%s, %s, %s, %s, %s)', d).decode('ascii')
+                     for d in to_save)
+
+def _refresh_auxiliary_tables(cursor, auxiliary_tables, data):
+    if auxiliary_tables:
+        auxiliary.refresh(
+            cursor, auxiliary_tables,
+            "select unnest(array[%s]::bigint[]) as zoid" %
+            ', '.join(str(d[1]) for d in data))
+
+# Lock the records being deleted in zoid order, like committers
+# using the 'rows' newt_lock option, to avoid deadlocks with them.
+_delete_sql = """
+delete from newt where zoid in (
+  select zoid from newt where zoid = any(%s) order by zoid for update)
+"""
+
+def _update_newt(conn, cursor, jsonifier, Binary, batch,
+                 auxiliary_tables=()):
     ex = cursor.execute
     mogrify = cursor.mogrify
 
@@ -114,51 +179,87 @@ def _update_newt(conn, cursor, jsonifier, Binary, batch):
         # Delete any existing records for the values. 2 reasons:
         # a) Make sire that new invalid data removes old valid data, and
         # b) Don't depend on upsert.
-        ex("delete from newt where zoid = any(%s)", ([d[1] for d in data], ))
+        ex(_delete_sql, ([d[1] for d in data], ))
 
-        # Convert, filtering out null conversions (uninteresting classes)
-        to_save = []
-        for tid, zoid, state in data:
-            class_name, ghost_pickle, state = jsonifier((tid, zoid), state)
-            if state is not None:
-                to_save.append((zoid, class_name, Binary(ghost_pickle), state))
+        to_save = _convert(jsonifier, Binary, data)
 
         if to_save:
-            ex("insert into newt (zoid, class_name, ghost_pickle, state)"
-               " values " +
-               ', '.join(mogrify('(%s, %s, %s, %s)', d).decode('ascii')
-                         for d in to_save)
-               )
+            ex(_insert_sql % _values(mogrify, to_save))
+
+        _refresh_auxiliary_tables(cursor, auxiliary_tables, data)
 
     if tid is not None:
         follow.set_progress_tid(conn, __name__, tid)
 
     conn.commit()
 
-def _compute_missing(conn, cursor, jsonifier, Binary, batch):
+write_stats = WriteStats()
+
+def _update_changed_newt(conn, cursor, jsonifier, Binary, batch,
+                         auxiliary_tables=()):
+    # Like _update_newt, but records with unchanged data aren't rewritten
     ex = cursor.execute
     mogrify = cursor.mogrify
 
     tid = None
+    written = unchanged = 0
     while True:
         data = list(itertools.islice(batch, 0, 100))
         if not data:
             break
         tid = data[-1][0]
 
-        # Convert, filtering out null conversions (uninteresting classes)
-        to_save = []
-        for tid, zoid, state in data:
-            class_name, ghost_pickle, state = jsonifier((tid, zoid), state)
-            if state is not None:
-                to_save.append((zoid, class_name, Binary(ghost_pickle), state))
+        to_save = _convert(jsonifier, Binary, data)
+
+        # Remove records that no longer have newt data:
+        saved = set(d[0] for d in to_save)
+        ex(_delete_sql, ([d[1] for d in data if d[1] not in saved], ))
 
         if to_save:
-            ex("insert into newt (zoid, class_name, ghost_pickle, state)"
-               " values %s on conflict do nothing" %
-               ', '.join(mogrify('(%s, %s, %s, %s)', d).decode('ascii')
-                         for d in to_save)
+            # Upsert, in zoid order, to avoid deadlocks with committers.
+            to_save.sort(key=lambda d: d[0])
+            ex(_insert_sql % _values(mogrify, to_save) +
+               " on conflict (zoid) do update set"
+               " class_name = excluded.class_name,"
+               " ghost_pickle = excluded.ghost_pickle,"
+               " state = excluded.state,"
+               " state_digest = excluded.state_digest"
+               " where newt.state_digest is distinct from"
+               " excluded.state_digest"
                )
+            written += cursor.rowcount
+            unchanged += len(to_save) - cursor.rowcount
+
+        _refresh_auxiliary_tables(cursor, auxiliary_tables, data)
+
+    if tid is not None:
+        follow.set_progress_tid(conn, __name__, tid)
+
+    conn.commit()
+
+    write_stats.add(written, unchanged)
+    logger.info("Wrote %s newt records, skipped %s unchanged (totals %s, %s)",
+                written, unchanged, write_stats.written, write_stats.unchanged)
+
+def _compute_missing(conn, cursor, jsonifier, Binary, batch,
+                     auxiliary_tables=()):
+    ex = cursor.execute
+    mogrify = cursor.mogrify
+
+    tid = None
+    while True:
+        data = list(itertools.islice(batch, 0, 100))
+        if not data:
+            break
+        tid = data[-1][0]
+
+        to_save = _convert(jsonifier, Binary, data)
+
+        if to_save:
+            ex(_insert_sql % _values(mogrify, to_save) +
+               " on conflict do nothing")
+
+        _refresh_auxiliary_tables(cursor, auxiliary_tables, data)
 
     conn.commit()
 
@@ -179,12 +280,26 @@ def main(args=None):
         from .component import global_by_name
         transform = global_by_name(transform)
 
-    jsonifier = Jsonifier(transform=transform)
+    json_encoder = options.json_encoder
+    if json_encoder is not None:
+        from .component import global_by_name
+        json_encoder = global_by_name(json_encoder)
+
+    auxiliary_tables = options.auxiliary_tables
+    if auxiliary_tables is not None:
+        from .component import global_by_name
+        auxiliary_tables = global_by_name(auxiliary_tables)
+    else:
+        auxiliary_tables = ()
+
+    jsonifier = Jsonifier(transform=transform,
+                          processes=options.jsonify_processes,
+                          encoder=json_encoder)
     driver = relstorage.adapters.postgresql.select_driver(
         relstorage.options.Options(driver=options.driver))
     Binary = driver.Binary
     dsn = options.connection_string
-    with closing(pg_connection(dsn)) as conn:
+    with closing(jsonifier), closing(pg_connection(dsn)) as conn:
         with closing(conn.cursor()) as cursor:
             if options.nagios:
                 if not table_exists(cursor, 'newt_follow_progress'):
@@ -229,6 +344,7 @@ def main(args=None):
                 ):
                 if not table_exists(cursor, 'newt'):
                     raise AssertionError("newt table doesn't exist")
+                _add_state_digest(cursor)
                 cursor.execute("select max(tid) from object_state")
                 [[tid]] = cursor
             else:
@@ -247,6 +363,9 @@ def main(args=None):
                             "Use -T to remove it.")
                         return 1
 
+                if table_exists(cursor, 'newt'):
+                    _add_state_digest(cursor)
+
                 if not options.no_gc:
                     cursor.execute(gc_sql)
 
@@ -268,7 +387,10 @@ def main(args=None):
                 logger.info("Starting updater at %s", tid)
                 start_tid = tid
                 end_tid = None
-                process = _update_newt
+                if options.skip_unchanged:
+                    process = _update_changed_newt
+                else:
+                    process = _update_newt
 
             for batch in follow.updates(
                 dsn,
@@ -277,7 +399,8 @@ def main(args=None):
                 batch_limit=options.transaction_size_limit,
                 poll_timeout=options.poll_timeout,
                 ):
-                process(conn, cursor, jsonifier, Binary, batch)
+                process(conn, cursor, jsonifier, Binary, batch,
+                        auxiliary_tables)
 
 if __name__ == '__main__':
     sys.exit(main())